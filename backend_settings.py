@@ -0,0 +1,41 @@
+import json
+import os
+
+import httpx
+
+
+# Settings and helpers shared by ollama_connects (blocking clients) and generation_engine (async clients).
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST")  # None lets the ollama package use its default (localhost:11434)
+DEFAULT_KEEP_ALIVE = "10m"
+
+# Private endpoint client: one pooled keep-alive connection set shared by all requests.
+ENDPOINT_CONNECT_TIMEOUT = 5.0   # seconds
+ENDPOINT_READ_TIMEOUT = 300.0    # seconds between bytes; long answers stream, so this bounds stalls only
+ENDPOINT_MAX_CONNECTIONS = 20
+ENDPOINT_HTTP2 = True            # used only when the optional h2 package is installed
+ENDPOINT_MAX_RETRIES = 3
+ENDPOINT_RETRY_BACKOFF = 0.5     # seconds, doubled after each failed attempt
+RETRY_STATUS_CODES = {502, 503, 504}
+
+
+def should_retry(method, error=None, status_code=None):
+    """GET is retried on any transport error or gateway status; POST only when it never reached the server."""
+    idempotent = method.upper() in ("GET", "HEAD", "OPTIONS")
+    if error is not None:
+        return idempotent or isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout))
+    return status_code in RETRY_STATUS_CODES if idempotent else status_code == 503
+
+
+def stream_chunk_text(line):
+    """Extracts the text from one line of a streamed private-endpoint response (NDJSON or SSE)."""
+    if line.startswith("data:"):
+        line = line[len("data:"):].strip()
+        if line == "[DONE]":
+            return ""
+    try:
+        data = json.loads(line)
+    except ValueError:
+        return line
+    if isinstance(data, dict):
+        return data.get("result") or data.get("response") or ""
+    return str(data)
@@ -0,0 +1,203 @@
+"""
+Deterministic stand-in for the Ollama API and a private endpoint, for benchmarks and load tests.
+
+Serves /api/generate, /api/chat, /api/tags, /api/embed and /api/ps like Ollama, plus the private
+endpoint's POST /model and GET /test. Answers are derived from a hash of the request, so repeated runs
+produce the same text; latency and tokens/sec are configurable.
+
+    python -m benchmarks.fake_server --port 11500 --latency 0.05 --tokens-per-second 200
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+WORDS = ("the model answers every question with a short deterministic sentence about local inference "
+         "privacy latency tokens context memory endpoints sessions and benchmarks").split()
+MODELS = ("fake-llm:7b", "fake-embed:latest")
+
+
+class FakeModelServer:
+    """Runs the stand-in server in a background thread; usable as a context manager."""
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, tokens_per_second=0.0, tokens=64,
+                 embedding_dim=256):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.tokens = tokens
+        self.embedding_dim = embedding_dim
+        self.requests = 0
+        self.httpd = ThreadingHTTPServer((host, port), _make_handler(self))
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-model-server", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def answer_tokens(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+        rng = random.Random(seed)
+        return [rng.choice(WORDS) + " " for _ in range(self.tokens)]
+
+    def embedding(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+        rng = random.Random(seed)
+        return [rng.uniform(-1, 1) for _ in range(self.embedding_dim)]
+
+    def token_delay(self):
+        return 1 / self.tokens_per_second if self.tokens_per_second else 0
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+        def _send_json(self, data, status=200):
+            body = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _stream(self, lines):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for line in lines:
+                data = (json.dumps(line) + "\n").encode("utf-8")
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _generate(self, key):
+            """Yields the answer tokens for key at the configured pace."""
+            time.sleep(server.latency)
+            delay = server.token_delay()
+            for token in server.answer_tokens(key):
+                if delay:
+                    time.sleep(delay)
+                yield token
+
+        def _ollama_reply(self, body, chat):
+            model = body.get("model", MODELS[0])
+            key = json.dumps(body.get("messages") if chat else body.get("prompt"), sort_keys=True)
+            started = time.perf_counter_ns()
+
+            def chunk(text, done):
+                data = {"model": model, "created_at": _now(), "done": done}
+                if chat:
+                    data["message"] = {"role": "assistant", "content": text}
+                else:
+                    data["response"] = text
+                if done:
+                    elapsed = time.perf_counter_ns() - started
+                    data.update(done_reason="stop", total_duration=elapsed, load_duration=0,
+                                prompt_eval_count=len(key) // 4, prompt_eval_duration=0,
+                                eval_count=server.tokens, eval_duration=elapsed)
+                return data
+
+            if not chat and not body.get("prompt"):
+                return self._send_json(chunk("", True))  # preload request
+            if body.get("stream", True):
+                return self._stream(_paced(self._generate(key), lambda token: chunk(token, False),
+                                           lambda: chunk("", True)))
+            return self._send_json(chunk("".join(self._generate(key)), True))
+
+        def do_GET(self):
+            server.requests += 1
+            if self.path == "/api/tags":
+                return self._send_json({"models": [{
+                    "name": name, "model": name, "modified_at": _now(), "size": 4_000_000_000,
+                    "digest": hashlib.sha256(name.encode()).hexdigest(),
+                    "details": {"format": "gguf", "family": "fake", "families": ["fake"],
+                                "parameter_size": "7B", "quantization_level": "Q4_0"},
+                } for name in MODELS]})
+            if self.path == "/api/ps":
+                return self._send_json({"models": []})
+            if self.path == "/test":
+                return self._send_json({"message": "Connected to the fake endpoint."})
+            self._send_json({"error": "not found"}, 404)
+
+        def do_POST(self):
+            server.requests += 1
+            body = self._body()
+            if self.path == "/api/generate":
+                return self._ollama_reply(body, chat=False)
+            if self.path == "/api/chat":
+                return self._ollama_reply(body, chat=True)
+            if self.path == "/api/embed":
+                texts = body.get("input") or []
+                texts = [texts] if isinstance(texts, str) else texts
+                return self._send_json({"model": body.get("model"),
+                                        "embeddings": [server.embedding(text) for text in texts]})
+            if self.path == "/model":
+                key = json.dumps(body.get("messages") or body.get("prompt"), sort_keys=True)
+                if body.get("stream"):
+                    return self._stream(_paced(self._generate(key), lambda token: {"result": token}))
+                return self._send_json({"result": "".join(self._generate(key))})
+            self._send_json({"error": "not found"}, 404)
+
+    return Handler
+
+
+def _paced(tokens, wrap, last=None):
+    """Wraps tokens as they are produced, then appends last() (e.g. Ollama's final stats chunk)."""
+    for token in tokens:
+        yield wrap(token)
+    if last is not None:
+        yield last()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11500)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0, help="0 streams as fast as possible")
+    parser.add_argument("--tokens", type=int, default=64, help="tokens per answer")
+    args = parser.parse_args()
+    server = FakeModelServer(args.host, args.port, args.latency, args.tokens_per_second, args.tokens)
+    print(f"Fake model server on {server.url} (OLLAMA_HOST={server.url}, private endpoint {server.url}/model)")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
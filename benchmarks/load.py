@@ -0,0 +1,290 @@
+"""
+Load generator: N simulated users chatting through the Dash callback endpoint of one app instance.
+
+Every user loads the page (bootstrap_page) and opens a session (create_new_session), then loops: think,
+send a question (add_question), start the answer (update_pending_responses) and poll it
+(stream_pending_response) until it is complete. Requests go to /_dash-update-component exactly as the
+browser sends them, built from the app's /_dash-dependencies.
+
+    python -m benchmarks.load --users 20 --duration 60 --think-time 2
+    python -m benchmarks.load --url http://127.0.0.1:8919 --model llama3   # against a running instance
+
+Without --url the app is started in-process on a scratch database, backed by benchmarks.fake_server.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+import httpx
+
+from benchmarks.fake_server import MODELS, FakeModelServer
+from benchmarks.run import _git_commit
+
+
+POLL_INTERVAL = 0.25  # seconds, as main.STREAM_POLL_INTERVAL
+
+
+class DashClient:
+    """Calls Dash callbacks by one of their output ids, filling inputs and state from a value map."""
+
+    def __init__(self, url, timeout=300):
+        self.url = url.rstrip("/")
+        # Shared by all simulated users; the pool keeps a keep-alive connection per concurrent request.
+        self.http = httpx.Client(timeout=timeout, limits=httpx.Limits(max_connections=None))
+        self.callbacks = {}
+        for dependency in self.http.get(f"{self.url}/_dash-dependencies").json():
+            for component_id, prop in _split_outputs(dependency["output"]):
+                # Several callbacks may write an output (allow_duplicate); call() picks one by its trigger.
+                self.callbacks.setdefault((_id_key(component_id), prop.split("@")[0]), []).append(dependency)
+
+    def call(self, output, values, triggered, index=None):
+        """
+        Runs the callback that writes output ("id.property") and has triggered, the input that changed,
+        among its inputs. values {"id.property": value} fill its inputs and state (None when missing) and
+        index fills MATCH ids. Returns {"id.property": value} of the outputs the callback updated.
+        """
+        component_id, prop = output.rsplit(".", 1)
+        if index is not None:
+            component_id = _id_key(dict(json.loads(component_id), index=["MATCH"]))
+
+        def concrete(spec_id):
+            if isinstance(spec_id, str) and spec_id.startswith("{"):
+                spec_id = json.loads(spec_id)  # pattern-matching ids come JSON-encoded
+            if isinstance(spec_id, dict):
+                return {k: index if v == ["MATCH"] else v for k, v in spec_id.items()}
+            return spec_id
+
+        dependency = next(d for d in self.callbacks[(component_id, prop)]
+                          if triggered in {f"{_id_key(concrete(spec['id']))}.{spec['property']}"
+                                           for spec in d["inputs"]})
+
+        def item(spec):
+            spec_id = concrete(spec["id"])
+            return {"id": spec_id, "property": spec["property"],
+                    "value": values.get(f"{_id_key(spec_id)}.{spec['property']}")}
+
+        outputs = [{"id": concrete(i), "property": p} for i, p in _split_outputs(dependency["output"])]
+        inputs = [item(spec) for spec in dependency["inputs"]]
+        body = {
+            "output": dependency["output"],
+            "outputs": outputs if dependency["output"].startswith("..") else outputs[0],
+            "inputs": inputs,
+            "state": [item(spec) for spec in dependency["state"]],
+            "changedPropIds": [triggered],
+        }
+        response = self.http.post(f"{self.url}/_dash-update-component", json=body)
+        if response.status_code == 204:  # PreventUpdate or all no_update
+            return {}
+        response.raise_for_status()
+        updated = {}
+        for key, props in response.json().get("response", {}).items():
+            for name, value in props.items():
+                updated[f"{_id_key(json.loads(key) if key.startswith('{') else key)}.{name.split('@')[0]}"] = value
+        return updated
+
+
+def _id_key(component_id):
+    if isinstance(component_id, dict):
+        return json.dumps(component_id, sort_keys=True, separators=(",", ":"))
+    return component_id
+
+
+def _split_outputs(output):
+    """Splits a Dash output spec ("a.b" or "..a.b...c.d..") into (id, property) pairs."""
+    parts = output[2:-2].split("...") if output.startswith("..") else [output]
+    pairs = []
+    for part in parts:
+        if part.startswith("{"):
+            end = part.rindex("}") + 1
+            pairs.append((json.loads(part[:end]), part[end + 1:]))
+        else:
+            component_id, prop = part.rsplit(".", 1)
+            pairs.append((component_id, prop))
+    return pairs
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.errors = {}
+
+    def record(self, name, seconds=None, error=None):
+        with self.lock:
+            self.timings.setdefault(name, [])
+            self.errors.setdefault(name, [])
+            if error is None:
+                self.timings[name].append(seconds)
+            else:
+                self.errors[name].append(error)
+
+    def summary(self, duration):
+        report = {}
+        for name in self.timings:
+            timings = sorted(self.timings[name])
+            errors = self.errors[name]
+            total = len(timings) + len(errors)
+            entry = {"count": total, "errors": len(errors), "error_rate": len(errors) / total if total else 0.0,
+                     "per_second": len(timings) / duration}
+            for p in (50, 90, 95, 99):
+                entry[f"p{p}_ms"] = timings[min(len(timings) - 1, len(timings) * p // 100)] * 1000 if timings else None
+            entry["max_ms"] = timings[-1] * 1000 if timings else None
+            entry["sample_errors"] = sorted(set(errors))[:5]
+            report[name] = entry
+        return report
+
+
+def simulate_user(client, user, args, results, deadline):
+    rng = random.Random(user)
+    values = {"model-options.value": args.model, "private-endpoint-switch.value": args.mode == "api",
+              "private-endpoint-url-store.data": args.endpoint_url, "access-token-store.data": "token",
+              "url-path.pathname": "/"}
+
+    def timed(name, fn):
+        started = time.perf_counter()
+        try:
+            result = fn()
+        except Exception as e:
+            results.record(name, error=f"{type(e).__name__}: {e}")
+            return None
+        results.record(name, time.perf_counter() - started)
+        return result
+
+    # The page load, then a fresh session for this user.
+    if timed("bootstrap_page", lambda: client.call("session-dropdown.value", values, "url-path.pathname")) is None:
+        return
+    values["new-session.n_clicks"] = 1
+    updated = timed("create_new_session", lambda: client.call(
+        "session-dropdown.value", values, "new-session.n_clicks"))
+    if not updated:
+        return
+    values["session-dropdown.value"] = updated.get("session-dropdown.value")
+    turn = 0
+    while time.monotonic() < deadline:
+        time.sleep(rng.uniform(0.5, 1.5) * args.think_time)
+        turn += 1
+        question = f"User {user} question {turn}: {rng.choice(['why', 'how', 'what', 'when'])} does it work?"
+        values.update({"send-button.n_clicks": turn, "user-input.n_submit": turn, "user-input.value": question})
+        turn_started = time.perf_counter()
+        if timed("add_question", lambda: client.call("chat-container.children", values,
+                                                     "send-button.n_clicks")) is None:
+            continue
+
+        response_key = _id_key({"index": turn, "type": "chat-response"})
+        pending = dict(values, **{f"{response_key}.children": "",
+                                  f"{_id_key({'index': turn, 'type': 'chat-question'})}.children": f"You: {question}"})
+        updated = timed("update_pending_responses", lambda: client.call(
+            f"{response_key}.children", pending, f"{response_key}.children", index=turn))
+        if updated is None:
+            continue
+        stream_key = _id_key({"index": turn, "type": "chat-stream-id"})
+        stream_id = updated.get(f"{stream_key}.data")
+        # Answered without streaming (semantic cache hit or streaming off) unless a stream id came back.
+        answer = None if stream_id else json.dumps(updated)
+        first_token = None
+        polls = 0
+        while stream_id and time.monotonic() < deadline + args.drain:
+            time.sleep(POLL_INTERVAL)
+            polls += 1
+            interval_key = _id_key({"index": turn, "type": "chat-stream-interval"})
+            polled = timed("stream_pending_response", lambda: client.call(
+                f"{_id_key({'index': turn, 'type': 'chat-stream'})}.children",
+                {f"{interval_key}.n_intervals": polls, f"{stream_key}.data": stream_id},
+                f"{interval_key}.n_intervals", index=turn))
+            if polled is None:
+                break
+            text = json.dumps(polled)
+            if first_token is None and "**AI:**" in text:
+                first_token = time.perf_counter() - turn_started
+            if polled.get(f"{interval_key}.disabled"):
+                answer = text
+                break
+        if answer is None:
+            results.record("turn", error="answer not finished before the deadline")
+        elif "Error" in answer:
+            results.record("turn", error=answer[:200])
+        else:
+            results.record("turn", time.perf_counter() - turn_started)
+            if first_token is not None:
+                results.record("time_to_first_token", first_token)
+
+
+def serve_app(args, model_server):
+    """Starts the Dash app in this process on a scratch database; returns its URL and the werkzeug server."""
+    from werkzeug.serving import make_server
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)  # no access log line per callback
+    os.environ["OLLAMA_HOST"] = model_server.url
+    import sql_connects
+    sql_connects.DB_FILENAME = os.path.join(args.tmp, "load.db")
+    sql_connects.close_all_connections()
+    sql_connects.init_db()
+    import main
+
+    server = make_server("127.0.0.1", 0, main.app.server, threaded=True)
+    threading.Thread(target=server.serve_forever, name="dash-under-load", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive the Dash callbacks with concurrent simulated users.")
+    parser.add_argument("--url", help="running app to test; default: start one in-process")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=60, help="seconds users keep asking questions")
+    parser.add_argument("--drain", type=float, default=60, help="extra seconds to let open answers finish")
+    parser.add_argument("--think-time", type=float, default=2.0, help="mean seconds between questions")
+    parser.add_argument("--model", default=MODELS[0])
+    parser.add_argument("--mode", choices=("local", "api"), default="local")
+    parser.add_argument("--latency", type=float, default=0.05, help="fake server seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=100.0)
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    model_server = FakeModelServer(latency=args.latency, tokens_per_second=args.tokens_per_second,
+                                   tokens=args.tokens).start()
+    args.endpoint_url = f"{model_server.url}/model"
+    with tempfile.TemporaryDirectory() as tmp:
+        args.tmp = tmp
+        app_server = None
+        url = args.url
+        if url is None:
+            url, app_server = serve_app(args, model_server)
+        client = DashClient(url)
+        results = Results()
+        started = time.monotonic()
+        deadline = started + args.duration
+        users = [threading.Thread(target=simulate_user, args=(client, user, args, results, deadline), daemon=True)
+                 for user in range(args.users)]
+        for thread in users:
+            thread.start()
+        for thread in users:
+            thread.join()
+        elapsed = time.monotonic() - started
+        if app_server is not None:
+            app_server.shutdown()
+    model_server.stop()
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": _git_commit(),
+        "params": {k: getattr(args, k) for k in ("users", "duration", "think_time", "model", "mode",
+                                                  "latency", "tokens_per_second", "tokens")},
+        "elapsed_seconds": elapsed,
+        "results": results.summary(elapsed),
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
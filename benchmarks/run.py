@@ -0,0 +1,292 @@
+"""
+Times the app's hot paths against a fake model server and a scratch database; prints JSON results.
+
+    python -m benchmarks.run                       # every scenario at the default sizes
+    python -m benchmarks.run sql context --sizes 1000 100000 1000000 --output bench.json
+
+Results carry the scenario, the case name, its parameters and latency statistics in milliseconds, so
+runs saved with --output can be compared over time.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.fake_server import MODELS, FakeModelServer
+
+
+DEFAULT_SIZES = (1_000, 10_000, 100_000)
+SESSION_MESSAGES = 200  # messages per seeded session, so N messages span N / SESSION_MESSAGES sessions
+STARTUP_REPEAT = 5  # each startup sample is a fresh interpreter, so fewer than --repeat
+
+# Run in a fresh interpreter by scenario_startup; prints the phase timings in seconds as JSON.
+STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import sql_connects
+sql_connects.DB_FILENAME = sys.argv[1]
+import main
+imported = time.perf_counter()
+sql_connects.init_db()
+initialised = time.perf_counter()
+main.bootstrap_page("/")
+loaded = time.perf_counter()
+print(json.dumps({"import main": imported - started, "init_db": initialised - imported,
+                  "bootstrap_page": loaded - initialised, "first screen": loaded - started}))
+"""
+
+
+def measure(fn, repeat=20, warmup=2):
+    """Calls fn repeatedly and returns latency statistics in milliseconds."""
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return _statistics(timings)
+
+
+def _statistics(timings):
+    """Latency statistics of timings in milliseconds."""
+    timings = sorted(timings)
+    return {
+        "repeat": len(timings),
+        "mean_ms": statistics.fmean(timings),
+        "p50_ms": timings[len(timings) // 2],
+        "p95_ms": timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        "min_ms": timings[0],
+        "max_ms": timings[-1],
+    }
+
+
+def _result(scenario, name, params, stats):
+    return {"scenario": scenario, "name": name, "params": params, **stats}
+
+
+def _use_database(path):
+    import sql_connects
+    sql_connects.DB_FILENAME = path
+    sql_connects.close_all_connections()
+    sql_connects.init_db()
+    return sql_connects
+
+
+def seed_messages(sql_connects, count, session_messages=SESSION_MESSAGES, words=40):
+    """Bulk-inserts count alternating user/AI messages spread over sessions of session_messages each."""
+    rng = random.Random(count)
+    vocabulary = "local model answer question context memory token session endpoint privacy".split()
+    sessions = max(1, count // session_messages)
+    with sql_connects.get_connection() as conn, conn:
+        conn.executemany("INSERT OR IGNORE INTO sessions (session_id, session_name) VALUES (?, ?)",
+                         [(f"bench-{s}", f"bench-{s}") for s in range(sessions)])
+        batch = []
+        for i in range(count):
+            text = " ".join(rng.choice(vocabulary) for _ in range(words))
+            batch.append((f"bench-{(i // session_messages) % sessions}", "user" if i % 2 == 0 else "Ai", text))
+            if len(batch) >= 10_000:
+                conn.executemany("INSERT INTO chat_history (session_id, sender, message) VALUES (?, ?, ?)", batch)
+                batch = []
+        if batch:
+            conn.executemany("INSERT INTO chat_history (session_id, sender, message) VALUES (?, ?, ?)", batch)
+    return sessions
+
+
+def scenario_ollama(args, server):
+    """get_ollama_response through the engine, against the fake Ollama API and private endpoint."""
+    import ollama_connects
+    from ollama_connects import get_ollama_response
+    ollama_connects.RESPONSE_CACHE_ENABLED = True  # opt-in in the app; the cached rows measure it
+    results = []
+    counter = iter(range(10 ** 9))
+    for mode, api_url in (("local", None), ("api", f"{server.url}/model")):
+        for cached in (False, True):
+            def call():
+                prompt = "benchmark prompt" if cached else f"benchmark prompt {next(counter)}"
+                answer = get_ollama_response(prompt, MODELS[0], mode, api_url, "token", use_cache=cached)
+                if answer.startswith("Error"):
+                    raise RuntimeError(answer)
+            results.append(_result("ollama", f"get_ollama_response[{mode}]",
+                                   {"cached": cached, "latency": server.latency,
+                                    "tokens_per_second": server.tokens_per_second, "tokens": server.tokens},
+                                   measure(call, args.repeat)))
+    return results
+
+
+def scenario_sql(args, server):
+    """sql_connects reads and writes on databases of increasing size."""
+    results = []
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            sql_connects = _use_database(os.path.join(tmp, "bench.db"))
+            started = time.perf_counter()
+            sessions = seed_messages(sql_connects, size)
+            seed_seconds = time.perf_counter() - started
+            session = f"bench-{sessions // 2}"
+            params = {"messages": size, "sessions": sessions, "seed_seconds": seed_seconds}
+
+            def burst(write_behind, count=100):
+                # A burst of inserts until they are all in SQLite, with or without the write-behind queue.
+                def run():
+                    sql_connects.WRITE_BEHIND, previous = write_behind, sql_connects.WRITE_BEHIND
+                    try:
+                        for _ in range(count):
+                            sql_connects.update_messages(session, "benchmark message", "user")
+                        sql_connects.flush_writes()
+                    finally:
+                        sql_connects.WRITE_BEHIND = previous
+                return run
+
+            cases = {
+                "fetch_all": sql_connects.fetch_all,
+                "get_chat_history[page]": lambda: sql_connects.get_chat_history(session, limit=50),
+                "get_chat_history[full]": lambda: sql_connects.get_chat_history(session),
+                "get_messages_after": lambda: sql_connects.get_messages_after(session, 0, 50),
+                "update_messages": lambda: sql_connects.update_messages(session, "benchmark message", "user"),
+                "update_messages[burst x100]": burst(False),
+                "update_messages[burst x100, write-behind]": burst(True),
+                "search_chat_history": lambda: sql_connects.search_chat_history("context memory", 20),
+                "fetch_sessions_to_title": sql_connects.fetch_sessions_to_title,
+            }
+            for name, fn in cases.items():
+                results.append(_result("sql", name, params, measure(fn, args.repeat)))
+            sql_connects.close_all_connections()
+    return results
+
+
+def scenario_context(args, server):
+    """get_conversation_context on one long session: cold, warm, and after one new message."""
+    results = []
+    for length in (100, 1_000, 10_000):
+        with tempfile.TemporaryDirectory() as tmp:
+            sql_connects = _use_database(os.path.join(tmp, "bench.db"))
+            seed_messages(sql_connects, length, session_messages=length)
+            session = "bench-0"
+            params = {"session_messages": length}
+
+            def cold():
+                sql_connects.invalidate_conversation_context(session)
+                sql_connects.get_conversation_context(session)
+
+            def after_append():
+                sql_connects.update_messages(session, "one more question", "user")
+                sql_connects.get_conversation_context(session)
+
+            results.append(_result("context", "get_conversation_context[cold]", params, measure(cold, args.repeat)))
+            results.append(_result("context", "get_conversation_context[warm]", params,
+                                   measure(lambda: sql_connects.get_conversation_context(session), args.repeat)))
+            results.append(_result("context", "get_conversation_context[append]", params,
+                                   measure(after_append, args.repeat)))
+            sql_connects.close_all_connections()
+    return results
+
+
+def scenario_render(args, server):
+    """add_question rendering a large session, as when the user opens it."""
+    results = []
+    for length in (100, 1_000, 10_000):
+        with tempfile.TemporaryDirectory() as tmp:
+            sql_connects = _use_database(os.path.join(tmp, "bench.db"))
+            import main  # builds the Dash app; imported after the scratch database is in place
+            from plotly.utils import PlotlyJSONEncoder
+            seed_messages(sql_connects, length, session_messages=length)
+            params = {"session_messages": length, "page_size": main.CHAT_PAGE_SIZE}
+
+            def open_session():
+                # Serialised as Dash does before sending the callback response.
+                json.dumps(main.add_question(0, 0, "bench-0", None, "", [], []), cls=PlotlyJSONEncoder)
+
+            results.append(_result("render", "add_question[open session]", params,
+                                   measure(open_session, args.repeat)))
+            sql_connects.close_all_connections()
+    return results
+
+
+def scenario_startup(args, server):
+    """
+    Cold start to a usable page: importing main, init_db on an existing database and the bootstrap_page
+    callback of the first page load, each sample in a new interpreter.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    phases = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        database = os.path.join(tmp, "startup.db")
+        # The first run creates the database and compiles the bytecode; it is not counted.
+        for run in range(STARTUP_REPEAT + 1):
+            process = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, database], cwd=root,
+                                     capture_output=True, text=True, check=True)
+            if run:
+                for phase, seconds in json.loads(process.stdout.splitlines()[-1]).items():
+                    phases.setdefault(phase, []).append(seconds * 1000)
+    return [_result("startup", phase, {}, _statistics(timings)) for phase, timings in phases.items()]
+
+
+SCENARIOS = {
+    "startup": scenario_startup,
+    "ollama": scenario_ollama,
+    "sql": scenario_sql,
+    "context": scenario_context,
+    "render": scenario_render,
+}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the app's hot paths.")
+    parser.add_argument("scenarios", nargs="*", help=f"scenarios to run: {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="message counts for the sql scenario (e.g. 1000 ... 1000000)")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.0, help="fake server seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=0.0)
+    parser.add_argument("--tokens", type=int, default=64)
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(unknown)}")
+
+    server = FakeModelServer(latency=args.latency, tokens_per_second=args.tokens_per_second,
+                             tokens=args.tokens).start()
+    # Must be set before ollama_connects is imported, which reads it once.
+    os.environ["OLLAMA_HOST"] = server.url
+    with tempfile.TemporaryDirectory() as tmp:
+        _use_database(os.path.join(tmp, "bench.db"))
+        report = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "commit": _git_commit(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "results": [],
+        }
+        for name in args.scenarios or SCENARIOS:
+            try:
+                report["results"].extend(SCENARIOS[name](args, server))
+            except ImportError as e:
+                report["results"].append({"scenario": name, "skipped": f"missing dependency: {e.name}"})
+    server.stop()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,315 @@
+import base64
+import codecs
+import csv
+import importlib.util
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ollama_connects import stream_ollama_response
+from retrieval import index_document
+from sql_connects import (MULTI_PROCESS, add_document_chunks, create_document, estimate_tokens, get_document,
+                          get_document_progress, iter_document_chunks, save_document_progress, update_document)
+
+
+# PDFs are read with pypdf (in requirements.txt); they are only offered when it is installed.
+SUPPORTED_EXTENSIONS = {".txt", ".md", ".markdown", ".csv"}
+if importlib.util.find_spec("pypdf") is not None:
+    SUPPORTED_EXTENSIONS.add(".pdf")
+
+# Uploads arrive as a base64 data URL; it is decoded DECODE_BLOCK characters at a time (a multiple of 4)
+# and cut into chunks of about CHUNK_TOKENS tokens, stored CHUNK_BATCH rows per transaction.
+DECODE_BLOCK = 256 * 1024
+CHUNK_TOKENS = 400
+CHUNK_BATCH = 64
+INGEST_WORKERS = 2
+# Progress is kept in memory while a document is being worked on, and stored with the document once it is
+# finished, when the memory copy is dropped. With several server processes, progress polls may reach one
+# that is not ingesting the file, so it is also stored on every status change and at most every
+# PROGRESS_SYNC_INTERVAL seconds.
+PROGRESS_SYNC_INTERVAL = 0.5
+FINISHED_STATUSES = ("ready", "error")
+
+# Summaries are map-reduced: groups of chunks up to SUMMARY_INPUT_TOKENS are summarised on their own,
+# then the partial summaries are merged the same way until one is left.
+SUMMARY_INPUT_TOKENS = 3000
+SUMMARY_MAP_PROMPT = """Summarize the following part of the document "{filename}".
+Keep names, numbers, decisions and conclusions. Reply with the summary only.
+
+{text}"""
+SUMMARY_REDUCE_PROMPT = """Below are summaries of consecutive parts of the document "{filename}".
+Combine them into one summary that keeps names, numbers, decisions and conclusions. Reply with the summary only.
+
+{text}"""
+
+_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="document-ingest")
+_summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="document-summary")
+_progress = {}
+_progress_synced = {}
+_progress_lock = threading.Lock()
+
+
+def is_supported(filename):
+    return os.path.splitext(filename or "")[1].lower() in SUPPORTED_EXTENSIONS
+
+
+def _payload_start(contents):
+    """Offset of the base64 payload in a dcc.Upload data URL, without copying it."""
+    comma = contents.find(",", 0, 256)
+    return comma + 1 if comma >= 0 else 0
+
+
+def iter_decoded(contents, start=0, on_progress=None):
+    """Yields the bytes of a base64 payload one block at a time. on_progress gets the bytes decoded so far."""
+    done = 0
+    for offset in range(start, len(contents), DECODE_BLOCK):
+        block = base64.b64decode(contents[offset:offset + DECODE_BLOCK])
+        done += len(block)
+        if on_progress:
+            on_progress(done)
+        yield block
+
+
+def iter_text(blocks, encoding="utf-8-sig"):
+    """Decodes byte blocks incrementally, so a character split across two blocks survives."""
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    for block in blocks:
+        text = decoder.decode(block)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def iter_lines(pieces):
+    """Regroups text pieces into lines, keeping line endings."""
+    rest = ""
+    for piece in pieces:
+        lines = (rest + piece).splitlines(keepends=True)
+        rest = lines.pop() if lines and not lines[-1].endswith(("\n", "\r")) else ""
+        yield from lines
+    if rest:
+        yield rest
+
+
+def iter_csv_text(pieces):
+    """Renders every CSV row as "column: value" pairs so a chunk still makes sense without the header."""
+    rows = csv.reader(iter_lines(pieces))
+    header = next(rows, None)
+    if header is None:
+        return
+    for row in rows:
+        if any(row):
+            yield "; ".join(f"{name}: {value}" for name, value in zip(header, row) if value) + "\n"
+
+
+def iter_pdf_text(blocks):
+    """Yields the text of a PDF page by page. Needs the optional pypdf package."""
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise ValueError("PDF support needs the pypdf package (pip install pypdf).")
+    # PDFs are read from the end (cross-reference table), so the bytes have to be assembled first.
+    buffer = io.BytesIO()
+    for block in blocks:
+        buffer.write(block)
+    for page in PdfReader(buffer).pages:
+        text = page.extract_text() or ""
+        if text.strip():
+            yield text + "\n\n"
+
+
+def _split_point(text, start, limit):
+    """Where the chunk starting at start should end: the last break in its second half, else start + limit."""
+    for separator in ("\n\n", "\n", ". ", " "):
+        cut = text.rfind(separator, start + limit // 2, start + limit)
+        if cut >= 0:
+            return cut + len(separator)
+    return start + limit
+
+
+def iter_chunks(pieces, chunk_tokens=None):
+    """Cuts a stream of text into chunks of about chunk_tokens tokens, preferring paragraph and line breaks."""
+    limit = (chunk_tokens or CHUNK_TOKENS) * 4
+    buffer = ""
+    for piece in pieces:
+        # Chunks are cut at an offset into the buffer; what is left is copied once per piece, not per chunk.
+        buffer += piece
+        start = 0
+        while len(buffer) - start >= limit:
+            cut = _split_point(buffer, start, limit)
+            chunk = buffer[start:cut].strip()
+            start = cut
+            if chunk:
+                yield chunk
+        buffer = buffer[start:]
+    buffer = buffer.strip()
+    if buffer:
+        yield buffer
+
+
+def iter_document_text(contents, filename, on_progress=None):
+    """Streams the text of an uploaded file from its data URL."""
+    blocks = iter_decoded(contents, _payload_start(contents), on_progress)
+    extension = os.path.splitext(filename or "")[1].lower()
+    if extension == ".pdf":
+        return iter_pdf_text(blocks)
+    if extension == ".csv":
+        return iter_csv_text(iter_text(blocks))
+    return iter_text(blocks)
+
+
+def _set_progress(document_id, **values):
+    finished = values.get("status") in FINISHED_STATUSES
+    with _progress_lock:
+        progress = _progress.setdefault(document_id, {})
+        progress.update(values)
+        if not MULTI_PROCESS and not finished:
+            return
+        now = time.monotonic()
+        if "status" not in values and now - _progress_synced.get(document_id, 0) < PROGRESS_SYNC_INTERVAL:
+            return
+        _progress_synced[document_id] = now
+        progress = dict(progress)
+    save_document_progress(document_id, progress)
+    if finished:
+        with _progress_lock:
+            # Only if nothing restarted it (schedule_summary) while the final state was being stored.
+            if _progress.get(document_id, {}).get("status") in FINISHED_STATUSES:
+                _progress.pop(document_id, None)
+                _progress_synced.pop(document_id, None)
+
+
+def ingest_document(session_id, document_id, contents, filename):
+    """
+    Decodes, chunks and stores one uploaded file, then embeds the chunks into the session's retrieval index,
+    reporting progress as it goes. Returns the chunk count.
+    """
+    count = 0
+    batch = []
+
+    def on_progress(done):
+        _set_progress(document_id, bytes_done=done)
+
+    for chunk in iter_chunks(iter_document_text(contents, filename, on_progress)):
+        batch.append((count, chunk, estimate_tokens(chunk)))
+        count += 1
+        if len(batch) >= CHUNK_BATCH:
+            add_document_chunks(document_id, batch)
+            batch = []
+            _set_progress(document_id, chunks=count)
+    if batch:
+        add_document_chunks(document_id, batch)
+    update_document(document_id, status="indexing", chunk_count=count)
+    _set_progress(document_id, chunks=count, status="indexing", indexed=0)
+    try:
+        index_document(session_id, document_id, lambda done: _set_progress(document_id, indexed=done))
+    except Exception as e:
+        # The chunks stay stored (and summarisable) without an embedding model; answers just skip retrieval.
+        print(f"Error indexing {filename}: {e}")
+        _set_progress(document_id, error=f"Retrieval index unavailable: {e}")
+    update_document(document_id, status="ready")
+    _set_progress(document_id, status="ready")
+    return count
+
+
+def _run_ingest(session_id, document_id, contents, filename):
+    try:
+        ingest_document(session_id, document_id, contents, filename)
+    except Exception as e:
+        print(f"Error ingesting {filename}: {e}")
+        update_document(document_id, status="error")
+        _set_progress(document_id, status="error", error=str(e))
+
+
+def start_ingestion(session_id, filename, contents):
+    """Registers an upload for a session and ingests it in the background. Returns the document id."""
+    document_id = create_document(session_id, filename)
+    payload = len(contents) - _payload_start(contents)
+    _set_progress(document_id, filename=filename, status="ingesting", bytes_done=0,
+                  bytes_total=payload * 3 // 4, chunks=0)
+    _executor.submit(_run_ingest, session_id, document_id, contents, filename)
+    return document_id
+
+
+def ingest_progress(document_id):
+    """Returns a copy of the progress of a document (filename, status, bytes, chunks, summary) or None."""
+    with _progress_lock:
+        progress = _progress.get(document_id)
+        if progress is not None:
+            return dict(progress)
+    # Finished, or being ingested by another server process.
+    progress = get_document_progress(document_id)
+    if progress is not None:
+        return progress
+    row = get_document(document_id)
+    if row is None:
+        return None
+    _, _, filename, status, chunk_count, summary = row
+    return {"filename": filename, "status": status, "chunks": chunk_count, "summary": summary}
+
+
+def _summarize_groups(texts, prompt, filename, *args):
+    """Summarises consecutive texts in groups of up to SUMMARY_INPUT_TOKENS tokens; yields one summary per group."""
+    group, tokens = [], 0
+    for text in texts:
+        size = estimate_tokens(text)
+        if group and tokens + size > SUMMARY_INPUT_TOKENS:
+            yield _summarize(prompt, filename, group, *args)
+            group, tokens = [], 0
+        group.append(text)
+        tokens += size
+    if group:
+        yield _summarize(prompt, filename, group, *args)
+
+
+def _summarize(prompt, filename, texts, model, mode, api_url, access_token):
+    """One model call; a failed generation raises GenerationError, which _run_summary reports."""
+    answer = "".join(stream_ollama_response(prompt.format(filename=filename, text="\n\n".join(texts)), model,
+                                            mode, api_url, access_token, priority="background")).strip()
+    if not answer:
+        raise RuntimeError("empty summary")
+    return answer
+
+
+def summarize_document(document_id, model, mode="local", api_url=None, access_token=None):
+    """Map-reduce summary of a stored document; only one group of chunks is held in memory at a time."""
+    _, _, filename, _, chunk_count, _ = get_document(document_id)
+    args = (model, mode, api_url, access_token)
+    summaries = []
+    for summary in _summarize_groups((content for _, _, content, _ in iter_document_chunks(document_id)),
+                                     SUMMARY_MAP_PROMPT, filename, *args):
+        summaries.append(summary)
+        _set_progress(document_id, summary_parts=len(summaries))
+    while len(summaries) > 1:
+        reduced = list(_summarize_groups(summaries, SUMMARY_REDUCE_PROMPT, filename, *args))
+        if len(reduced) >= len(summaries):
+            # Every partial summary fills a group on its own; merge them in one call rather than loop.
+            reduced = [_summarize(SUMMARY_REDUCE_PROMPT, filename, summaries, *args)]
+        summaries = reduced
+    summary = summaries[0] if summaries else ""
+    update_document(document_id, summary=summary)
+    return summary
+
+
+def _run_summary(document_id, *args):
+    try:
+        summary = summarize_document(document_id, *args)
+        _set_progress(document_id, status="ready", summary=summary)
+    except Exception as e:
+        print(f"Error summarizing document {document_id}: {e}")
+        _set_progress(document_id, status="ready", error=f"Summary failed: {e}")
+
+
+def schedule_summary(document_id, model, mode="local", api_url=None, access_token=None):
+    """Queues a map-reduce summary of an ingested document at background priority."""
+    progress = ingest_progress(document_id)
+    if not progress or progress.get("status") != "ready" or (not model and mode == "local"):
+        return False
+    # progress may have come from SQLite (ingested by another process), so it seeds this process's copy.
+    _set_progress(document_id, **{**progress, "status": "summarizing", "summary_parts": 0, "error": None})
+    _summary_executor.submit(_run_summary, document_id, model, mode, api_url, access_token)
+    return True
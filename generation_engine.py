@@ -0,0 +1,302 @@
+import asyncio
+import hashlib
+import importlib.util
+import json
+import queue
+import threading
+import time
+
+import httpx
+
+from backend_settings import (DEFAULT_KEEP_ALIVE, ENDPOINT_CONNECT_TIMEOUT, ENDPOINT_HTTP2,
+                              ENDPOINT_MAX_CONNECTIONS, ENDPOINT_MAX_RETRIES, ENDPOINT_READ_TIMEOUT,
+                              ENDPOINT_RETRY_BACKOFF, OLLAMA_HOST, should_retry, stream_chunk_text)
+import generation_scheduler
+import metrics
+
+
+# Every generation runs as a task on one asyncio event loop in a background thread; the Dash callbacks
+# use the blocking stream() facade. GENERATION_TIMEOUT is the default deadline in seconds, counted from
+# submission, so time spent queued in generation_scheduler is included.
+GENERATION_TIMEOUT = 900
+
+_loop = None
+_loop_lock = threading.Lock()
+_async_clients = {}
+_flights = {}
+_END = object()
+
+
+class GenerationError(Exception):
+    """A generation failed or timed out; the text streamed before the failure is not a complete answer."""
+
+
+class CancellationToken:
+    """Lets any thread stop the generations it was passed to. Once no caller is waiting on a generation,
+    its backend connection is closed, which makes Ollama (and streaming private endpoints) stop generating."""
+
+    def __init__(self):
+        self.cancelled = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            get_loop().call_soon_threadsafe(callback)
+
+    def _on_cancel(self, callback):
+        """Registers callback to run on the engine loop when cancelled (immediately if it already was)."""
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+
+class _Flight:
+    """One generation on the backend, fanned out to every caller that asked for the same thing."""
+
+    def __init__(self, key):
+        self.key = key
+        self.chunks = []
+        self.subscribers = []
+        self.stats = {"cancelled": False, "timed_out": False, "error": None}
+        self.task = None
+
+    def publish(self, chunk):
+        self.chunks.append(chunk)
+        for emit, _ in list(self.subscribers):
+            emit(chunk)
+
+
+def get_loop():
+    """Returns the engine's event loop, starting its thread on first use."""
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="generation-engine", daemon=True).start()
+                _loop = loop
+    return _loop
+
+
+def _ollama_client():
+    if "ollama" not in _async_clients:
+        import ollama  # deferred, as in ollama_connects.get_client
+        _async_clients["ollama"] = ollama.AsyncClient(host=OLLAMA_HOST)
+    return _async_clients["ollama"]
+
+
+def _endpoint_client():
+    if "endpoint" not in _async_clients:
+        _async_clients["endpoint"] = httpx.AsyncClient(
+            http2=ENDPOINT_HTTP2 and importlib.util.find_spec("h2") is not None,
+            timeout=httpx.Timeout(ENDPOINT_READ_TIMEOUT, connect=ENDPOINT_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=ENDPOINT_MAX_CONNECTIONS,
+                                max_keepalive_connections=ENDPOINT_MAX_CONNECTIONS),
+        )
+    return _async_clients["endpoint"]
+
+
+async def _local_chunks(prompt, model, options, keep_alive, stats, messages=None):
+    """Streams from Ollama: /api/chat when messages are given (so the server can reuse the KV cache of the
+    unchanged message prefix between turns), /api/generate for a plain prompt."""
+    if messages:
+        response = await _ollama_client().chat(model=model, messages=messages, stream=True,
+                                               options=options, keep_alive=keep_alive)
+    else:
+        response = await _ollama_client().generate(model=model, prompt=prompt, stream=True,
+                                                   options=options, keep_alive=keep_alive)
+    async for chunk in response:
+        text = chunk.message.content if messages else chunk.response
+        if text:
+            yield text
+        if chunk.done:
+            ns = 1e-9
+            stats.update(
+                model=chunk.model,
+                prompt_eval_count=chunk.prompt_eval_count or 0,
+                eval_count=chunk.eval_count or 0,
+                total_duration=(chunk.total_duration or 0) * ns,
+                load_duration=(chunk.load_duration or 0) * ns,
+                prompt_eval_duration=(chunk.prompt_eval_duration or 0) * ns,
+                eval_duration=(chunk.eval_duration or 0) * ns,
+            )
+
+
+async def _open_endpoint_stream(client, request):
+    """Sends a streaming POST, retrying with backoff only while nothing has reached the server."""
+    for attempt in range(ENDPOINT_MAX_RETRIES + 1):
+        last = attempt == ENDPOINT_MAX_RETRIES
+        try:
+            response = await client.send(request, stream=True)
+        except httpx.TransportError as e:
+            if last or not should_retry("POST", error=e):
+                raise
+        else:
+            if last or not should_retry("POST", status_code=response.status_code):
+                return response
+            await response.aclose()
+        await asyncio.sleep(ENDPOINT_RETRY_BACKOFF * 2 ** attempt)
+
+
+async def _endpoint_chunks(prompt, api_url, access_token, messages=None):
+    """
+    Streams from a private endpoint. It is sent `"stream": true`; a plain JSON reply comes as one chunk.
+    Chat requests also carry the role-tagged `messages` for endpoints that support them.
+    """
+    headers = {}
+    if access_token:
+        headers["Authorization"] = f"Bearer {access_token}"
+    payload = {"prompt": prompt, "stream": True}
+    if messages:
+        payload["messages"] = messages
+    client = _endpoint_client()
+    request = client.build_request("POST", api_url, json=payload, headers=headers)
+    response = await _open_endpoint_stream(client, request)
+    try:
+        if response.status_code != 200:
+            await response.aread()
+            raise GenerationError(f"API returned status code {response.status_code} with message: {response.text}")
+        if response.headers.get("Content-Type", "").startswith("application/json"):
+            await response.aread()
+            yield json.loads(response.text).get("result", "").strip()
+            return
+        async for line in response.aiter_lines():
+            if line:
+                text = stream_chunk_text(line)
+                if text:
+                    yield text
+    finally:
+        await response.aclose()
+
+
+def _chunks(prompt, model, mode, api_url, access_token, options, keep_alive, stats, messages):
+    if mode == "local":
+        return _local_chunks(prompt, model, options or {}, keep_alive, stats, messages)
+    return _endpoint_chunks(prompt, api_url, access_token, messages)
+
+
+def _resources(model, mode, api_url):
+    if mode == "local":
+        return [("model", model), ("endpoint", OLLAMA_HOST or "local")]
+    return [("endpoint", api_url)]
+
+
+def _flight_key(prompt, model, mode, api_url, access_token, options, messages):
+    key = json.dumps([mode, model, api_url, access_token, options or {}, prompt, messages], sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+async def _produce(flight, chunks, resources, priority, timeout, mode, model):
+    """
+    Runs one generation once a scheduler slot is free, publishing chunks until done, cancelled or late.
+    A failure or timeout is recorded in flight.stats["error"], never published as answer text. Queue
+    wait, time to first chunk, total time and the streaming rate go to flight.stats and metrics.
+    """
+    started = time.perf_counter()
+    first = None
+    count = 0
+    try:
+        async with asyncio.timeout(timeout):
+            async with generation_scheduler.acquire(resources, priority):
+                flight.stats["queue_wait"] = time.perf_counter() - started
+                async for chunk in chunks:
+                    if first is None:
+                        first = time.perf_counter()
+                        flight.stats["time_to_first_token"] = first - started
+                    count += 1
+                    flight.publish(chunk)
+    except TimeoutError:
+        flight.stats["timed_out"] = True
+        flight.stats["error"] = f"generation timed out after {timeout} seconds."
+    except asyncio.CancelledError:
+        flight.stats["cancelled"] = True
+    except Exception as e:
+        flight.stats["error"] = str(e)
+    finally:
+        await chunks.aclose()
+        finished = time.perf_counter()
+        flight.stats["generation_seconds"] = finished - started
+        if count > 1 and finished > first:
+            # Chunks are tokens for Ollama and usually for streaming endpoints, so both modes compare.
+            flight.stats["tokens_per_second"] = (count - 1) / (finished - first)
+        metrics.record_generation(flight.stats, mode, model)
+        if _flights.get(flight.key) is flight:
+            del _flights[flight.key]
+        for emit, stats in flight.subscribers:
+            stats.update(flight.stats)
+            emit(_END)
+        flight.subscribers.clear()
+
+
+def _unsubscribe(flight, subscriber):
+    if subscriber not in flight.subscribers:
+        return
+    flight.subscribers.remove(subscriber)
+    emit, stats = subscriber
+    stats["cancelled"] = True
+    emit(_END)
+    if not flight.subscribers and flight.task is not None:
+        flight.task.cancel()
+
+
+def _subscribe(key, start, emit, stats, token):
+    """Joins the in-flight generation for key (replaying what it produced so far) or starts a new one."""
+    flight = _flights.get(key) if key is not None else None
+    if flight is None:
+        flight = _Flight(key)
+        if key is not None:
+            _flights[key] = flight
+        flight.task = get_loop().create_task(start(flight))
+    subscriber = (emit, stats)
+    for chunk in flight.chunks:
+        emit(chunk)
+    flight.subscribers.append(subscriber)
+    token._on_cancel(lambda: _unsubscribe(flight, subscriber))
+
+
+def stream(prompt, model, mode="local", api_url=None, access_token=None, options=None,
+           keep_alive=DEFAULT_KEEP_ALIVE, token=None, timeout=GENERATION_TIMEOUT, stats=None,
+           priority="interactive", coalesce=True, messages=None):
+    """
+    Blocking generator over the chunks of one generation running on the engine loop.
+
+    A failure or timeout raises GenerationError once the chunks produced before it have been yielded,
+    and is also recorded in stats["error"] (with stats["timed_out"] for timeouts). Closing the generator
+    early, or cancelling token, detaches this caller; the backend generation stops once no caller is
+    left. With coalesce, identical requests already in flight are shared instead of generated twice.
+    Token counts and timings end up in stats if given (for the caller that started the generation).
+    With messages, the chat endpoint is used and prompt is only the flattened fallback for private
+    endpoints.
+    """
+    if stats is None:
+        stats = {}
+    if token is None:
+        token = CancellationToken()
+    chunks = queue.SimpleQueue()
+    key = _flight_key(prompt, model, mode, api_url, access_token, options, messages) if coalesce else None
+
+    def start(flight):
+        backend = _chunks(prompt, model, mode, api_url, access_token, options, keep_alive, stats, messages)
+        return _produce(flight, backend, _resources(model, mode, api_url), priority,
+                        timeout or GENERATION_TIMEOUT, mode, model)
+
+    get_loop().call_soon_threadsafe(_subscribe, key, start, chunks.put, stats, token)
+    finished = False
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is _END:
+                finished = True
+                break
+            yield chunk
+    finally:
+        if not finished:
+            token.cancel()
+    if stats.get("error") and not stats.get("cancelled"):
+        raise GenerationError(stats["error"])
@@ -0,0 +1,102 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+
+
+# Interactive chat always goes ahead of queued background work (titles, compaction, document summaries).
+PRIORITIES = {"interactive": 0, "background": 1}
+
+# Generations allowed to run at once per model and per backend (the local Ollama server or a private
+# endpoint URL). CONCURRENCY_LIMITS overrides single keys, e.g. {("model", "llama3:8b"): 2}.
+MODEL_CONCURRENCY = 2
+ENDPOINT_CONCURRENCY = 4
+CONCURRENCY_LIMITS = {}
+
+
+class _Slots:
+    """Counting semaphore for the engine loop that wakes waiters by priority, then arrival order."""
+
+    _order = itertools.count()
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.waiters = []
+        self.waited = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    async def acquire(self, priority):
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self._order), future))
+        started = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()  # the slot was handed over just as we were cancelled
+            raise
+        finally:
+            waited = time.monotonic() - started
+            self.waited += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+    def release(self):
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)  # hand our slot straight to the next waiter
+                return
+        self.active -= 1
+
+    def queued(self):
+        return sum(1 for _, _, future in self.waiters if not future.done())
+
+
+_slots = {}
+
+
+def _get_slots(key):
+    if key not in _slots:
+        default = MODEL_CONCURRENCY if key[0] == "model" else ENDPOINT_CONCURRENCY
+        _slots[key] = _Slots(CONCURRENCY_LIMITS.get(key, default))
+    return _slots[key]
+
+
+@asynccontextmanager
+async def acquire(resources, priority="interactive"):
+    """
+    Holds one slot of every resource key, e.g. [("model", "llama3"), ("endpoint", "local")], for the
+    duration of the block. Must be used on the generation engine loop.
+    """
+    level = PRIORITIES.get(priority, PRIORITIES["background"])
+    acquired = []
+    try:
+        for key in resources:
+            await _get_slots(key).acquire(level)
+            acquired.append(key)
+        yield
+    finally:
+        for key in reversed(acquired):
+            _get_slots(key).release()
+
+
+def scheduler_stats():
+    """Snapshot of every limiter: limit, running, queued and queue wait times, keyed "kind:name"."""
+    return {
+        f"{kind}:{name}": {
+            "limit": slots.limit,
+            "active": slots.active,
+            "queued": slots.queued(),
+            "waited": slots.waited,
+            "wait_seconds_total": slots.wait_seconds_total,
+            "wait_seconds_max": slots.wait_seconds_max,
+        }
+        for (kind, name), slots in list(_slots.items())
+    }
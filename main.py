@@ -1,16 +1,32 @@
 import dash
-from dash import dcc, html, Input, Output, State, MATCH, Patch, ctx
+from dash import dcc, html, Input, Output, State, MATCH, ALL, Patch, ctx
 import dash_bootstrap_components as dbc
+import argparse
+import os
+import shutil
+import sys
 import threading
-import webview
-import requests
-from ollama_connects import list_available_models, get_ollama_response
+from ollama_connects import (get_model_catalog, model_catalog_loaded, get_chat_response, stream_chat_response,
+                             endpoint_request, preload_model, preload_pinned_models, model_load_status,
+                             response_cache_stats)
+from generation_engine import CancellationToken
+from response_streams import start_stream, read_stream, cancel_stream
+from session_jobs import (schedule_compaction, schedule_title_updates, titles_version, start_leader_election,
+                          is_background_leader)
+from document_ingest import SUPPORTED_EXTENSIONS, is_supported, start_ingestion, ingest_progress, schedule_summary
+from retrieval import retrieval_message, delete_index, has_index
+from semantic_cache import (cache_scope, forget_session, lookup as semantic_lookup,
+                            remember as semantic_remember, semantic_cache_snapshot)
+from generation_scheduler import scheduler_stats
+from metrics import RequestTrace, span, register_collector, render_prometheus, slow_requests
+import flask
 import datetime
 from sql_connects import (init_db, fetch_all,
                           create_session, update_messages, get_chat_history,
-                          delete_session, get_conversation_context,
-                          update_session_name, update_private_endpoint,
-                          fetch_private_endpoint
+                          delete_session, get_conversation_messages,
+                          get_messages_after, search_chat_history, get_message_session,
+                          update_private_endpoint,
+                          load_startup_state, install_shutdown_flush, write_behind_stats
                           )
 
 
@@ -23,10 +39,12 @@ user_png = './assets/user.svg'
 
 EXTERNAL_STYLESHEETS = [stylesheet1, stylesheet2, fontstylecss, fontstylecss]
 
-# -------------------------------
-# Database Setup (unchanged)
-# -------------------------------
-init_db()
+# Show answers token by token while they are generated instead of waiting for the full text.
+STREAM_RESPONSES = True
+STREAM_POLL_INTERVAL = 250  # ms
+# Messages rendered when a session is opened; older ones are loaded a page at a time on demand.
+CHAT_PAGE_SIZE = 50
+
 BETA_EXPIRY_DATE = datetime.datetime(2026, 6, 1)
 
 
@@ -109,6 +127,41 @@ app = dash.Dash(__name__,
                 suppress_callback_exceptions=True
 
                 )
+# The Flask app, for WSGI servers (see wsgi.py).
+server = app.server
+
+
+def collect_app_metrics():
+    scheduler = scheduler_stats()
+    semantic = semantic_cache_snapshot()
+    return [
+        ("scheduler_active", "gauge", "Generations running per scheduler resource.",
+         [({"resource": key}, stats["active"]) for key, stats in scheduler.items()]),
+        ("scheduler_queued", "gauge", "Generations waiting per scheduler resource.",
+         [({"resource": key}, stats["queued"]) for key, stats in scheduler.items()]),
+        ("response_cache_total", "counter", "Response cache hits, misses and writes.",
+         [({"result": key}, value) for key, value in response_cache_stats.items()]),
+        ("semantic_cache_total", "counter", "Semantic cache hits, misses and errors.",
+         [({"result": key}, semantic[key]) for key in ("hits", "misses", "errors")]),
+        ("semantic_cache_lookup_seconds_total", "counter", "Time spent in semantic cache lookups.",
+         [({}, semantic["lookup_seconds_total"])]),
+        ("write_behind_writes_total", "counter", "Queued SQLite writes stored, and dropped after failing.",
+         [({"result": key}, value) for key, value in write_behind_stats.items()]),
+    ]
+
+
+register_collector(collect_app_metrics)
+
+
+@app.server.route("/metrics")
+def prometheus_metrics():
+    return flask.Response(render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+@app.server.route("/metrics/slow")
+def slow_request_log():
+    return flask.jsonify(slow_requests())
+
 
 app.layout = dbc.Container([
 
@@ -185,6 +238,11 @@ app.layout = dbc.Container([
             ),
 
             html.Div(id="session-list", style={"overflowY": "auto"}),
+            dcc.Input(id="history-search", type="search", debounce=True, placeholder="Search all chats...",
+                      style={"width": "100%", "marginBottom": "5px"}),
+            html.Div(id="search-results", style={"overflowY": "auto", "maxHeight": "30vh"}),
+            dcc.Store(id="chat-jump-id"),
+            html.Div(id="chat-scroll-anchor", style={"display": "none"}),
             html.H5("Questions"),
             html.Div(id="history-container", style={"overflowY": "auto"})
         ], width=3, style={"borderRight": "1px solid lightgray", "padding": "15px"}),
@@ -208,7 +266,11 @@ app.layout = dbc.Container([
                                 html.Div([
                                     html.Label("Local models"),
                                     dcc.Dropdown(id="model-options", options=[
-                                    ], value=[])
+                                    ], value=[]),
+                                    html.Div(id="model-status", className="mt-2",
+                                             style={"fontSize": "0.85em", "color": "gray"}),
+                                    dcc.Interval(id="model-status-interval", interval=1000, disabled=True),
+                                    dcc.Interval(id="model-catalog-interval", interval=1000, disabled=True)
                                 ], id='local-models'),
 
                                 html.Div([
@@ -253,6 +315,9 @@ app.layout = dbc.Container([
 
             ], style={"height": "40px"}),
             dbc.Row([
+                dcc.Store(id="chat-oldest-id"),
+                dbc.Button("Load earlier messages", id="load-earlier-button", color="link", n_clicks=0,
+                           style={"display": "none"}),
                 html.Div(id="chat-container", style={
                     "height": "80vh", "overflowY": "auto",
                     "border": "1px solid lightgray", "padding": "10px",
@@ -263,6 +328,10 @@ app.layout = dbc.Container([
             dbc.Row([
 
                 html.Div(id='file-output'),
+                dcc.Store(id="ingest-document-id"),
+                dcc.Interval(id="ingest-progress-interval", interval=500, disabled=True),
+                html.Div(dbc.Button("Summarize file", id="summarize-file-btn", color="link", n_clicks=0),
+                         id="summarize-file", style={"display": "none"}),
 
                 dbc.Col(
                     dcc.Input(id="user-input", type="text", placeholder="Type a message...", style={"width": "100%"}),
@@ -271,7 +340,7 @@ app.layout = dbc.Container([
                     dcc.Upload(children=dbc.Button(
                         [html.Img(src="/assets/upload.svg", height="20px", style={"filter": "invert(100%)"})],
                         id="", n_clicks=0, color="primary", style={"marginLeft": "0px"}), id='upload-file',
-                        multiple=False,
+                        multiple=False, accept=",".join(sorted(SUPPORTED_EXTENSIONS)),
                     )
 
                 ], width=1),
@@ -340,7 +409,7 @@ def test_connection(n_clicks, url, port, protocol, api_key):
         api_key = api_key
         headers = {"Authorization": f"Bearer {api_key}"}
         try:
-            response = requests.get(full_url, headers=headers, verify=True)
+            response = endpoint_request("GET", full_url, headers=headers)
             if response.status_code == 200:
                 json_resp = response.json()
                 return f"Success: {json_resp.get('message', 'Connected successfully!')}"
@@ -353,22 +422,22 @@ def test_connection(n_clicks, url, port, protocol, api_key):
 
 @app.callback(
     Output("connection-output1", "children"),
-    Output("private-endpoint-url", "value"),
-    Output("private-endpoint-port", "value"),
-    Output("private-endpoint-protocol", "value"),
-    Output("private-endpoint-api-key", "value"),
-    Output("private-endpoint-url-store", "data"),
-    Output("access-token-store", "data"),
+    Output("private-endpoint-url", "value", allow_duplicate=True),
+    Output("private-endpoint-port", "value", allow_duplicate=True),
+    Output("private-endpoint-protocol", "value", allow_duplicate=True),
+    Output("private-endpoint-api-key", "value", allow_duplicate=True),
+    Output("private-endpoint-url-store", "data", allow_duplicate=True),
+    Output("access-token-store", "data", allow_duplicate=True),
     Input("save-endpoint-btn", "n_clicks"),
-    Input("url-path", "pathname"),
     [
         State("private-endpoint-url", "value"),
         State("private-endpoint-port", "value"),
         State("private-endpoint-protocol", "value"),
         State("private-endpoint-api-key", "value")
-    ]
+    ],
+    prevent_initial_call=True
 )
-def save_endpoint(n_clicks, url_path, url, port, protocol, api_key):
+def save_endpoint(n_clicks, url, port, protocol, api_key):
     if n_clicks:
         if not url or not port or not protocol or not api_key:
             return "Please fill in all fields before saving."
@@ -380,27 +449,45 @@ def save_endpoint(n_clicks, url_path, url, port, protocol, api_key):
         except Exception as e:
             return (f"Error saving endpoint: {str(e)}", dash.no_update, dash.no_update, dash.no_update, dash.no_update,
                     dash.no_update, dash.no_update)
-    else:
-        enpoint = fetch_private_endpoint()
-        url = enpoint[0][1]
-        port = enpoint[0][2]
-        protocol = enpoint[0][3]
-        api_key = enpoint[0][4]
-        full_url = f"{protocol}://{url}:{port}/model"
-        return dash.no_update, url, port, protocol, api_key, full_url, api_key
+    return (dash.no_update,) * 7
+
+
+def model_option_label(model):
+    details = [d for d in (model["parameter_size"], model["quantization"]) if d]
+    if model["size"]:
+        details.append(f"{model['size'] / 1e9:.1f} GB")
+    return f"{model['name']} ({', '.join(details)})" if details else model["name"]
 
 
 @app.callback(
-    Output("model-options", "options"),
-    Input('url-path', 'pathname')
+    Output("model-options", "options", allow_duplicate=True),
+    Input("open-offcanvas", "n_clicks"),
+    prevent_initial_call=True
 )
-def update_models_installed(pathname_url):
-    models = list_available_models()
-    models = [{'label': m, 'value': m} for m in models]
+def update_models_installed(n_clicks):
+    # Served from the model catalog cache; it refreshes itself in the background when stale.
+    models = get_model_catalog()
+    models = [{'label': model_option_label(m), 'value': m["name"]} for m in models]
 
     return models
 
 
+@app.callback(
+    Output("model-status", "children"),
+    Output("model-status-interval", "disabled"),
+    Input("model-options", "value"),
+    Input("model-status-interval", "n_intervals")
+)
+def show_model_status(model, n_intervals):
+    if not model:
+        return "", True
+    if ctx.triggered_id == "model-options":
+        # Load the weights now so the first question does not pay the cold start.
+        preload_model(model)
+    status = model_load_status(model)
+    return f"Model status: {status}", status != "loading"
+
+
 @app.callback(
     Output("offcanvas", "is_open"),
     Input("open-offcanvas", "n_clicks"),
@@ -412,37 +499,126 @@ def toggle_offcanvas(n, is_open):
 
 
 @app.callback(
+    Output("model-options", "options"),
+    Output("private-endpoint-url", "value"),
+    Output("private-endpoint-port", "value"),
+    Output("private-endpoint-protocol", "value"),
+    Output("private-endpoint-api-key", "value"),
+    Output("private-endpoint-url-store", "data"),
+    Output("access-token-store", "data"),
+    Output('session-dropdown', 'options'),
+    Output('session-dropdown', 'value'),
     Output("user-input", "style"),
     Output("beta-modal", "is_open"),
+    Output("model-catalog-interval", "disabled"),
     Input("url-path", "pathname")
-
 )
-def check_expiry_block(url_path):
-    now = datetime.datetime.now()
-    expired = now > BETA_EXPIRY_DATE
-    if expired:
+def bootstrap_page(url_path):
+    """
+    Fills the page on load in one round trip: the model list, the saved private endpoint, the sessions
+    and the beta expiry block. The callbacks that later update these outputs skip the initial call.
+    """
+    # Served from the model catalog cache without waiting on the daemon; if the first listing has not
+    # arrived yet, model-catalog-interval fills the dropdown once it does.
+    models = [{'label': model_option_label(m), 'value': m["name"]} for m in get_model_catalog()]
+    rows, endpoint = load_startup_state("Session 1")
+    if endpoint:
+        url, port, protocol, api_key = endpoint[1:5]
+        full_url = f"{protocol}://{url}:{port}/model"
+        endpoint_values = (url, port, protocol, api_key, full_url, api_key)
+    else:
+        endpoint_values = (dash.no_update,) * 6
+    if datetime.datetime.now() > BETA_EXPIRY_DATE:
         # Even if the user closes the modal, keep inputs disabled.
-        return {"pointerEvents": "none", "opacity": "0.5", "width": "100%"}, True
+        expiry = ({"pointerEvents": "none", "opacity": "0.5", "width": "100%"}, True)
     else:
+        expiry = (dash.no_update, False)
+    sessions = [{'label': r[1], 'value': r[0]} for r in rows]
+    return (models, *endpoint_values, sessions, rows[0][0], *expiry, model_catalog_loaded())
+
+
+@app.callback(
+    Output("model-options", "options", allow_duplicate=True),
+    Output("model-catalog-interval", "disabled", allow_duplicate=True),
+    Input("model-catalog-interval", "n_intervals"),
+    prevent_initial_call=True
+)
+def fill_models_after_first_load(n_intervals):
+    if not model_catalog_loaded():
         return dash.no_update, False
+    return [{'label': model_option_label(m), 'value': m["name"]} for m in get_model_catalog()], True
+
+
+def render_saved_message(sender, message, message_id=None, highlight=False):
+    """Returns the chat row for a stored message, plus its sidebar entry if it is a user question."""
+    # Rows carry the message id so a search result can scroll to them.
+    row_props = {"id": f"message-{message_id}"} if message_id is not None else {}
+    if highlight:
+        row_props["style"] = {"backgroundColor": "rgba(63, 81, 181, 0.1)", "borderRadius": "10px"}
+    if sender == 'user':
+        saved_response = dbc.Row([
+            dbc.Col([html.Img(src=user_png, className='brand-logo')], width=1),
+            dbc.Col(
+                html.Div(f"You: {message}",
+                         # id={"type": "chat-question", "index": n_clicks},
+                         style={"margin": "10px", "width": "100%"}), width=10
+            )
+        ], **row_props)
+        new_history = html.Div(f"{message}",
+                               style={"margin": "10px", "width": "100%"})
+        return saved_response, new_history
+    saved_response = dbc.Row([
+        dbc.Col([html.Img(src=response_png, className='brand-logo')], width=1),
+        dbc.Col(
+            html.Div(dcc.Markdown(message),  # Empty response Div to be updated later.
+                     # id={"type": "chat-response", "index": n_clicks},
+                     style={"margin": "10px", "width": "100%"}), width=10
+        )
+
+    ], **row_props)
+    return saved_response, None
+
+
+def render_history_page(rows, highlight_id=None):
+    """Renders a page of (id, sender, message) rows into chat rows and sidebar questions."""
+    chat_history = []
+    history = []
+    for message_id, sender, message in rows:
+        saved_response, new_history = render_saved_message(sender, message, message_id, message_id == highlight_id)
+        chat_history.append(saved_response)
+        if new_history is not None:
+            history.append(new_history)
+    return chat_history, history
+
+
+def load_earlier_style(rows):
+    # A full page means there may be older messages left to load.
+    return {"display": "block"} if len(rows) >= CHAT_PAGE_SIZE else {"display": "none"}
 
 
 @app.callback(
     [Output("chat-container", "children"),
      Output("history-container", "children"),
-     Output("user-input", "value")
+     Output("user-input", "value"),
+     Output("chat-oldest-id", "data"),
+     Output("load-earlier-button", "style"),
      ],
     Input("send-button", "n_clicks"),
     Input("user-input", "n_submit"),
     Input('session-dropdown', 'value'),
+    Input("chat-jump-id", "data"),
     [State("user-input", "value"),
      State("chat-container", "children"),
      State("history-container", "children"),
+     State({"type": "chat-stream-id", "index": ALL}, "data"),
      ]
 )
-def add_question(n_clicks, n_clicks_submit, session_id, user_input, chat_history, history):
+def add_question(n_clicks, n_clicks_submit, session_id, jump_id, user_input, chat_history, history, stream_ids):
     # When the user clicks "Send", immediately append a new chat pair
     if n_clicks > 0 and user_input or n_clicks_submit is not None and user_input:
+        if not session_id:
+            # No session selected (e.g. right after deleting one): keep the question in the input box.
+            return dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update
         # Create a new chat pair with pattern-matching IDs using n_clicks as the unique index.
         #         new_pair =    [dbc.Row(f"You: {user_input}", id={"type": "chat-question", "index": n_clicks}, className='question-card-center'),
         # ]
@@ -464,14 +640,19 @@ def add_question(n_clicks, n_clicks_submit, session_id, user_input, chat_history
             dbc.Row([
                 dbc.Col([html.Img(src=response_png, className='brand-logo')], width=1),
                 dbc.Col(
-                    dcc.Loading(
+                    [dcc.Loading(
                         id={'type': 'chat-loading', 'index': n_clicks},
                         children=html.Div(id={'type': 'chat-response', 'index': n_clicks},
                                           style={"margin": "10px", "width": "100%"}
                                           ), type='circle',color="#3F51B5"
-                    )
+                    ),
                     # html.Div(id={'type': 'chat-response', 'index': n_clicks},
                     #          style={"marginBottom": "10px", "width": "100%"})
+                    html.Div(id={'type': 'chat-stream', 'index': n_clicks},
+                             style={"margin": "10px", "width": "100%"}),
+                    dcc.Store(id={'type': 'chat-stream-id', 'index': n_clicks}),
+                    dcc.Interval(id={'type': 'chat-stream-interval', 'index': n_clicks},
+                                 interval=STREAM_POLL_INTERVAL, disabled=True)]
 
                     , width=10
                 )
@@ -493,41 +674,109 @@ def add_question(n_clicks, n_clicks_submit, session_id, user_input, chat_history
             history = []
         history.append(new_history)
 
-        return patched_children, history, ""
+        return patched_children, history, "", dash.no_update, dash.no_update
     else:
+        # The page is replaced (session switched, created or deleted, or a search result opened), so nobody
+        # will poll the answers still streaming into it: stop them now rather than after STREAM_IDLE_TIMEOUT.
+        for stream_id in filter(None, stream_ids):
+            cancel_stream(stream_id)
+        # Only the newest page is sent to the browser; "Load earlier messages" fetches the rest.
+        if jump_id and "chat-jump-id.data" in ctx.triggered_prop_ids:
+            # Opened from a search result: show the matched message with some context on both sides.
+            rows = (get_chat_history(session_id, before_id=jump_id + 1, limit=CHAT_PAGE_SIZE // 2)
+                    + get_messages_after(session_id, jump_id, limit=CHAT_PAGE_SIZE))
+        else:
+            jump_id = None
+            rows = get_chat_history(session_id, limit=CHAT_PAGE_SIZE)
+        chat_history, history = render_history_page(rows, highlight_id=jump_id)
+        oldest_id = rows[0][0] if rows else None
+        return chat_history, history, "", oldest_id, load_earlier_style(rows)
 
-        rows = get_chat_history(session_id)
-        chat_history = []
-        history = []
-        for sender, message in rows:
-            if sender == 'user':
-                saved_response = dbc.Row([
-                    dbc.Col([html.Img(src=user_png, className='brand-logo')], width=1),
-                    dbc.Col(
-                        html.Div(f"You: {message}",
-                                 # id={"type": "chat-question", "index": n_clicks},
-                                 style={"margin": "10px", "width": "100%"}), width=10
-                    )
-                ])
-                chat_history.append(saved_response)
-                new_history = html.Div(f"{message}",
-                                       style={"margin": "10px", "width": "100%"})
-                history.append(new_history)
-            else:
-                saved_response = dbc.Row([
-                    dbc.Col([html.Img(src=response_png, className='brand-logo')], width=1),
-                    dbc.Col(
-                        html.Div(dcc.Markdown(message),  # Empty response Div to be updated later.
-                                 # id={"type": "chat-response", "index": n_clicks},
-                                 style={"margin": "10px", "width": "100%"}), width=10
-                    )
+    return dash.no_update, dash.no_update, dash.no_update, dash.no_update, dash.no_update
 
-                ])
-                chat_history.append(saved_response)
 
-        return chat_history, history, ""
+@app.callback(
+    Output("search-results", "children"),
+    Input("history-search", "value"),
+    prevent_initial_call=True
+)
+def search_history(query):
+    if not query or not query.strip():
+        return []
+    results = []
+    for message_id, session_id, session_name, sender, snippet in search_chat_history(query):
+        results.append(html.Div([
+            html.Small(session_name or session_id, style={"color": "gray"}),
+            dcc.Markdown(snippet, style={"margin": "0"}),
+        ], id={"type": "search-result", "index": message_id}, n_clicks=0,
+            style={"cursor": "pointer", "borderBottom": "1px solid lightgray", "padding": "5px"}))
+    return results or html.Div("No matches.", style={"color": "gray", "padding": "5px"})
+
+
+@app.callback(
+    Output("session-dropdown", "value", allow_duplicate=True),
+    Output("chat-jump-id", "data"),
+    Input({"type": "search-result", "index": ALL}, "n_clicks"),
+    prevent_initial_call=True
+)
+def jump_to_search_result(n_clicks):
+    if not ctx.triggered_id or not ctx.triggered[0]["value"]:
+        return dash.no_update, dash.no_update
+    message_id = ctx.triggered_id["index"]
+    session_id = get_message_session(message_id)
+    if session_id is None:
+        return dash.no_update, dash.no_update
+    return session_id, message_id
+
+
+app.clientside_callback(
+    """
+    function(jumpId) {
+        // Wait for add_question to render the page, then bring the matched message into view.
+        var tries = 0;
+        var scroll = function() {
+            var row = document.getElementById('message-' + jumpId);
+            if (row) {
+                row.scrollIntoView({block: 'center'});
+            } else if (tries++ < 30) {
+                setTimeout(scroll, 100);
+            }
+        };
+        if (jumpId) {
+            scroll();
+        }
+        return window.dash_clientside.no_update;
+    }
+    """,
+    Output("chat-scroll-anchor", "children"),
+    Input("chat-jump-id", "data"),
+    prevent_initial_call=True
+)
+
 
-    return dash.no_update, dash.no_update, dash.no_update
+@app.callback(
+    Output("chat-container", "children", allow_duplicate=True),
+    Output("history-container", "children", allow_duplicate=True),
+    Output("chat-oldest-id", "data", allow_duplicate=True),
+    Output("load-earlier-button", "style", allow_duplicate=True),
+    Input("load-earlier-button", "n_clicks"),
+    State("session-dropdown", "value"),
+    State("chat-oldest-id", "data"),
+    prevent_initial_call=True
+)
+def load_earlier_messages(n_clicks, session_id, oldest_id):
+    if not n_clicks or oldest_id is None:
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update
+    rows = get_chat_history(session_id, before_id=oldest_id, limit=CHAT_PAGE_SIZE)
+    chat_rows, history_rows = render_history_page(rows)
+    patched_chat = Patch()
+    patched_history = Patch()
+    for row in reversed(chat_rows):
+        patched_chat.prepend(row)
+    for row in reversed(history_rows):
+        patched_history.prepend(row)
+    oldest_id = rows[0][0] if rows else oldest_id
+    return patched_chat, patched_history, oldest_id, load_earlier_style(rows)
 
 
 # -------------------------------
@@ -535,9 +784,17 @@ def add_question(n_clicks, n_clicks_submit, session_id, user_input, chat_history
 # -------------------------------
 
 
+def is_repeated_question(messages):
+    """True when the user sent the same question again, i.e. asked for a new answer rather than a reused one."""
+    questions = [m["content"].strip() for m in messages if m["role"] == "user"]
+    return len(questions) >= 2 and questions[-1] == questions[-2]
+
+
 @app.callback(
     [Output({"type": "chat-response", "index": MATCH}, "children"),
-     Output({"type": "chat-loading", "index": MATCH}, "children")],
+     Output({"type": "chat-loading", "index": MATCH}, "children"),
+     Output({"type": "chat-stream-id", "index": MATCH}, "data"),
+     Output({"type": "chat-stream-interval", "index": MATCH}, "disabled")],
     Input({"type": "chat-response", "index": MATCH}, "children"),
     [State({"type": "chat-question", "index": MATCH}, "children"),
      State("model-options", "value"),
@@ -554,14 +811,163 @@ def update_pending_responses(event, question, model, session_id, model_type, api
             model_type = 'api'
         else:
             model_type = 'local'
-        context = get_conversation_context(session_id)
-        prompt = f"{context}\nUser: {question}\nAI:"
-        answer = get_ollama_response(prompt, model, model_type, api_url, access_token)
-        update_messages(session_id, answer, 'Ai')
+        # Every stage of the turn is timed into /metrics; slow turns land in the slow-request log.
+        trace = RequestTrace(mode=model_type)
+        # add_question has already stored the question, so it is normally the last message of the history.
+        with span("context_read_seconds", trace):
+            messages = get_conversation_messages(session_id)
+        with span("prompt_build_seconds", trace):
+            if not messages or messages[-1]["role"] != "user":
+                messages.append({"role": "user", "content": question.removeprefix("You: ")})
+            question_text = messages[-1]["content"]
+            # Answers grounded in a session's uploaded files are neither served from nor added to the
+            # semantic cache, so document contents cannot surface in other chats.
+            grounded = has_index(session_id)
+            # Asking the same question again is a retry: neither cache may hand back the answer being retried.
+            use_cache = not is_repeated_question(messages)
+            scope = cache_scope(session_id, model, model_type, api_url)
+            cached, embedding = (None, None) if grounded or not use_cache else semantic_lookup(question_text, scope)
+            # Passages from uploaded files go right before the question, leaving the cached prefix untouched.
+            passages = retrieval_message(session_id, question_text) if grounded and not cached else None
+            if passages:
+                messages.insert(len(messages) - 1, passages)
+
+        def after_turn():
+            # Every saved answer, generated or reused, grows the history that compaction folds away.
+            schedule_compaction(session_id, model, model_type, api_url, access_token)
+            trace.finish()
+
+        if cached:
+            with span("db_write_seconds", trace):
+                update_messages(session_id, cached, 'Ai')
+            after_turn()
+            updated_response = dcc.Markdown(f"**AI:** {cached}\n\n*Reused the answer to a similar earlier question.*",
+                                            style={'marginBottom': '20px'})
+            return "", updated_response, dash.no_update, dash.no_update
+        if STREAM_RESPONSES:
+            # Generate in the background; stream_pending_response polls the partial answer into the pane
+            # and the full answer is saved once when generation finishes.
+            def save_answer(answer, error):
+                # A cancelled or failed answer is kept as far as it got, but never reused for other questions.
+                if answer:
+                    with span("db_write_seconds", trace):
+                        answer_id = update_messages(session_id, answer, 'Ai')
+                    if not cancel_token.cancelled and error is None:
+                        semantic_remember(embedding, answer_id, scope)
+                after_turn()
+
+            cancel_token = CancellationToken()
+            chunks = stream_chat_response(messages, model, model_type, api_url, access_token, use_cache=use_cache,
+                                          cancel_token=cancel_token, stats=trace.generation)
+            stream_id = start_stream(chunks, on_complete=save_answer, cancel_token=cancel_token)
+            return "", dash.no_update, stream_id, False
+        answer = get_chat_response(messages, model, model_type, api_url, access_token, use_cache=use_cache,
+                                   stats=trace.generation)
+        # A failed generation is shown but not saved, so it never becomes part of the conversation context.
+        if not trace.generation.get("error"):
+            with span("db_write_seconds", trace):
+                answer_id = update_messages(session_id, answer, 'Ai')
+            semantic_remember(embedding, answer_id, scope)
+        after_turn()
         updated_response = dcc.Markdown(f"**AI:** {answer}", style={'marginBottom': '20px'})
-        return "", updated_response
+        return "", updated_response, dash.no_update, dash.no_update
     else:
-        return dash.no_update, dash.no_update
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update
+
+
+@app.callback(
+    Output({"type": "chat-stream", "index": MATCH}, "children"),
+    Output({"type": "chat-stream-interval", "index": MATCH}, "disabled", allow_duplicate=True),
+    Input({"type": "chat-stream-interval", "index": MATCH}, "n_intervals"),
+    State({"type": "chat-stream-id", "index": MATCH}, "data"),
+    prevent_initial_call=True
+)
+def stream_pending_response(n_intervals, stream_id):
+    state = read_stream(stream_id) if stream_id else None
+    if state is None:
+        return dash.no_update, True
+    text, done = state
+    if not text and not done:
+        # Nothing generated yet: keep a spinner up until the first token arrives.
+        return dbc.Spinner(size="sm", color="#3F51B5"), False
+    return dcc.Markdown(f"**AI:** {text}", style={'marginBottom': '20px'}), done
+
+
+@app.callback(
+    Output("file-output", "children"),
+    Output("ingest-document-id", "data"),
+    Output("ingest-progress-interval", "disabled"),
+    Output("upload-file", "contents"),
+    Input("upload-file", "contents"),
+    State("upload-file", "filename"),
+    State("session-dropdown", "value"),
+    prevent_initial_call=True
+)
+def ingest_upload(contents, filename, session_id):
+    if not contents:
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update
+    if not session_id:
+        return "Select a session before uploading a file.", dash.no_update, True, None
+    if not is_supported(filename):
+        return f"Error: {filename} is not a supported file type.", dash.no_update, True, None
+    # Decoding and chunking run in a background thread; show_ingest_progress polls how far it got.
+    # Clearing contents lets the same file be uploaded again.
+    document_id = start_ingestion(session_id, filename, contents)
+    return f"Reading {filename}...", document_id, False, None
+
+
+@app.callback(
+    Output("file-output", "children", allow_duplicate=True),
+    Output("ingest-progress-interval", "disabled", allow_duplicate=True),
+    Output("summarize-file", "style"),
+    Input("ingest-progress-interval", "n_intervals"),
+    State("ingest-document-id", "data"),
+    prevent_initial_call=True
+)
+def show_ingest_progress(n_intervals, document_id):
+    progress = ingest_progress(document_id) if document_id else None
+    if progress is None:
+        return dash.no_update, True, {"display": "none"}
+    status = progress["status"]
+    filename = progress["filename"]
+    if status == "ingesting":
+        total = progress.get("bytes_total") or 1
+        percent = min(100, 100 * progress.get("bytes_done", 0) // total)
+        return [html.Div(f"Reading {filename}: {progress.get('chunks', 0)} chunks"),
+                dbc.Progress(value=percent, label=f"{percent}%")], False, {"display": "none"}
+    if status == "indexing":
+        return (f"Indexing {filename}: {progress.get('indexed', 0)} of {progress.get('chunks', 0)} chunks...",
+                False, {"display": "none"})
+    if status == "summarizing":
+        return (f"Summarizing {filename}: {progress.get('summary_parts', 0)} parts done...", False,
+                {"display": "none"})
+    if status == "error":
+        return f"Error reading {filename}: {progress.get('error')}", True, {"display": "none"}
+    children = [html.Div(f"{filename}: {progress.get('chunks', 0)} chunks stored.")]
+    if progress.get("error"):
+        children.append(html.Div(progress["error"]))
+    if progress.get("summary"):
+        children.append(dcc.Markdown(f"**Summary of {filename}:** {progress['summary']}"))
+    return children, True, {"display": "block"}
+
+
+@app.callback(
+    Output("ingest-progress-interval", "disabled", allow_duplicate=True),
+    Input("summarize-file-btn", "n_clicks"),
+    [State("ingest-document-id", "data"),
+     State("model-options", "value"),
+     State("private-endpoint-switch", "value"),
+     State("private-endpoint-url-store", "data"),
+     State("access-token-store", "data")],
+    prevent_initial_call=True
+)
+def summarize_uploaded_file(n_clicks, document_id, model, model_type, api_url, access_token):
+    model_type = 'api' if model_type else 'local'
+    if not n_clicks or not document_id:
+        return dash.no_update
+    if not schedule_summary(document_id, model, model_type, api_url, access_token):
+        return dash.no_update
+    return False
 
 
 @app.callback(
@@ -571,51 +977,33 @@ def update_pending_responses(event, question, model, session_id, model_type, api
     State("private-endpoint-switch", "value"),
     State("private-endpoint-url-store", "data"),
     State("access-token-store", "data"),
+    State("session_name_update_flag", "data"),
 )
-def summarize_sessions(n_intervals, model, model_type, api_url, access_token):
-    # Connect to the database
+def summarize_sessions(n_intervals, model, model_type, api_url, access_token, last_version):
+    # Titles are generated by session_jobs' worker pool; this only queues sessions that changed and
+    # reports the rename counter so the dropdown refreshes once titles land.
     if n_intervals > 0:
         if model_type:
             model_type = 'api'
         else:
             model_type = 'local'
-        sessions = fetch_all()
-        updated_sessions = []
-
-        for session in sessions:
-            session_id, session_name = session
-            # Retrieve conversation context for this session.
-            context = get_conversation_context(session_name)
-            if context.strip():
-                # Build a prompt for summarization.
-                # You might want to limit the length of context if too long.
-                prompt = f"Summarize the following conversation in 10 words or less:\n{context}"
-                summary = get_ollama_response(prompt, model, model_type, api_url, access_token)
-                # If we get a valid summary, update the session name.
-                if summary and "Error" not in summary:
-                    if ':' in summary:
-                        summary = summary.split(':')[1]
-                    new_name = summary.strip()
-                    update_session_name(new_name, session_id)
-                    updated_sessions.append((session_id, new_name))
-
-        # For debugging, return a summary of updated sessions.
-        return f"Updated sessions: {updated_sessions}"
+        schedule_title_updates(model, model_type, api_url, access_token)
+        version = titles_version()
+        return version if version != last_version else dash.no_update
     else:
         return dash.no_update
 
 
 @app.callback(
-    Output('session-dropdown', 'options'),
-    Output('session-dropdown', 'value'),
+    Output('session-dropdown', 'options', allow_duplicate=True),
+    Output('session-dropdown', 'value', allow_duplicate=True),
     Input('new-session', 'n_clicks'),
     Input('delete-session-button', 'n_clicks'),
-    Input('url-path', 'pathname'),
     Input("session_name_update_flag", "data"),
-    State('session-dropdown', 'value')
-
+    State('session-dropdown', 'value'),
+    prevent_initial_call=True
 )
-def create_new_session(n_clicks_add, n_clicks_delete, pathname_url, flag, current_session):
+def create_new_session(n_clicks_add, n_clicks_delete, flag, current_session):
     changed_id = [ctx.triggered[0]['prop_id']]
     if 'new-session.n_clicks' in changed_id:
         rows = fetch_all()
@@ -626,26 +1014,64 @@ def create_new_session(n_clicks_add, n_clicks_delete, pathname_url, flag, curren
         # Retrieve all sessions from the DB
     elif 'delete-session-button.n_clicks' in changed_id:
         delete_session(current_session)
+        delete_index(current_session)
+        forget_session(current_session)
 
         rows = fetch_all()
         return [{'label': r[1], 'value': r[0]} for r in rows], ""
 
     else:
+        # Titles were renamed in the background: refresh labels but stay on the current session.
         rows = fetch_all()
-        if len(rows) < 1:
-            session_id = f"Session {1}"
-            rows.append((session_id, session_id))
-        return [{'label': r[1], 'value': r[0]} for r in rows], rows[0][0]
+        return [{'label': r[1], 'value': r[0]} for r in rows], dash.no_update
+
+
+def start_background_services():
+    """Per-process startup work; background jobs only run in the process that wins the lease."""
+    init_db()  # not at import time, so importing the app (wsgi, benchmarks, tools) does no I/O
+    install_shutdown_flush()  # queued write-behind writes reach SQLite on SIGTERM too, not only at exit
+    get_model_catalog()  # starts the first catalog refresh before the first page load
+    start_leader_election()
+    if is_background_leader():
+        preload_pinned_models()
 
 
-def run_dash():
+def run_dash(host="127.0.0.1", port=8919):
     # Start Dash (Flask) server; set use_reloader=False to prevent duplicate threads.
-    app.run_server(debug=False, use_reloader=False, port=8919)
+    app.run_server(debug=False, use_reloader=False, host=host, port=port)
+
+
+def run_headless(host, port, workers, threads):
+    """Serves the app without a window: through gunicorn when installed, else the Werkzeug server."""
+    gunicorn = shutil.which("gunicorn")
+    if gunicorn:
+        # Workers import wsgi.py; UNCOVER_WORKERS tells them the database and streams are shared.
+        os.environ["UNCOVER_WORKERS"] = str(workers)
+        os.execv(gunicorn, [gunicorn, "--workers", str(workers), "--threads", str(threads),
+                            "--worker-class", "gthread", "--bind", f"{host}:{port}", "wsgi:server"])
+    if workers > 1:
+        sys.exit("Error: --workers > 1 needs gunicorn (pip install gunicorn).")
+    print("gunicorn is not installed; serving with the Werkzeug development server.")
+    start_background_services()
+    run_dash(host, port)
 
 
 if __name__ == '__main__':
-    dash_thread = threading.Thread(target=run_dash)
-    dash_thread.daemon = True  # Allow program to exit even if thread is running.
-    dash_thread.start()
-    webview.create_window('Uncover-LLMs', 'http://127.0.0.1:8919')
-    webview.start()
+    parser = argparse.ArgumentParser(description="Uncover-LLMs chat app.")
+    parser.add_argument("--headless", action="store_true", help="serve only, without the desktop window")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8919)
+    parser.add_argument("--workers", type=int, default=1, help="server processes (headless, needs gunicorn)")
+    parser.add_argument("--threads", type=int, default=8, help="request threads per worker (headless)")
+    args = parser.parse_args()
+    if args.headless:
+        run_headless(args.host, args.port, args.workers, args.threads)
+    else:
+        import webview
+
+        start_background_services()
+        dash_thread = threading.Thread(target=run_dash, args=(args.host, args.port))
+        dash_thread.daemon = True  # Allow program to exit even if thread is running.
+        dash_thread.start()
+        webview.create_window('Uncover-LLMs', f'http://{args.host}:{args.port}')
+        webview.start()
@@ -0,0 +1,187 @@
+import bisect
+import collections
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# Bucket upper bounds (seconds, or tokens/sec for the rate histogram) of the Prometheus histograms.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+
+# Chat turns slower than SLOW_REQUEST_SECONDS end to end are kept, with their spans, in a rolling log of
+# the last SLOW_REQUEST_LOG_SIZE entries. Each is also logged on the "uncover.metrics" logger at
+# SLOW_REQUEST_LOG_LEVEL; the default (DEBUG) keeps them off the console unless logging is set up to show them.
+SLOW_REQUEST_SECONDS = 10.0
+SLOW_REQUEST_LOG_SIZE = 100
+SLOW_REQUEST_LOG_LEVEL = getattr(logging, os.environ.get("SLOW_REQUEST_LOG_LEVEL", "DEBUG").upper(), logging.DEBUG)
+
+METRICS = {
+    "context_read_seconds": ("Reading the conversation context from SQLite.", LATENCY_BUCKETS),
+    "prompt_build_seconds": ("Building the prompt: semantic cache lookup, retrieval and messages.", LATENCY_BUCKETS),
+    "queue_wait_seconds": ("Time a generation waited for a scheduler slot.", LATENCY_BUCKETS),
+    "time_to_first_token_seconds": ("Time from submitting a generation to its first chunk.", LATENCY_BUCKETS),
+    "generation_seconds": ("Total time of a generation, queue wait included.", LATENCY_BUCKETS),
+    "tokens_per_second": ("Streaming rate of a generation after its first chunk.", RATE_BUCKETS),
+    "db_write_seconds": ("Writing (or, with write-behind, queueing) a message with update_messages.",
+                         LATENCY_BUCKETS),
+    "turn_seconds": ("A chat turn from the question reaching the server to the answer being saved.",
+                     LATENCY_BUCKETS),
+}
+PREFIX = "uncover_"
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = collections.Counter()
+_collectors = []
+_slow_requests = collections.deque(maxlen=SLOW_REQUEST_LOG_SIZE)
+_log = logging.getLogger("uncover.metrics")
+
+
+class Histogram:
+    """Cumulative-bucket histogram; observe() is a bisect and three additions."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def observe(name, value, **labels):
+    """Records value in the histogram name (a key of METRICS) for the given labels."""
+    key = (name, _label_key(labels))
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram(METRICS[name][1])
+        histogram.observe(value)
+
+
+def increment(name, amount=1, **labels):
+    with _lock:
+        _counters[(name, _label_key(labels))] += amount
+
+
+@contextmanager
+def span(name, trace=None, **labels):
+    """Times the block into histogram name and, if a RequestTrace is given, into its spans."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        observe(name, elapsed, **labels)
+        if trace is not None:
+            trace.spans[name] = trace.spans.get(name, 0.0) + elapsed
+
+
+class RequestTrace:
+    """Spans of one chat turn. generation is passed to the engine as its stats dict."""
+
+    def __init__(self, **labels):
+        self.started = time.perf_counter()
+        self.wall_time = time.time()
+        self.labels = labels
+        self.spans = {}
+        self.generation = {}
+
+    def finish(self):
+        total = time.perf_counter() - self.started
+        observe("turn_seconds", total, **self.labels)
+        if total >= SLOW_REQUEST_SECONDS:
+            generation = {k: v for k, v in self.generation.items()
+                          if k in ("queue_wait", "time_to_first_token", "generation_seconds", "tokens_per_second",
+                                   "cancelled", "timed_out", "error")}
+            entry = {"time": self.wall_time, "seconds": total, **self.labels, "spans": dict(self.spans),
+                     "generation": generation}
+            with _lock:
+                _slow_requests.append(entry)
+            _log.log(SLOW_REQUEST_LOG_LEVEL, "Slow request: %.1fs %s", total, entry)
+        return total
+
+
+def record_generation(stats, mode, model):
+    """Records the timings the generation engine collected for one generation."""
+    labels = {"mode": mode, "model": model if mode == "local" else "private-endpoint"}
+    for name in ("queue_wait", "time_to_first_token"):
+        if name in stats:
+            observe(f"{name}_seconds", stats[name], **labels)
+    if "generation_seconds" in stats:
+        observe("generation_seconds", stats["generation_seconds"], **labels)
+    if stats.get("tokens_per_second"):
+        observe("tokens_per_second", stats["tokens_per_second"], **labels)
+    if stats.get("timed_out"):
+        outcome = "timed_out"
+    elif stats.get("cancelled"):
+        outcome = "cancelled"
+    else:
+        outcome = "failed" if stats.get("error") else "completed"
+    increment("generations_total", outcome=outcome, **labels)
+
+
+def register_collector(collect):
+    """
+    Adds a function called on every scrape that returns [(name, type, help, [(labels, value), ...])],
+    for values owned by other modules (scheduler queues, cache counters).
+    """
+    _collectors.append(collect)
+
+
+def slow_requests():
+    with _lock:
+        return list(_slow_requests)
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def render_prometheus():
+    """All metrics in the Prometheus text exposition format."""
+    with _lock:
+        histograms = [(name, labels, list(h.counts), h.sum, h.count, h.buckets)
+                      for (name, labels), h in _histograms.items()]
+        counters = list(_counters.items())
+    lines = []
+    for metric in METRICS:
+        series = [h for h in histograms if h[0] == metric]
+        if not series:
+            continue
+        lines += [f"# HELP {PREFIX}{metric} {METRICS[metric][0]}", f"# TYPE {PREFIX}{metric} histogram"]
+        for _, labels, counts, total, count, buckets in series:
+            cumulative = 0
+            for bound, bucket_count in zip(list(buckets) + ["+Inf"], counts):
+                cumulative += bucket_count
+                lines.append(f"{PREFIX}{metric}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{PREFIX}{metric}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{PREFIX}{metric}_count{_format_labels(labels)} {count}")
+    for metric in sorted({name for (name, _), _ in counters}):
+        lines.append(f"# TYPE {PREFIX}{metric} counter")
+        lines += [f"{PREFIX}{metric}{_format_labels(labels)} {value}"
+                  for (name, labels), value in counters if name == metric]
+    for collect in _collectors:
+        try:
+            collected = collect()
+        except Exception as e:
+            print(f"Error collecting metrics: {e}")
+            continue
+        for name, kind, help_text, samples in collected:
+            lines += [f"# HELP {PREFIX}{name} {help_text}", f"# TYPE {PREFIX}{name} {kind}"]
+            lines += [f"{PREFIX}{name}{_format_labels(_label_key(labels))} {value}" for labels, value in samples]
+    return "\n".join(lines) + "\n"
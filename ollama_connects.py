@@ -1,37 +1,285 @@
-from os import access
+import hashlib
+import importlib.util
+import json
+import os
+import re
+import threading
+import time
 
-import ollama
+import httpx
 
-def list_available_models():
-    """Lists all models currently installed on the local Ollama instance."""
-    try:
-        models = ollama.list()
-        return [n.model for n in models.models]
-    except Exception as e:
-        return f"Error listing models: {e}"
+from backend_settings import (DEFAULT_KEEP_ALIVE, ENDPOINT_CONNECT_TIMEOUT, ENDPOINT_HTTP2,
+                              ENDPOINT_MAX_CONNECTIONS, ENDPOINT_MAX_RETRIES, ENDPOINT_READ_TIMEOUT,
+                              ENDPOINT_RETRY_BACKOFF, OLLAMA_HOST, should_retry)
+from generation_engine import GenerationError
+import generation_engine
+from sql_connects import (MULTI_PROCESS, evict_response_cache, get_cached_response, put_cached_response,
+                          read_shared_state, save_shared_state)
+
+
+# Models warmed up when the app starts and kept loaded indefinitely, e.g. PINNED_MODELS="llama3:8b,qwen2.5:14b".
+PINNED_MODELS = [m.strip() for m in os.environ.get("PINNED_MODELS", "").split(",") if m.strip()]
+PINNED_KEEP_ALIVE = -1
+
+# model -> (status, expires): a "loaded" model counts as unloaded again once its keep_alive has passed
+# (expires is a time.time() deadline, None for models kept loaded forever). With several server
+# processes (sql_connects.MULTI_PROCESS) statuses are also kept in SQLite, where all of them read them.
+_model_status = {}
+_model_status_lock = threading.Lock()
+
+# Opt-in response cache: identical requests (same mode, model, endpoint, prompt and options) are answered
+# from SQLite. Pass use_cache=False to get_ollama_response/stream_ollama_response to bypass it, e.g. when
+# the user asks again. Only answers that finished cleanly (not cancelled, timed out or failed) are stored.
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE", "").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_MAX_ENTRIES = 5000
+RESPONSE_CACHE_MAX_AGE = 7 * 24 * 3600  # seconds
+RESPONSE_CACHE_EVICT_EVERY = 100  # writes between eviction sweeps
+
+response_cache_stats = {"hits": 0, "misses": 0, "writes": 0}
+
+# Embeddings for document retrieval come from a local Ollama embedding model, EMBED_BATCH texts per request.
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "nomic-embed-text")
+EMBED_BATCH = 64
+
+# Private endpoint timeouts, pool size and retries are in backend_settings.
+_endpoint_client = None
+
+# Installed model list, served from memory and refreshed in the background once older than MODEL_CATALOG_TTL.
+MODEL_CATALOG_TTL = 60  # seconds
+
+_model_catalog = {"models": [], "fetched": None, "error": None}
+_catalog_refreshing = False
+_catalog_loaded = threading.Event()
+_catalog_lock = threading.Lock()
+
+_client = None
+_client_lock = threading.Lock()
+_cache_lock = threading.Lock()
+
+
+def get_client():
+    """Returns the shared Ollama HTTP client, creating it on first use so connections are reused."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                import ollama  # deferred: the package (and pydantic) take a large share of startup
+                _client = ollama.Client(host=OLLAMA_HOST)
+    return _client
+
+
+def get_endpoint_client():
+    """Returns the shared httpx client for private endpoints, creating it on first use."""
+    global _endpoint_client
+    if _endpoint_client is None:
+        with _client_lock:
+            if _endpoint_client is None:
+                _endpoint_client = httpx.Client(
+                    http2=ENDPOINT_HTTP2 and importlib.util.find_spec("h2") is not None,
+                    timeout=httpx.Timeout(ENDPOINT_READ_TIMEOUT, connect=ENDPOINT_CONNECT_TIMEOUT),
+                    limits=httpx.Limits(max_connections=ENDPOINT_MAX_CONNECTIONS,
+                                        max_keepalive_connections=ENDPOINT_MAX_CONNECTIONS),
+                )
+    return _endpoint_client
+
+
+def endpoint_request(method, url, **kwargs):
+    """Sends a request through the pooled client, retrying with exponential backoff on transient failures."""
+    client = get_endpoint_client()
+    for attempt in range(ENDPOINT_MAX_RETRIES + 1):
+        last = attempt == ENDPOINT_MAX_RETRIES
+        try:
+            response = client.request(method, url, **kwargs)
+        except httpx.TransportError as e:
+            if last or not should_retry(method, error=e):
+                raise
+        else:
+            if last or not should_retry(method, status_code=response.status_code):
+                return response
+        time.sleep(ENDPOINT_RETRY_BACKOFF * 2 ** attempt)
 
-def download_model(model_name):
-    """Downloads a specified model if it is available in Ollama's library."""
+
+def refresh_model_catalog():
+    """Fetches the installed models with their metadata from Ollama and caches them."""
+    global _catalog_refreshing
     try:
-        ollama.pull(model_name)
-        return f"Model '{model_name}' downloaded successfully."
+        models = []
+        for m in get_client().list().models:
+            details = m.details
+            models.append({
+                "name": m.model,
+                "size": m.size or 0,
+                "family": details.family if details else None,
+                "parameter_size": details.parameter_size if details else None,
+                "quantization": details.quantization_level if details else None,
+                "modified_at": m.modified_at.isoformat() if m.modified_at else None,
+            })
+        with _catalog_lock:
+            _model_catalog.update(models=models, error=None)
     except Exception as e:
-        return f"Error downloading model '{model_name}': {e}"
+        # Keep serving the last good list; the error is reported alongside it.
+        with _catalog_lock:
+            _model_catalog["error"] = f"Error listing models: {e}"
+    finally:
+        with _catalog_lock:
+            _model_catalog["fetched"] = time.monotonic()
+            _catalog_refreshing = False
+        _catalog_loaded.set()
+
+
+def _refresh_model_catalog_async():
+    global _catalog_refreshing
+    with _catalog_lock:
+        if _catalog_refreshing:
+            return
+        _catalog_refreshing = True
+    threading.Thread(target=refresh_model_catalog, name="model-catalog", daemon=True).start()
+
+
+def get_model_catalog():
+    """
+    Returns the cached list of installed models (dicts with name, size, family, parameter_size,
+    quantization, modified_at). It never waits on the daemon: a stale list is returned as is and
+    refreshed in the background, and before the first refresh has finished the list is empty
+    (see model_catalog_loaded).
+    """
+    with _catalog_lock:
+        fetched = _model_catalog["fetched"]
+    if fetched is None or time.monotonic() - fetched > MODEL_CATALOG_TTL:
+        _refresh_model_catalog_async()
+    with _catalog_lock:
+        return list(_model_catalog["models"])
+
+
+def model_catalog_loaded():
+    """True once the first catalog refresh has finished (successfully or not)."""
+    return _catalog_loaded.is_set()
 
-def delete_model(model_name):
-    """Deletes a specified model from the local Ollama instance."""
+
+def keep_alive_for(model, keep_alive=None):
+    """The keep_alive to send for a model: the explicit value, forever for pinned models, else the default."""
+    if keep_alive is not None:
+        return keep_alive
+    return PINNED_KEEP_ALIVE if model in PINNED_MODELS else DEFAULT_KEEP_ALIVE
+
+
+def keep_alive_seconds(keep_alive):
+    """Seconds Ollama keeps a model loaded for a keep_alive value (a number or "30s", "10m", "1h30m");
+    None means forever."""
+    if isinstance(keep_alive, (int, float)):
+        return None if keep_alive < 0 else float(keep_alive)
+    text = str(keep_alive).strip()
+    if text.startswith("-"):
+        return None
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)?", text)
+    units = {"ms": 0.001, "s": 1, "": 1, "m": 60, "h": 3600}
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def _set_model_status(model, status, keep_alive=None):
+    expires = None
+    if status == "loaded":
+        seconds = keep_alive_seconds(keep_alive)
+        expires = None if seconds is None else time.time() + seconds
+    with _model_status_lock:
+        _model_status[model] = (status, expires)
+    if MULTI_PROCESS:
+        save_shared_state(f"model-status:{model}", [status, expires])
+
+
+def _load_model(model, keep_alive):
     try:
-        ollama.delete(model_name)
-        return f"Model '{model_name}' deleted successfully."
+        # An empty prompt makes Ollama load the weights without generating anything.
+        get_client().generate(model=model, prompt="", keep_alive=keep_alive)
+        _set_model_status(model, "loaded", keep_alive)
     except Exception as e:
-        return f"Error deleting model '{model_name}': {e}"
+        _set_model_status(model, f"failed: {e}")
+
+
+def preload_model(model, keep_alive=None):
+    """Starts loading a model into memory in the background so its first answer skips the cold start."""
+    if not model:
+        return
+    with _model_status_lock:
+        if _model_status.get(model, (None,))[0] == "loading":
+            return
+        _model_status[model] = ("loading", None)
+    if MULTI_PROCESS:
+        save_shared_state(f"model-status:{model}", ["loading", None])
+    threading.Thread(target=_load_model, args=(model, keep_alive_for(model, keep_alive)),
+                     name="model-preload", daemon=True).start()
 
 
-import subprocess
-import requests
+def preload_pinned_models():
+    for model in PINNED_MODELS:
+        preload_model(model)
 
 
-def get_ollama_response(prompt, model, mode="local", api_url=None, access_token=None):
+def model_load_status(model):
+    """
+    "loading", "loaded", "failed: ..." or "not loaded" for models never loaded by the app, or whose
+    keep_alive has run out since they last answered.
+    """
+    if MULTI_PROCESS:
+        status, expires = read_shared_state(f"model-status:{model}", ["not loaded", None])
+    else:
+        with _model_status_lock:
+            status, expires = _model_status.get(model, ("not loaded", None))
+    if status == "loaded" and expires is not None and time.time() > expires:
+        return "not loaded"
+    return status
+
+
+def embed_texts(texts, model=None):
+    """Returns one embedding (list of floats) per text, sending EMBED_BATCH texts per Ollama request."""
+    model = model or EMBEDDING_MODEL
+    embeddings = []
+    for start in range(0, len(texts), EMBED_BATCH):
+        response = get_client().embed(model=model, input=texts[start:start + EMBED_BATCH],
+                                      keep_alive=keep_alive_for(model))
+        embeddings.extend(response.embeddings)
+    return embeddings
+
+
+def build_options(num_ctx=None, temperature=None):
+    """Builds the Ollama `options` payload, leaving out anything not set so model defaults apply."""
+    options = {}
+    if num_ctx is not None:
+        options["num_ctx"] = int(num_ctx)
+    if temperature is not None:
+        options["temperature"] = float(temperature)
+    return options
+
+
+def response_cache_key(prompt, model, mode, api_url=None, options=None, messages=None):
+    """Hashes everything that determines a response; whitespace differences in the prompt are ignored."""
+    normalized = "\n".join(line.rstrip() for line in prompt.strip().splitlines())
+    key = json.dumps([mode, model, api_url if mode == "api" else None, options or {}, normalized, messages],
+                     sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def _cache_lookup(cache_key):
+    response = get_cached_response(cache_key, RESPONSE_CACHE_MAX_AGE)
+    with _cache_lock:
+        response_cache_stats["hits" if response is not None else "misses"] += 1
+    return response
+
+
+def _cache_store(cache_key, response):
+    if not response:
+        return
+    put_cached_response(cache_key, response)
+    with _cache_lock:
+        response_cache_stats["writes"] += 1
+        evict = response_cache_stats["writes"] % RESPONSE_CACHE_EVICT_EVERY == 0
+    if evict:
+        evict_response_cache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_AGE)
+
+
+def get_ollama_response(prompt, model, mode="local", api_url=None, access_token=None,
+                        num_ctx=None, temperature=None, keep_alive=None, use_cache=True,
+                        cancel_token=None, timeout=None, priority="interactive", messages=None):
     """
     Retrieve a response either by calling the local LLM (using ollama) or by sending a request to a remote API.
 
@@ -41,41 +289,109 @@ def get_ollama_response(prompt, model, mode="local", api_url=None, access_token=
         mode (str): "local" to call the local LLM; "api" to call a remote API endpoint.
         api_url (str): The URL of the remote API endpoint. Required if mode is "api".
         access_token (str): Optional. If provided, will be sent as a Bearer token in the Authorization header for the API.
+        num_ctx (int): Optional. Context window size for local generation.
+        temperature (float): Optional. Sampling temperature for local generation.
+        keep_alive (str): How long the local server keeps the model loaded after the request (see keep_alive_for).
+        use_cache (bool): False skips the response cache lookup for this request (the fresh answer is still stored).
+        cancel_token (generation_engine.CancellationToken): Optional. Cancelling it stops the generation.
+        timeout (float): Optional. Seconds before the generation is abandoned (generation_engine.GENERATION_TIMEOUT).
+        priority (str): "interactive" or "background"; decides queue order in generation_scheduler.
+        messages (list): Optional. Role-tagged chat messages; see get_chat_response.
 
     Returns:
         str: The response from the model, or an error message.
     """
-    if mode == "local":
-        try:
-            result = subprocess.run(
-                ['ollama', 'run', model],
-                input=prompt,
-                capture_output=True,
-                text=True,
-                check=True
-            )
-            return result.stdout.strip()
-        except Exception as e:
-            return f"Error: {str(e)}"
-
-    elif mode == "api":
-        if not api_url:
-            return "Error: API URL must be provided in API mode."
-        headers = {}
-        if access_token:
-            access_token = access_token
-            headers["Authorization"] = f"Bearer {access_token}"
-        try:
-            payload = {"prompt": prompt}
-            response = requests.post(api_url, json=payload, headers=headers)
-            if response.status_code == 200:
-                return response.json().get("result", "").strip()
-            else:
-                return f"Error: API returned status code {response.status_code} with message: {response.text}"
-        except Exception as e:
-            return f"Error: {str(e)}"
+    return _join_response(stream_ollama_response(prompt, model, mode, api_url, access_token, num_ctx, temperature,
+                                                 keep_alive, use_cache, cancel_token, timeout, priority,
+                                                 messages))
+
 
+def _join_response(chunks):
+    """The whole answer from a response stream, or "Error: ..." if the generation failed."""
+    try:
+        return "".join(chunks).strip()
+    except GenerationError as e:
+        return f"Error: {e}"
+
+
+def stream_ollama_response(prompt, model, mode="local", api_url=None, access_token=None,
+                           num_ctx=None, temperature=None, keep_alive=None, use_cache=True,
+                           cancel_token=None, timeout=None, priority="interactive", messages=None,
+                           stats=None):
+    """
+    Same as get_ollama_response, but yields the answer in chunks; cached answers come as one chunk.
+    If stats is a dict, the generation's timings and token counts are added to it (see generation_engine).
+    A failed generation raises generation_engine.GenerationError after the chunks it produced, with the
+    message also in stats["error"]; only answers that finished cleanly are stored in the response cache.
+    """
+    if stats is None:
+        stats = {}
+    cache_key = None
+    if RESPONSE_CACHE_ENABLED:
+        cache_key = response_cache_key(prompt, model, mode, api_url, build_options(num_ctx, temperature), messages)
+        if use_cache:
+            cached = _cache_lookup(cache_key)
+            if cached is not None:
+                yield cached
+                return
+    chunks = []
+    try:
+        for chunk in _stream_response(prompt, model, mode, api_url, access_token, num_ctx, temperature,
+                                      keep_alive, cancel_token, timeout, priority, messages, stats):
+            chunks.append(chunk)
+            yield chunk
+    except GenerationError as e:
+        stats["error"] = str(e)
+        raise
+    cancelled = stats.get("cancelled") or cancel_token is not None and cancel_token.cancelled
+    if cache_key is not None and not (cancelled or stats.get("timed_out") or stats.get("error")):
+        _cache_store(cache_key, "".join(chunks).strip())
+
+
+def _stream_response(prompt, model, mode="local", api_url=None, access_token=None,
+                     num_ctx=None, temperature=None, keep_alive=None, cancel_token=None, timeout=None,
+                     priority="interactive", messages=None, stats=None):
+    """
+    Calls the model through generation_engine without consulting the response cache. Identical
+    requests already in flight share one generation, and generation_scheduler limits concurrency.
+
+    Private endpoints are asked for a streamed answer with `"stream": true`; endpoints that ignore
+    the flag and return a single JSON body are yielded as one chunk. Errors raise GenerationError.
+    """
+    if mode == "api" and not api_url:
+        raise GenerationError("API URL must be provided in API mode.")
+    elif mode in ("local", "api"):
+        keep_alive = keep_alive_for(model, keep_alive)
+        yield from generation_engine.stream(prompt, model, mode, api_url, access_token,
+                                            options=build_options(num_ctx, temperature),
+                                            keep_alive=keep_alive, token=cancel_token, timeout=timeout,
+                                            stats=stats, priority=priority, messages=messages)
+        if mode == "local":
+            _set_model_status(model, "loaded", keep_alive)  # each answer restarts the keep_alive timer
     else:
-        return "Error: Invalid mode specified. Use 'local' or 'api'."
+        raise GenerationError("Invalid mode specified. Use 'local' or 'api'.")
+
+
+def messages_to_prompt(messages):
+    """Flattens chat messages into the "User: ... / AI: ..." prompt used by the plain completion path."""
+    labels = {"system": "System", "user": "User", "assistant": "AI"}
+    lines = [f"{labels.get(m['role'], m['role'])}: {m['content']}\n" for m in messages]
+    return "".join(lines) + "AI:"
+
+
+def stream_chat_response(messages, model, mode="local", api_url=None, access_token=None, **kwargs):
+    """
+    Yields the answer to a role-tagged conversation ([{"role": "system"|"user"|"assistant", "content": ...}]).
+
+    Local models get the messages through Ollama's chat endpoint, which keeps the KV cache of an unchanged
+    message prefix between turns, so prefill cost follows the new turn rather than the whole history.
+    Private endpoints receive both the messages and the flattened prompt. Other keyword arguments are
+    those of stream_ollama_response.
+    """
+    yield from stream_ollama_response(messages_to_prompt(messages), model, mode, api_url, access_token,
+                                      messages=messages, **kwargs)
 
 
+def get_chat_response(messages, model, mode="local", api_url=None, access_token=None, **kwargs):
+    """Blocking version of stream_chat_response."""
+    return _join_response(stream_chat_response(messages, model, mode, api_url, access_token, **kwargs))
@@ -0,0 +1,145 @@
+import threading
+import time
+import uuid
+
+from sql_connects import (MULTI_PROCESS, cancel_shared_stream, prune_shared_streams, read_shared_stream,
+                          save_shared_stream, shared_stream_states)
+
+
+# Finished streams nobody polled (tab closed mid-answer) are dropped after this many seconds.
+STREAM_RETENTION = 600
+# Streams still generating but not polled for this long (the user left the chat) are cancelled.
+STREAM_IDLE_TIMEOUT = 15
+# With several server processes the next poll may reach another process, so the text is also published
+# to SQLite at most every STREAM_SYNC_INTERVAL seconds (see sql_connects.MULTI_PROCESS).
+STREAM_SYNC_INTERVAL = 0.25
+
+
+class ResponseStream:
+    """Text accumulated so far for one answer being generated in the background."""
+
+    def __init__(self, cancel_token=None):
+        self.chunks = []
+        self.error = None
+        self.done = False
+        self.cancel_token = cancel_token
+        self.last_read = time.monotonic()
+
+    def text(self):
+        return "".join(self.chunks)
+
+    def display(self):
+        """The text so far, followed by the error if generation failed; the error is not part of the answer."""
+        if self.error is None:
+            return self.text()
+        return f"{self.text()}\n\nError: {self.error}".lstrip()
+
+
+_streams = {}
+_streams_lock = threading.Lock()
+_watcher = None
+
+
+def _run_stream(stream_id, stream, chunks, on_complete):
+    synced = time.monotonic()
+    try:
+        try:
+            for chunk in chunks:
+                stream.chunks.append(chunk)
+                if MULTI_PROCESS and time.monotonic() - synced >= STREAM_SYNC_INTERVAL:
+                    save_shared_stream(stream_id, stream.display())
+                    synced = time.monotonic()
+        except Exception as e:
+            stream.error = str(e)
+        # The answer is saved before the stream reports done, so a question sent as soon as the client
+        # sees done already finds it in the conversation context.
+        if on_complete is not None:
+            try:
+                on_complete(stream.text().strip(), stream.error)
+            except Exception as e:
+                print(f"Error completing response stream: {e}")
+    finally:
+        if MULTI_PROCESS:
+            try:
+                save_shared_stream(stream_id, stream.display(), done=True)
+            except Exception as e:
+                print(f"Error publishing response stream: {e}")
+        stream.done = True
+
+
+def _prune_streams():
+    now = time.monotonic()
+    with _streams_lock:
+        streams = list(_streams.items())
+    # Polls (and cancel requests) answered by other processes are only visible in the shared table.
+    shared = {}
+    if MULTI_PROCESS:
+        prune_shared_streams(STREAM_RETENTION)
+        shared = shared_stream_states([stream_id for stream_id, stream in streams if not stream.done])
+    with _streams_lock:
+        for stream_id, stream in streams:
+            if stream.done and stream.last_read < now - STREAM_RETENTION:
+                _streams.pop(stream_id, None)
+            elif not stream.done and stream.cancel_token is not None:
+                idle = now - stream.last_read
+                last_read, cancelled = shared.get(stream_id, (None, False))
+                if last_read is not None:
+                    idle = min(idle, time.time() - last_read)
+                if cancelled or idle > STREAM_IDLE_TIMEOUT:
+                    stream.cancel_token.cancel()
+
+
+def _watch_streams():
+    while True:
+        time.sleep(STREAM_IDLE_TIMEOUT / 3)
+        try:
+            _prune_streams()
+        except Exception as e:
+            print(f"Error pruning response streams: {e}")
+
+
+def start_stream(chunks, on_complete=None, cancel_token=None):
+    """
+    Consumes an iterator of text chunks on a background thread and returns an id to poll it with.
+
+    on_complete(text, error) is called once with the answer when the iterator is exhausted; error is None
+    unless the iterator raised, in which case text is what came before the failure. If
+    cancel_token is given, the stream is cancelled when nobody has polled it for STREAM_IDLE_TIMEOUT.
+    """
+    global _watcher
+    stream_id = uuid.uuid4().hex
+    stream = ResponseStream(cancel_token)
+    if MULTI_PROCESS:
+        save_shared_stream(stream_id, "")  # so a poll landing on another process finds it right away
+    with _streams_lock:
+        _streams[stream_id] = stream
+        if _watcher is None:
+            _watcher = threading.Thread(target=_watch_streams, name="response-streams", daemon=True)
+            _watcher.start()
+    threading.Thread(target=_run_stream, args=(stream_id, stream, chunks, on_complete), daemon=True).start()
+    return stream_id
+
+
+def cancel_stream(stream_id):
+    """Stops the generation behind a stream, if it is still running and cancellable."""
+    with _streams_lock:
+        stream = _streams.get(stream_id)
+    if stream is not None and stream.cancel_token is not None:
+        stream.cancel_token.cancel()
+    elif stream is None and MULTI_PROCESS:
+        cancel_shared_stream(stream_id)  # the owning process cancels it on its next sweep
+
+
+def read_stream(stream_id):
+    """Returns (text_so_far, done) for a stream, or None if it is unknown. Finished streams are forgotten once read."""
+    with _streams_lock:
+        stream = _streams.get(stream_id)
+        if stream is not None:
+            stream.last_read = time.monotonic()
+            done = stream.done
+            if done:
+                del _streams[stream_id]
+    if stream is None:
+        # Started by another server process: read what it published.
+        return read_shared_stream(stream_id) if MULTI_PROCESS else None
+    return stream.display(), done
@@ -0,0 +1,233 @@
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows; the desktop app runs as a single process there
+    fcntl = None
+
+from ollama_connects import EMBED_BATCH, embed_texts
+from sql_connects import estimate_tokens, get_chunks_by_id, iter_document_chunks
+
+
+# Each collection (one per session) is a pair of append-only files in VECTOR_INDEX_DIR: a contiguous
+# float32 matrix of unit-length embeddings, memory-mapped for search, and the int64 chunk id of each row.
+VECTOR_INDEX_DIR = os.environ.get("VECTOR_INDEX_DIR", "vector_index")
+
+# Passages added to a prompt: the RETRIEVAL_TOP_K most similar chunks scoring at least RETRIEVAL_MIN_SCORE
+# (cosine similarity), cut off at RETRIEVAL_TOKEN_BUDGET tokens.
+RETRIEVAL_TOP_K = 4
+RETRIEVAL_MIN_SCORE = 0.35
+RETRIEVAL_TOKEN_BUDGET = 1500
+
+RETRIEVAL_PROMPT = """Excerpts from documents uploaded to this conversation. Use them when they are relevant to the question and say so when they do not contain the answer.
+
+{passages}"""
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+_np = None
+_np_lock = threading.Lock()
+
+
+def _numpy():
+    """The numpy module, imported on first use rather than when the app starts."""
+    global _np
+    if _np is None:
+        with _np_lock:
+            if _np is None:
+                import numpy
+                _np = numpy
+    return _np
+
+
+def _normalize(vectors):
+    np = _numpy()
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+@contextmanager
+def _file_lock(path):
+    """Serialises appends to an index between server processes."""
+    if fcntl is None:
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class VectorIndex:
+    """Append-only on-disk matrix of unit vectors with an id per row, searched by cosine similarity."""
+
+    def __init__(self, name):
+        self.path = os.path.join(VECTOR_INDEX_DIR, name)
+        self.lock = threading.Lock()
+        self._matrix = None
+        self._ids = None
+        self._count = 0
+
+    def _read_meta(self):
+        try:
+            with open(self.path + ".json") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_meta(self, meta):
+        # The row count is published last and atomically, so readers never map a half-written row.
+        with open(self.path + ".json.tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(self.path + ".json.tmp", self.path + ".json")
+
+    def add(self, ids, vectors):
+        np = _numpy()
+        vectors = _normalize(vectors)
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(ids):
+            return
+        os.makedirs(VECTOR_INDEX_DIR, exist_ok=True)
+        with self.lock, _file_lock(self.path + ".lock"):
+            meta = self._read_meta() or {"dim": vectors.shape[1], "count": 0}
+            if meta["dim"] != vectors.shape[1]:
+                raise ValueError(f"embedding size changed from {meta['dim']} to {vectors.shape[1]}; "
+                                 f"delete {self.path}.* to rebuild the index")
+            for suffix, rows, itemsize in ((".f32", vectors, 4 * meta["dim"]), (".ids", ids, 8)):
+                with open(self.path + suffix, "ab") as f:
+                    f.truncate(meta["count"] * itemsize)  # drop rows of an interrupted append
+                    f.write(rows.tobytes())
+            meta["count"] += len(ids)
+            self._write_meta(meta)
+
+    def _load(self):
+        np = _numpy()
+        meta = self._read_meta()
+        if meta is None or meta["count"] == 0:
+            return None, None
+        if meta["count"] != self._count:
+            self._matrix = np.memmap(self.path + ".f32", dtype=np.float32, mode="r",
+                                     shape=(meta["count"], meta["dim"]))
+            self._ids = np.fromfile(self.path + ".ids", dtype=np.int64, count=meta["count"])
+            self._count = meta["count"]
+        return self._matrix, self._ids
+
+    def __len__(self):
+        with self.lock:
+            matrix, _ = self._load()
+        return 0 if matrix is None else len(matrix)
+
+    def search(self, vector, k):
+        """Returns up to k (id, score) pairs, best first."""
+        np = _numpy()
+        with self.lock:
+            matrix, ids = self._load()
+        if matrix is None:
+            return []
+        scores = matrix @ _normalize(vector)
+        if k < len(scores):
+            top = np.argpartition(scores, -k)[-k:]
+            top = top[np.argsort(scores[top])[::-1]]
+        else:
+            top = np.argsort(scores)[::-1]
+        return [(int(ids[i]), float(scores[i])) for i in top]
+
+
+def _collection_name(session_id):
+    return "session-" + hashlib.sha1(str(session_id).encode("utf-8")).hexdigest()[:16]
+
+
+def get_index(session_id):
+    name = _collection_name(session_id)
+    with _indexes_lock:
+        if name not in _indexes:
+            _indexes[name] = VectorIndex(name)
+        return _indexes[name]
+
+
+def has_index(session_id):
+    return os.path.exists(os.path.join(VECTOR_INDEX_DIR, _collection_name(session_id) + ".json"))
+
+
+def remove_index_files(prefix):
+    """Deletes the files of every collection whose name starts with prefix."""
+    try:
+        filenames = os.listdir(VECTOR_INDEX_DIR)
+    except FileNotFoundError:
+        return
+    for filename in filenames:
+        if filename.startswith(prefix):
+            try:
+                os.remove(os.path.join(VECTOR_INDEX_DIR, filename))
+            except FileNotFoundError:
+                pass
+
+
+def delete_index(session_id):
+    """Removes a session's vectors, e.g. when the session is deleted (session names get reused)."""
+    name = _collection_name(session_id)
+    with _indexes_lock:
+        _indexes.pop(name, None)
+    remove_index_files(name + ".")
+
+
+def index_document(session_id, document_id, on_progress=None):
+    """Embeds every chunk of a stored document into its session's index. Returns the number of chunks."""
+    index = get_index(session_id)
+    done = 0
+    batch = []
+    for chunk_id, _, content, _ in iter_document_chunks(document_id, batch_size=EMBED_BATCH):
+        batch.append((chunk_id, content))
+        if len(batch) >= EMBED_BATCH:
+            index.add([i for i, _ in batch], embed_texts([c for _, c in batch]))
+            done += len(batch)
+            batch = []
+            if on_progress:
+                on_progress(done)
+    if batch:
+        index.add([i for i, _ in batch], embed_texts([c for _, c in batch]))
+        done += len(batch)
+        if on_progress:
+            on_progress(done)
+    return done
+
+
+def retrieve_passages(session_id, query, top_k=None, token_budget=None):
+    """Returns [(score, filename, content)] of the uploaded passages most similar to query."""
+    if not query or not has_index(session_id):
+        return []
+    try:
+        vector = embed_texts([query])[0]
+    except Exception as e:
+        print(f"Error embedding query: {e}")
+        return []
+    hits = [(chunk_id, score) for chunk_id, score in get_index(session_id).search(vector, top_k or RETRIEVAL_TOP_K)
+            if score >= RETRIEVAL_MIN_SCORE]
+    chunks = get_chunks_by_id([chunk_id for chunk_id, _ in hits])
+    budget = token_budget or RETRIEVAL_TOKEN_BUDGET
+    passages = []
+    for chunk_id, score in hits:
+        if chunk_id not in chunks:
+            continue
+        filename, content = chunks[chunk_id]
+        budget -= estimate_tokens(content)
+        if budget < 0 and passages:
+            break
+        passages.append((score, filename, content))
+    return passages
+
+
+def retrieval_message(session_id, query):
+    """System message carrying the passages relevant to query, or None when the session has none."""
+    passages = retrieve_passages(session_id, query)
+    if not passages:
+        return None
+    text = "\n\n".join(f"[{filename}]\n{content}" for _, filename, content in passages)
+    return {"role": "system", "content": RETRIEVAL_PROMPT.format(passages=text)}
@@ -0,0 +1,114 @@
+import hashlib
+import os
+import threading
+import time
+
+from ollama_connects import embed_texts
+from retrieval import VectorIndex, remove_index_files
+from sql_connects import get_message
+
+
+# Opt-in: questions close enough to an earlier one (cosine similarity >= SEMANTIC_CACHE_THRESHOLD) are
+# answered with the earlier answer instead of a new generation. Entries are shared per model (or private
+# endpoint) across chats, so a question re-asked in a new chat is answered at once. The trade-off is that
+# an answer may have depended on the chat it was given in; SEMANTIC_CACHE_SCOPE = "session" keeps entries
+# per session instead. Answers grounded in uploaded documents are never cached (see main.py).
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE", "").lower() in ("1", "true", "yes")
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_SCOPE = os.environ.get("SEMANTIC_CACHE_SCOPE", "model")  # "model" or "session"
+SEMANTIC_CACHE_CANDIDATES = 3
+
+semantic_cache_stats = {"lookups": 0, "hits": 0, "misses": 0, "errors": 0,
+                        "lookup_seconds_total": 0.0, "lookup_seconds_max": 0.0}
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _digest(text):
+    return hashlib.sha1(str(text).encode("utf-8")).hexdigest()[:16]
+
+
+def cache_scope(session_id, model, mode="local", api_url=None):
+    """
+    The index answers are shared in: one per model (or endpoint URL), and in session scope one per
+    session as well, named after the session so forget_session can find it.
+    """
+    name = "qa-" + _digest(f"{mode}\x00{model if mode == 'local' else api_url}")
+    if SEMANTIC_CACHE_SCOPE == "session":
+        name = f"qa-{_digest(session_id)}-{name[3:]}"
+    return name
+
+
+def _get_index(scope):
+    with _indexes_lock:
+        if scope not in _indexes:
+            _indexes[scope] = VectorIndex(scope)
+        return _indexes[scope]
+
+
+def forget_session(session_id):
+    """
+    Deletes the session-scoped indexes of a deleted session. In model scope its entries stay in the shared
+    index, but lookup skips them since their answers are gone.
+    """
+    prefix = f"qa-{_digest(session_id)}-"
+    with _indexes_lock:
+        for scope in [scope for scope in _indexes if scope.startswith(prefix)]:
+            del _indexes[scope]
+    remove_index_files(prefix)
+
+
+def _record(started, hit=None, error=False):
+    elapsed = time.perf_counter() - started
+    with _indexes_lock:
+        semantic_cache_stats["lookups"] += 1
+        key = "errors" if error else "hits" if hit else "misses"
+        semantic_cache_stats[key] += 1
+        semantic_cache_stats["lookup_seconds_total"] += elapsed
+        semantic_cache_stats["lookup_seconds_max"] = max(semantic_cache_stats["lookup_seconds_max"], elapsed)
+
+
+def lookup(question, scope):
+    """
+    Returns (answer, embedding) where answer is the stored answer to the most similar earlier question in
+    scope, or None. Pass the embedding to remember() so the question is not embedded twice.
+    """
+    if not SEMANTIC_CACHE_ENABLED or not question:
+        return None, None
+    started = time.perf_counter()
+    try:
+        vector = embed_texts([question])[0]
+        candidates = _get_index(scope).search(vector, SEMANTIC_CACHE_CANDIDATES)
+    except Exception as e:
+        print(f"Error looking up semantic cache: {e}")
+        _record(started, error=True)
+        return None, None
+    for answer_id, score in candidates:
+        if score < SEMANTIC_CACHE_THRESHOLD:
+            break
+        answer = get_message(answer_id)  # None once the answer's session was deleted
+        if answer:
+            _record(started, hit=True)
+            return answer, vector
+    _record(started)
+    return None, vector
+
+
+def remember(embedding, answer_id, scope):
+    """Adds an answered question (by its embedding from lookup) to the cache of its scope."""
+    if not SEMANTIC_CACHE_ENABLED or embedding is None or answer_id is None:
+        return
+    try:
+        _get_index(scope).add([answer_id], [embedding])
+    except Exception as e:
+        print(f"Error updating semantic cache: {e}")
+
+
+def semantic_cache_snapshot():
+    """Copy of the counters with the hit rate and mean lookup latency."""
+    with _indexes_lock:
+        stats = dict(semantic_cache_stats)
+    stats["hit_rate"] = stats["hits"] / stats["lookups"] if stats["lookups"] else 0.0
+    stats["lookup_seconds_mean"] = stats["lookup_seconds_total"] / stats["lookups"] if stats["lookups"] else 0.0
+    return stats
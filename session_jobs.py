@@ -0,0 +1,237 @@
+import atexit
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from ollama_connects import stream_ollama_response
+from sql_connects import (MULTI_PROCESS, acquire_lease, estimate_tokens, fetch_sessions_to_title,
+                          get_conversation_context, get_counter, get_messages_after, get_session_summary,
+                          get_uncompacted_tokens, increment_counter, queue_background_job, release_lease,
+                          take_background_jobs, update_session_name, update_session_summary)
+
+
+# Once the uncompacted messages of a session other than the last COMPACTION_KEEP_RECENT reach
+# COMPACTION_THRESHOLD tokens, they are folded into the session's running summary.
+COMPACTION_THRESHOLD = 1500
+COMPACTION_KEEP_RECENT = 6
+# One model call folds at most COMPACTION_PASS_TOKENS tokens of messages, so a long backlog is folded over
+# several passes, each moving the summary's last_message_id forward; a longer single message is clipped.
+COMPACTION_PASS_TOKENS = 4 * COMPACTION_THRESHOLD
+
+COMPACTION_PROMPT = """Below is the summary of an earlier conversation followed by newer messages.
+Write an updated summary that keeps every fact, decision, name and open question needed to continue the conversation.
+Reply with the summary only.
+
+Summary so far:
+{summary}
+
+Newer messages:
+{messages}"""
+
+# Session titles are regenerated by at most TITLE_WORKERS concurrent model calls.
+TITLE_WORKERS = 2
+TITLE_PROMPT = "Summarize the following conversation in 10 words or less:\n{context}"
+
+# When several server processes share the database, only the one holding this SQLite lease runs
+# background jobs (compaction, titles, model warm-up). It renews the lease every LEASE_TTL / 3 seconds,
+# so another process takes over within LEASE_TTL if it dies. The other processes queue their jobs in
+# SQLite, and the holder picks them up every QUEUED_JOB_POLL_INTERVAL seconds.
+BACKGROUND_LEASE = "background-jobs"
+LEASE_TTL = 30
+QUEUED_JOB_POLL_INTERVAL = 2
+
+# Counter bumped in SQLite whenever a background job renames a session (see titles_version).
+TITLES_COUNTER = "session-titles"
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-jobs")
+_title_executor = ThreadPoolExecutor(max_workers=TITLE_WORKERS, thread_name_prefix="session-titles")
+_pending = set()
+_pending_titles = set()
+_pending_lock = threading.Lock()
+_lease_holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+_is_leader = not MULTI_PROCESS
+_election_thread = None
+
+
+def _renew_lease():
+    global _is_leader
+    try:
+        _is_leader = acquire_lease(BACKGROUND_LEASE, _lease_holder, LEASE_TTL)
+    except Exception as e:
+        print(f"Error renewing background job lease: {e}")
+        _is_leader = False
+
+
+def _hold_lease():
+    renewed = time.monotonic()
+    while True:
+        time.sleep(QUEUED_JOB_POLL_INTERVAL)
+        if time.monotonic() - renewed >= LEASE_TTL / 3:
+            _renew_lease()
+            renewed = time.monotonic()
+        if _is_leader:
+            _run_queued_jobs()
+
+
+def _run_queued_jobs():
+    """Runs the jobs other processes queued while this one holds the lease."""
+    try:
+        jobs = take_background_jobs()
+    except Exception as e:
+        print(f"Error reading queued background jobs: {e}")
+        return
+    for kind, args in jobs:
+        try:
+            if kind == "compaction":
+                schedule_compaction(*args)
+            elif kind == "titles":
+                schedule_title_updates(*args)
+        except Exception as e:
+            print(f"Error starting queued {kind} job: {e}")
+
+
+def start_leader_election():
+    """Competes for the background job lease when several processes serve the app. Returns is_background_leader()."""
+    global _election_thread
+    if not MULTI_PROCESS or _election_thread is not None:
+        return _is_leader
+    _renew_lease()
+    _election_thread = threading.Thread(target=_hold_lease, name="background-lease", daemon=True)
+    _election_thread.start()
+    atexit.register(release_lease, BACKGROUND_LEASE, _lease_holder)
+    return _is_leader
+
+
+def is_background_leader():
+    """True in the one process that should run background jobs (always true in a single process)."""
+    return _is_leader
+
+
+def _foldable_tokens(session_id):
+    """Size of what compaction would fold; schedule_compaction and compact_session use the same test."""
+    return get_uncompacted_tokens(session_id, keep_recent=COMPACTION_KEEP_RECENT)
+
+
+def _pass_rows(rows):
+    """The oldest rows that fit in one compaction pass (always at least one)."""
+    folded, tokens = [], 0
+    for row in rows:
+        tokens += estimate_tokens(row[2])
+        if folded and tokens > COMPACTION_PASS_TOKENS:
+            break
+        folded.append(row)
+    return folded
+
+
+def compact_session(session_id, model, mode="local", api_url=None, access_token=None):
+    """
+    Folds the oldest uncompacted messages of a session, up to COMPACTION_PASS_TOKENS, into its stored
+    running summary. Returns True if it did; call again while it does to fold a longer backlog.
+    """
+    if _foldable_tokens(session_id) < COMPACTION_THRESHOLD:
+        return False
+    summary, last_id = get_session_summary(session_id)
+    rows = get_messages_after(session_id, last_id)
+    if len(rows) <= COMPACTION_KEEP_RECENT:
+        return False
+    folded = _pass_rows(rows[:-COMPACTION_KEEP_RECENT])
+    clip = COMPACTION_PASS_TOKENS * 4  # characters, see estimate_tokens
+    messages = "".join(f"{'User' if sender == 'user' else 'AI'}: {message[:clip]}\n"
+                       for _, sender, message in folded)
+    prompt = COMPACTION_PROMPT.format(summary=summary or "(none)", messages=messages)
+    # A failed generation raises GenerationError, which _run_compaction reports.
+    new_summary = "".join(stream_ollama_response(prompt, model, mode, api_url, access_token,
+                                                 priority="background")).strip()
+    if not new_summary:
+        return False
+    update_session_summary(session_id, new_summary, folded[-1][0])
+    return True
+
+
+def _run_compaction(session_id, *args):
+    try:
+        while compact_session(session_id, *args):
+            pass
+    except Exception as e:
+        print(f"Error compacting session {session_id}: {e}")
+    finally:
+        with _pending_lock:
+            _pending.discard(session_id)
+
+
+def schedule_compaction(session_id, model, mode="local", api_url=None, access_token=None):
+    """
+    Queues compaction of a session in the background once what it would fold passes the threshold.
+    A process that does not hold the background lease queues it in SQLite for the one that does.
+    """
+    if not model or _foldable_tokens(session_id) < COMPACTION_THRESHOLD:
+        return False
+    if not _is_leader:
+        return queue_background_job("compaction", f"compaction:{session_id}",
+                                    [session_id, model, mode, api_url, access_token])
+    with _pending_lock:
+        if session_id in _pending:
+            return False
+        _pending.add(session_id)
+    _executor.submit(_run_compaction, session_id, model, mode, api_url, access_token)
+    return True
+
+
+def summarize_session_title(session_id, last_message_id, model, mode="local", api_url=None, access_token=None):
+    """Generates a short title for a session and stores it with the newest message id it covers."""
+    context = get_conversation_context(session_id)
+    if not context.strip():
+        return None
+    # A failed generation raises GenerationError, which _run_title reports.
+    summary = "".join(stream_ollama_response(TITLE_PROMPT.format(context=context), model, mode, api_url,
+                                             access_token, priority="background")).strip()
+    if not summary:
+        return None
+    if ':' in summary:
+        summary = summary.split(':')[1]
+    new_name = summary.strip()
+    update_session_name(new_name, session_id, last_message_id)
+    increment_counter(TITLES_COUNTER)
+    return new_name
+
+
+def _run_title(session_id, *args):
+    try:
+        summarize_session_title(session_id, *args)
+    except Exception as e:
+        print(f"Error summarizing session {session_id}: {e}")
+    finally:
+        with _pending_lock:
+            _pending_titles.discard(session_id)
+
+
+def schedule_title_updates(model, mode="local", api_url=None, access_token=None):
+    """
+    Queues a new title for every session that changed since its last one. Returns how many were queued;
+    a process that does not hold the background lease returns 0 and leaves the scan to the one that does.
+    """
+    if not model and mode == "local":
+        return 0
+    if not _is_leader:
+        queue_background_job("titles", "titles", [model, mode, api_url, access_token])
+        return 0
+    queued = 0
+    for session_id, last_message_id in fetch_sessions_to_title():
+        with _pending_lock:
+            if session_id in _pending_titles:
+                continue
+            _pending_titles.add(session_id)
+        _title_executor.submit(_run_title, session_id, last_message_id, model, mode, api_url, access_token)
+        queued += 1
+    return queued
+
+
+def titles_version():
+    """
+    Counter bumped whenever a background job renames a session, so the UI knows to refresh. It is kept
+    in SQLite, so every server process reports the same value.
+    """
+    return get_counter(TITLES_COUNTER)
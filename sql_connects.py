@@ -1,143 +1,1042 @@
+import atexit
+import itertools
+import json
+import os
+import queue
+import signal
 import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
 
 
+DB_FILENAME = "chat_history.db"
 
+# Idle connections kept open for reuse; extra connections opened under load are closed when returned.
+POOL_SIZE = 8
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-16000",      # ~16 MB page cache per connection
+    "PRAGMA mmap_size=268435456",    # 256 MB
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA foreign_keys=ON",
+)
 
+# Set when several server processes share the database (headless mode with --workers > 1): cached
+# per-process state is then re-validated against SQLite, and answer streams, model load status and
+# document ingest progress are shared through it.
+MULTI_PROCESS = int(os.environ.get("UNCOVER_WORKERS", "1")) > 1
+
+# Optional write-behind (SQL_WRITE_BEHIND=1): message inserts and session renames are queued and written
+# by one thread in a single transaction per batch, once WRITE_BEHIND_BATCH writes are queued or
+# WRITE_BEHIND_INTERVAL seconds after the first one. Queued writes are flushed at exit, and before any
+# read of the session they belong to. Single-process only, since message ids are assigned in memory.
+WRITE_BEHIND = os.environ.get("SQL_WRITE_BEHIND", "").lower() in ("1", "true", "yes") and not MULTI_PROCESS
+WRITE_BEHIND_BATCH = 100
+WRITE_BEHIND_INTERVAL = 0.05  # seconds
+# Queued writes SQLite rejected even when retried alone are kept (the last FAILED_WRITES_KEPT of them) for
+# failed_writes() and counted in write_behind_stats; their message ids then point at nothing.
+FAILED_WRITES_KEPT = 100
+# On SIGTERM/SIGINT the queue gets this many seconds to reach SQLite (see install_shutdown_flush).
+SHUTDOWN_FLUSH_TIMEOUT = 5
+
+# Conversation context: sessions kept in memory (LRU) and the prompt budget for the history part.
+CONTEXT_CACHE_SIZE = 64
+CONTEXT_TOKEN_BUDGET = 3000
+CONTEXT_PINNED_MESSAGES = 2  # the opening question and answer always stay in the prompt
+# When the history outgrows the budget, the window start jumps forward until the history fills this
+# share of it, so the prompt prefix (and the backend's cached KV for it) stays stable for several turns.
+CONTEXT_WINDOW_REFILL = 0.6
+# Messages that fell out of every window are dropped from the cache, but the newest
+# CONTEXT_RETAINED_MESSAGES are always kept (so get_uncompacted_tokens can leave out up to that many).
+CONTEXT_RETAINED_MESSAGES = 16
+
+_pool = queue.LifoQueue()
+_pool_filename = DB_FILENAME
+_pool_lock = threading.Lock()
+_local = threading.local()
+
+
+def _open_connection():
+    conn = sqlite3.connect(DB_FILENAME, timeout=5, check_same_thread=False, cached_statements=256)
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def close_all_connections():
+    """Closes every pooled connection, e.g. at shutdown or after DB_FILENAME changes."""
+    global _next_message_id
+    while True:
+        try:
+            _pool.get_nowait().close()
+        except queue.Empty:
+            break
+    _next_message_id = None  # re-read from the (possibly different) database on the next queued insert
+
+
+@contextmanager
+def get_connection():
+    """
+    Yields a pooled SQLite connection for the current thread.
+
+    Nested calls on the same thread share one connection, and the connection goes back to the pool
+    afterwards, so the per-request threads of the Flask server do not reconnect for every query.
+    Use `with conn:` inside to run statements in a transaction.
+    """
+    global _pool_filename
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        yield conn
+        return
+    with _pool_lock:
+        if _pool_filename != DB_FILENAME:
+            close_all_connections()
+            _pool_filename = DB_FILENAME
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = _open_connection()
+    _local.conn = conn
+    try:
+        yield conn
+    finally:
+        _local.conn = None
+        if conn.in_transaction:
+            conn.rollback()
+        if _pool_filename == DB_FILENAME and _pool.qsize() < POOL_SIZE:
+            _pool.put(conn)
+        else:
+            conn.close()
+
+
+_WRITE_STATEMENTS = {
+    "message": "INSERT INTO chat_history (id, session_id, sender, message) VALUES (?, ?, ?, ?)",
+    "rename": "UPDATE sessions SET session_name=? WHERE session_id=?",
+    "rename_titled": "UPDATE sessions SET session_name=?, titled_message_id=? WHERE session_id=?",
+}
+_pending_writes = []  # (kind, session_id, params) in the order they were queued
+_pending_sessions = Counter()  # queued or in-flight writes per session
+_write_lock = threading.Lock()
+_write_queued = threading.Condition(_write_lock)
+_flush_lock = threading.Lock()  # one batch at a time, so writes reach SQLite in order
+_writer = None
+_next_message_id = None
+_failed_writes = deque(maxlen=FAILED_WRITES_KEPT)
+write_behind_stats = {"written": 0, "failed": 0}
+
+
+def _queue_write(kind, session_id, params):
+    """Queues a write for the write-behind thread; call with _write_lock held."""
+    global _writer
+    _pending_writes.append((kind, session_id, params))
+    _pending_sessions[session_id] += 1
+    _write_queued.notify()
+    if _writer is None:
+        _writer = threading.Thread(target=_write_behind_loop, name="sql-write-behind", daemon=True)
+        _writer.start()
+        atexit.register(flush_writes)
+
+
+def _allocate_message_id():
+    """Next chat_history id for a queued insert; AUTOINCREMENT never reuses ids, so neither does this."""
+    global _next_message_id
+    if _next_message_id is None:
+        with get_connection() as conn:
+            _next_message_id = conn.execute("""
+                SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'chat_history'), 0),
+                           COALESCE((SELECT MAX(id) FROM chat_history), 0))
+            """).fetchone()[0] + 1
+    message_id = _next_message_id
+    _next_message_id += 1
+    return message_id
+
+
+def _write_behind_loop():
+    while True:
+        with _write_queued:
+            while not _pending_writes:
+                _write_queued.wait()
+            deadline = time.monotonic() + WRITE_BEHIND_INTERVAL
+            while len(_pending_writes) < WRITE_BEHIND_BATCH and time.monotonic() < deadline:
+                _write_queued.wait(deadline - time.monotonic())
+        flush_writes()
+
+
+def _execute_writes(conn, writes):
+    # The first message of a session may arrive before the session row exists (see create_new_session).
+    sessions = {(session_id, session_id) for kind, session_id, _ in writes if kind == "message"}
+    conn.executemany("INSERT OR IGNORE INTO sessions (session_id,session_name) VALUES (?,?)", sessions)
+    for kind, group in itertools.groupby(writes, key=lambda write: write[0]):
+        conn.executemany(_WRITE_STATEMENTS[kind], [params for _, _, params in group])
+
+
+def flush_writes(session_id=None):
+    """
+    Writes the queued write-behind batch now and returns once it is in SQLite. With session_id, only
+    does so when that session has queued writes, so readers of other sessions do not wait.
+    """
+    with _write_lock:
+        if not _pending_sessions or (session_id is not None and not _pending_sessions[session_id]):
+            return
+    with _flush_lock:
+        with _write_lock:
+            writes = list(_pending_writes)
+            _pending_writes.clear()
+        failed = []
+        if writes:
+            with get_connection() as conn:
+                try:
+                    with conn:
+                        _execute_writes(conn, writes)
+                except sqlite3.Error as e:
+                    print(f"Error writing {len(writes)} queued writes, retrying one by one: {e}")
+                    for write in writes:
+                        try:
+                            with conn:
+                                _execute_writes(conn, [write])
+                        except sqlite3.Error as e:
+                            print(f"Error writing queued {write[0]} for session {write[1]}, dropping it: {e}")
+                            failed.append((*write, str(e)))
+        with _write_lock:
+            write_behind_stats["written"] += len(writes) - len(failed)
+            write_behind_stats["failed"] += len(failed)
+            _failed_writes.extend(failed)
+            _pending_sessions.subtract(write[1] for write in writes)
+            for key in [key for key, count in _pending_sessions.items() if count <= 0]:
+                del _pending_sessions[key]
+
+
+def failed_writes():
+    """Returns (kind, session_id, params, error) for the latest queued writes that could not be stored."""
+    with _write_lock:
+        return list(_failed_writes)
+
+
+def _flush_before_exit():
+    # On a helper thread, with a deadline: the signal may have interrupted a thread holding the write locks.
+    flusher = threading.Thread(target=flush_writes, name="sql-shutdown-flush", daemon=True)
+    flusher.start()
+    flusher.join(SHUTDOWN_FLUSH_TIMEOUT)
+
+
+def install_shutdown_flush(signals=(signal.SIGTERM, signal.SIGINT)):
+    """
+    Flushes queued write-behind writes when the process is told to stop, then passes the signal on to
+    the handler installed before. atexit alone misses SIGTERM, whose default action skips it. Call
+    from the main thread; does nothing without WRITE_BEHIND.
+    """
+    if not WRITE_BEHIND or threading.current_thread() is not threading.main_thread():
+        return
+    for signum in signals:
+        previous = signal.getsignal(signum)
+
+        def handler(signum, frame, previous=previous):
+            _flush_before_exit()
+            if callable(previous):
+                previous(signum, frame)
+            elif previous == signal.SIG_DFL:
+                signal.signal(signum, signal.SIG_DFL)
+                os.kill(os.getpid(), signum)
+
+        signal.signal(signum, handler)
+
+
+# Schema changes applied on top of the tables created by init_db, in order. PRAGMA user_version
+# records how many have run, so each migration is applied exactly once per database.
+SCHEMA_MIGRATIONS = [
+    # 1: cascade chat_history deletes from sessions and index messages by (session_id, id).
+    (
+        """INSERT OR IGNORE INTO sessions (session_id, session_name)
+           SELECT DISTINCT session_id, session_id FROM chat_history WHERE session_id IS NOT NULL""",
+        """CREATE TABLE chat_history_new (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               session_id TEXT REFERENCES sessions(session_id) ON DELETE CASCADE,
+               session_name TEXT,
+               sender TEXT,
+               message TEXT,
+               timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+           )""",
+        """INSERT INTO chat_history_new (id, session_id, session_name, sender, message, timestamp)
+           SELECT id, session_id, session_name, sender, message, timestamp FROM chat_history""",
+        "DROP TABLE chat_history",
+        "ALTER TABLE chat_history_new RENAME TO chat_history",
+        "CREATE INDEX IF NOT EXISTS idx_chat_history_session ON chat_history (session_id, id)",
+    ),
+    # 2: running summary of the compacted part of each session.
+    (
+        """CREATE TABLE IF NOT EXISTS session_summaries (
+               session_id TEXT PRIMARY KEY REFERENCES sessions(session_id) ON DELETE CASCADE,
+               summary TEXT,
+               last_message_id INTEGER NOT NULL DEFAULT 0,
+               updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+           )""",
+    ),
+    # 3: newest message id each session title was generated from, to find sessions needing a new title.
+    (
+        "ALTER TABLE sessions ADD COLUMN titled_message_id INTEGER NOT NULL DEFAULT 0",
+    ),
+    # 4: model responses keyed by a hash of the request (see ollama_connects.response_cache_key).
+    (
+        """CREATE TABLE IF NOT EXISTS response_cache (
+               cache_key TEXT PRIMARY KEY,
+               response TEXT,
+               created REAL,
+               last_used REAL,
+               hits INTEGER NOT NULL DEFAULT 0
+           )""",
+        "CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache (last_used)",
+    ),
+    # 5: full-text index over chat messages, kept in sync by triggers and filled from existing rows.
+    (
+        """CREATE VIRTUAL TABLE IF NOT EXISTS chat_history_fts USING fts5(
+               message, content='chat_history', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+           )""",
+        """CREATE TRIGGER IF NOT EXISTS chat_history_fts_insert AFTER INSERT ON chat_history BEGIN
+               INSERT INTO chat_history_fts (rowid, message) VALUES (new.id, new.message);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS chat_history_fts_delete AFTER DELETE ON chat_history BEGIN
+               INSERT INTO chat_history_fts (chat_history_fts, rowid, message) VALUES ('delete', old.id, old.message);
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS chat_history_fts_update AFTER UPDATE OF message ON chat_history BEGIN
+               INSERT INTO chat_history_fts (chat_history_fts, rowid, message) VALUES ('delete', old.id, old.message);
+               INSERT INTO chat_history_fts (rowid, message) VALUES (new.id, new.message);
+           END""",
+        "INSERT INTO chat_history_fts (chat_history_fts) VALUES ('rebuild')",
+    ),
+    # 6: uploaded documents and their text chunks.
+    (
+        """CREATE TABLE IF NOT EXISTS documents (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               session_id TEXT REFERENCES sessions(session_id) ON DELETE CASCADE,
+               filename TEXT,
+               status TEXT,
+               chunk_count INTEGER NOT NULL DEFAULT 0,
+               summary TEXT,
+               created TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+           )""",
+        "CREATE INDEX IF NOT EXISTS idx_documents_session ON documents (session_id)",
+        """CREATE TABLE IF NOT EXISTS document_chunks (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               document_id INTEGER REFERENCES documents(id) ON DELETE CASCADE,
+               chunk_index INTEGER,
+               content TEXT,
+               tokens INTEGER
+           )""",
+        "CREATE INDEX IF NOT EXISTS idx_document_chunks_document ON document_chunks (document_id, chunk_index)",
+    ),
+    # 7: leases (one process runs background jobs) and answer streams shared between server processes.
+    (
+        """CREATE TABLE IF NOT EXISTS leases (
+               name TEXT PRIMARY KEY,
+               holder TEXT,
+               expires REAL
+           )""",
+        """CREATE TABLE IF NOT EXISTS response_streams (
+               stream_id TEXT PRIMARY KEY,
+               text TEXT,
+               done INTEGER NOT NULL DEFAULT 0,
+               cancelled INTEGER NOT NULL DEFAULT 0,
+               last_read REAL,
+               updated REAL
+           )""",
+    ),
+    # 8: state every server process must see: counters, small JSON values, document progress, and
+    # background jobs queued by any process for the lease holder to run.
+    (
+        """CREATE TABLE IF NOT EXISTS counters (
+               name TEXT PRIMARY KEY,
+               value INTEGER NOT NULL DEFAULT 0
+           )""",
+        """CREATE TABLE IF NOT EXISTS shared_state (
+               key TEXT PRIMARY KEY,
+               value TEXT,
+               updated REAL
+           )""",
+        "ALTER TABLE documents ADD COLUMN progress TEXT",
+        """CREATE TABLE IF NOT EXISTS background_jobs (
+               id INTEGER PRIMARY KEY AUTOINCREMENT,
+               kind TEXT,
+               job_key TEXT UNIQUE,
+               args TEXT,
+               created REAL
+           )""",
+    ),
+]
+
+
+def migrate(conn):
+    """Applies any pending SCHEMA_MIGRATIONS in a single write transaction."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, statements in enumerate(SCHEMA_MIGRATIONS[version:], start=version + 1):
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {number}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
 
-DB_FILENAME = "chat_history.db"
 
 def init_db():
     """Initializes the SQLite database with sessions and chat_history tables."""
-    conn = sqlite3.connect(DB_FILENAME)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS sessions (
-                    session_id TEXT PRIMARY KEY,
-                    session_name TEXT,
-                    created TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                 )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS chat_history (
+    with get_connection() as conn:
+        with conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS sessions (
+                            session_id TEXT PRIMARY KEY,
+                            session_name TEXT,
+                            created TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                         )''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS chat_history (
+                            id INTEGER PRIMARY KEY AUTOINCREMENT,
+                            session_id TEXT,
+                            session_name TEXT,
+                            sender TEXT,
+                            message TEXT,
+                            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                         )''')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS endpoints (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    session_id TEXT,
-                    session_name TEXT,
-                    sender TEXT,
-                    message TEXT,
+                    url TEXT,
+                    port INTEGER,
+                    protocol TEXT,
+                    api_key TEXT,
                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                 )''')
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS endpoints (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            url TEXT,
-            port INTEGER,
-            protocol TEXT,
-            api_key TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    conn.commit()
-    conn.close()
+                )
+            """)
+        migrate(conn)
 
 
 def fetch_all():
-    conn = sqlite3.connect(DB_FILENAME)
-    c = conn.cursor()
-    c.execute("SELECT session_id,session_name FROM sessions order by created DESC ")
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    flush_writes()
+    with get_connection() as conn:
+        return conn.execute("SELECT session_id,session_name FROM sessions order by created DESC ").fetchall()
 
 def create_session(session_id):
     """Creates a new session record if it doesn't already exist."""
-    conn = sqlite3.connect(DB_FILENAME)
-    c = conn.cursor()
-    c.execute("INSERT OR IGNORE INTO sessions (session_id,session_name) VALUES (?,?)", (session_id,session_id))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn, conn:
+        conn.execute("INSERT OR IGNORE INTO sessions (session_id,session_name) VALUES (?,?)", (session_id,session_id))
 
 
 def delete_session(session_id):
     """Deletes a session and all associated chat history."""
-    conn = sqlite3.connect(DB_FILENAME)
-    c = conn.cursor()
+    flush_writes(session_id)  # or a queued message would recreate the session afterwards
+    with get_connection() as conn:
+        try:
+            with conn:
+                # chat_history rows go with it through ON DELETE CASCADE
+                conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        except Exception as e:
+            print(f"Error deleting session: {e}")
+    invalidate_conversation_context(session_id)
 
-    try:
-        # Delete chat history related to the session
-        c.execute("DELETE FROM chat_history WHERE session_id = ?", (session_id,))
+def update_messages(session_id,user_input,user_type):
+    """Appends a message to a session and returns its id (queued, with an id assigned, under WRITE_BEHIND)."""
+    if not session_id:
+        # Would otherwise create a visible session named "" (the dropdown value after a delete).
+        raise ValueError("update_messages needs a session_id")
+    if WRITE_BEHIND:
+        with _write_lock:
+            message_id = _allocate_message_id()
+            _queue_write("message", session_id, (message_id, session_id, user_type, user_input))
+        return message_id
+    with get_connection() as conn, conn:
+        # The first message of a session may arrive before the session row exists (see create_new_session).
+        conn.execute("INSERT OR IGNORE INTO sessions (session_id,session_name) VALUES (?,?)", (session_id, session_id))
+        cursor = conn.execute("INSERT INTO chat_history (session_id, sender, message) VALUES (?, ?, ?)",
+                              (session_id, user_type, user_input))
+        return cursor.lastrowid
 
-        # Delete the session itself
-        c.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
 
-        conn.commit()
-    except Exception as e:
-        print(f"Error deleting session: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
-def update_messages(session_id,user_input,user_type):
-    conn = sqlite3.connect(DB_FILENAME)
-    c = conn.cursor()
-        # Insert user's message
-    c.execute("INSERT INTO chat_history (session_id, sender, message) VALUES (?, ?, ?)",
-                  (session_id, user_type, user_input))
-        # Insert AI's response
-    conn.commit()
-    conn.close()
-
-def get_chat_history(session_id):
-    """Returns a list of chat messages (as dcc.Markdown components) for the given session."""
-    conn = sqlite3.connect(DB_FILENAME)
-    c = conn.cursor()
-    c.execute("SELECT sender, message FROM chat_history WHERE session_id=? ORDER BY timestamp", (session_id,))
-    rows = c.fetchall()
-    conn.close()
+def get_message(message_id):
+    """Returns the text of a chat message, or None once it (or its session) was deleted."""
+    flush_writes()
+    with get_connection() as conn:
+        row = conn.execute("SELECT message FROM chat_history WHERE id = ?", (message_id,)).fetchone()
+    return row[0] if row else None
 
+def get_chat_history(session_id, before_id=None, limit=None):
+    """
+    Returns (id, sender, message) rows of a session, oldest first.
+
+    With limit, only the newest `limit` messages older than before_id (or the newest overall) are
+    returned, so long histories can be loaded page by page with the id of the first row.
+    """
+    flush_writes(session_id)
+    with get_connection() as conn:
+        if limit is None and before_id is None:
+            return conn.execute("SELECT id, sender, message FROM chat_history WHERE session_id=? ORDER BY id",
+                                (session_id,)).fetchall()
+        rows = conn.execute("""
+            SELECT id, sender, message FROM chat_history
+            WHERE session_id = ? AND id < ?
+            ORDER BY id DESC LIMIT ?
+        """, (session_id, before_id if before_id is not None else 2 ** 63 - 1,
+              limit if limit is not None else -1)).fetchall()
+    rows.reverse()
     return rows
 
-def get_conversation_context(session_id):
-    """Retrieve the conversation history for a given session from SQLite."""
-    conn = sqlite3.connect(DB_FILENAME)
-    c = conn.cursor()
-    # Assuming your sessions table stores a unique session name and chat_history stores the conversation
-    c.execute("""
-        SELECT sender,message 
-        FROM chat_history 
-        WHERE session_id = ?
-        ORDER BY timestamp 
-    """, (session_id,))
-    rows = c.fetchall()
-    conn.close()
-    context = ""
-    for user_input, ai_response in rows:
-        # Only include entries where both question and response exist
-            context += f"User: {user_input}\nAI: {ai_response}\n"
-    return context
-
-
-def update_session_name(new_name, session_id):
-    conn = sqlite3.connect(DB_FILENAME)
-    c = conn.cursor()
-    c.execute("UPDATE sessions SET session_name=? WHERE session_id=?", (new_name, session_id))
-    conn.commit()
-    conn.close()
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token) used for prompt budgeting."""
+    return len(text) // 4 + 1
+
+
+class _SessionContext:
+    """
+    Running summary plus (role, content) history of one session, and the newest message id loaded.
+    Its lock is held while the entry is read from SQLite or used, so sessions load independently.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.reset()
+
+    def reset(self, summary="", last_id=0, version=None):
+        self.summary = summary
+        self.compacted = last_id > 0
+        self.messages = []
+        self.tokens = []
+        self.window_starts = {}
+        self.trimmed = False
+        self.uncompacted_tokens = 0
+        self.last_id = last_id
+        self.version = version
+
+
+_context_cache = OrderedDict()
+_context_lock = threading.Lock()
+
+
+def _message_role(sender):
+    return "user" if sender == "user" else "assistant"
+
+
+def _format_context_line(role, content):
+    label = {"user": "User", "system": "System"}.get(role, "AI")
+    return f"{label}: {content}\n"
+
+
+def _summary_text(summary):
+    return f"Summary of the earlier conversation: {summary}"
+
+
+def _session_version(session_id):
+    """Changes when another process compacts the session or deletes and recreates it."""
+    with get_connection() as conn:
+        return conn.execute("""
+            SELECT s.rowid, ss.last_message_id FROM sessions s
+            LEFT JOIN session_summaries ss ON ss.session_id = s.session_id
+            WHERE s.session_id = ?
+        """, (session_id,)).fetchone()
+
+
+def _context_entry(session_id):
+    """The cache entry of a session, created empty if missing; _context_lock only guards the LRU."""
+    with _context_lock:
+        entry = _context_cache.get(session_id)
+        if entry is None:
+            entry = _context_cache[session_id] = _SessionContext()
+            if len(_context_cache) > CONTEXT_CACHE_SIZE:
+                _context_cache.popitem(last=False)
+        else:
+            _context_cache.move_to_end(session_id)
+        return entry
+
+
+def _load_session_context(entry, session_id):
+    """Appends the messages written since the entry was last read (rebuilding it if needed); hold entry.lock."""
+    version = _session_version(session_id) if MULTI_PROCESS else None
+    if not entry.loaded or entry.version != version:
+        entry.reset(*get_session_summary(session_id), version)
+        entry.loaded = True
+    for message_id, sender, message in get_messages_after(session_id, entry.last_id):
+        role = _message_role(sender)
+        tokens = estimate_tokens(_format_context_line(role, message))
+        entry.messages.append((role, message))
+        entry.tokens.append(tokens)
+        entry.uncompacted_tokens += tokens
+        entry.last_id = message_id
+
+
+def _trim_session_context(entry):
+    """Drops cached messages that are before the window of every token budget used so far."""
+    pinned = 0 if entry.compacted else min(CONTEXT_PINNED_MESSAGES, len(entry.messages))
+    cut = min(min(entry.window_starts.values(), default=pinned), len(entry.messages) - CONTEXT_RETAINED_MESSAGES)
+    if cut <= pinned:
+        return
+    del entry.messages[pinned:cut]
+    del entry.tokens[pinned:cut]
+    for budget in entry.window_starts:
+        entry.window_starts[budget] -= cut - pinned
+    entry.trimmed = True
+
+
+def _select_window(entry, token_budget):
+    """
+    Picks the messages to send: returns (pinned, start), meaning messages[:pinned] + messages[start:].
+    The start only moves when the budget is exceeded, and then with headroom (CONTEXT_WINDOW_REFILL).
+    """
+    tokens = entry.tokens
+    pinned = 0 if entry.compacted else min(CONTEXT_PINNED_MESSAGES, len(tokens))
+    start = max(entry.window_starts.get(token_budget, pinned), pinned)
+    if not token_budget:
+        return pinned, pinned
+    fixed = sum(tokens[:pinned])
+    if entry.summary:
+        fixed += estimate_tokens(_summary_text(entry.summary))
+    total = sum(tokens[start:])
+    if fixed + total > token_budget:
+        target = (token_budget - fixed) * CONTEXT_WINDOW_REFILL
+        while start < len(tokens) - 1 and total > target:
+            total -= tokens[start]
+            start += 1
+        # Start the window on a question so user/assistant turns stay paired.
+        while start < len(tokens) - 1 and entry.messages[start][0] != "user":
+            start += 1
+    entry.window_starts[token_budget] = start
+    return pinned, start
+
+
+def _conversation_window(session_id, token_budget):
+    if token_budget is None:
+        token_budget = CONTEXT_TOKEN_BUDGET
+    entry = _context_entry(session_id)
+    with entry.lock:
+        _load_session_context(entry, session_id)
+        if entry.trimmed and (not token_budget or token_budget not in entry.window_starts):
+            # A budget that may reach further back than what is still cached: reload the history.
+            entry.loaded = False
+            _load_session_context(entry, session_id)
+        pinned, start = _select_window(entry, token_budget)
+        window = entry.messages[:pinned] + entry.messages[start:]
+        _trim_session_context(entry)
+        return entry.summary, window
+
+
+def invalidate_conversation_context(session_id=None):
+    """Drops the cached context of one session, or of all sessions."""
+    with _context_lock:
+        if session_id is None:
+            _context_cache.clear()
+        else:
+            _context_cache.pop(session_id, None)
+
+
+def get_conversation_context(session_id, token_budget=None):
+    """
+    Retrieve the conversation history for a given session as prompt text.
+
+    Only messages written since the previous call are read from SQLite. Compacted sessions start with
+    their running summary followed by the messages after it; otherwise the first CONTEXT_PINNED_MESSAGES
+    messages are pinned. The rest is a window of recent messages kept within token_budget
+    (CONTEXT_TOKEN_BUDGET by default); pass token_budget=0 for everything.
+    """
+    summary, messages = _conversation_window(session_id, token_budget)
+    lines = [_format_context_line(role, content) for role, content in messages]
+    if summary:
+        lines.insert(0, _format_context_line("system", _summary_text(summary)))
+    return "".join(lines)
+
+
+def get_conversation_messages(session_id, token_budget=None):
+    """Same window as get_conversation_context, as chat messages ({"role", "content"}) for a chat endpoint."""
+    summary, messages = _conversation_window(session_id, token_budget)
+    chat = [{"role": role, "content": content} for role, content in messages]
+    if summary:
+        chat.insert(0, {"role": "system", "content": _summary_text(summary)})
+    return chat
+
+
+def get_uncompacted_tokens(session_id, keep_recent=0):
+    """
+    Estimated prompt size of the messages not yet folded into the session's running summary, leaving
+    out the newest keep_recent of them (at most CONTEXT_RETAINED_MESSAGES).
+    """
+    entry = _context_entry(session_id)
+    with entry.lock:
+        _load_session_context(entry, session_id)
+        if keep_recent >= len(entry.messages):
+            return 0
+        return entry.uncompacted_tokens - sum(entry.tokens[len(entry.tokens) - keep_recent:])
+
+
+def get_messages_after(session_id, after_id=0, limit=None):
+    """Returns (id, sender, message) rows of a session with id greater than after_id, oldest first."""
+    flush_writes(session_id)  # read-your-writes for the conversation context, which reads through here
+    with get_connection() as conn:
+        return conn.execute("""
+            SELECT id, sender, message FROM chat_history WHERE session_id = ? AND id > ? ORDER BY id LIMIT ?
+        """, (session_id, after_id, limit if limit is not None else -1)).fetchall()
+
+
+def get_session_summary(session_id):
+    """Returns (summary, last_message_id) for a session, or ("", 0) if it was never compacted."""
+    with get_connection() as conn:
+        row = conn.execute("SELECT summary, last_message_id FROM session_summaries WHERE session_id = ?",
+                           (session_id,)).fetchone()
+    return (row[0] or "", row[1]) if row else ("", 0)
+
+
+def update_session_summary(session_id, summary, last_message_id):
+    """Stores the running summary covering every message of the session up to last_message_id."""
+    with get_connection() as conn, conn:
+        conn.execute("""
+            INSERT INTO session_summaries (session_id, summary, last_message_id) VALUES (?, ?, ?)
+            ON CONFLICT(session_id) DO UPDATE SET summary = excluded.summary,
+                last_message_id = excluded.last_message_id, updated = CURRENT_TIMESTAMP
+        """, (session_id, summary, last_message_id))
+    invalidate_conversation_context(session_id)
+
+
+def update_session_name(new_name, session_id, titled_message_id=None):
+    if WRITE_BEHIND:
+        with _write_lock:
+            if titled_message_id is None:
+                _queue_write("rename", session_id, (new_name, session_id))
+            else:
+                _queue_write("rename_titled", session_id, (new_name, titled_message_id, session_id))
+        return
+    with get_connection() as conn, conn:
+        if titled_message_id is None:
+            conn.execute("UPDATE sessions SET session_name=? WHERE session_id=?", (new_name, session_id))
+        else:
+            conn.execute("UPDATE sessions SET session_name=?, titled_message_id=? WHERE session_id=?",
+                         (new_name, titled_message_id, session_id))
+
+
+def fetch_sessions_to_title():
+    """Returns (session_id, newest_message_id) for sessions with messages newer than their current title."""
+    flush_writes()
+    with get_connection() as conn:
+        # The correlated MAX is one seek to the end of the session's range in idx_chat_history_session,
+        # so this costs one lookup per session however long the histories are.
+        return conn.execute("""
+            SELECT session_id, newest FROM (
+                SELECT s.session_id, s.titled_message_id,
+                       (SELECT MAX(c.id) FROM chat_history c WHERE c.session_id = s.session_id) AS newest
+                FROM sessions s
+            )
+            WHERE newest > titled_message_id
+        """).fetchall()
 
 def update_private_endpoint(url, port, protocol, api_key):
-    conn = sqlite3.connect(DB_FILENAME)
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO endpoints (url, port, protocol, api_key)
-        VALUES (?, ?, ?, ?)
-    """, (url, port, protocol, api_key))
-    conn.commit()
-    conn.close()
+    with get_connection() as conn, conn:
+        conn.execute("""
+            INSERT INTO endpoints (url, port, protocol, api_key)
+            VALUES (?, ?, ?, ?)
+        """, (url, port, protocol, api_key))
 
 def fetch_private_endpoint():
-    conn = sqlite3.connect(DB_FILENAME)
-    c = conn.cursor()
-    # Assuming your sessions table stores a unique session name and chat_history stores the conversation
-    c.execute("""
-        SELECT * from endpoints order by timestamp desc""")
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    with get_connection() as conn:
+        # Assuming your sessions table stores a unique session name and chat_history stores the conversation
+        return conn.execute("""
+            SELECT * from endpoints order by timestamp desc""").fetchall()
+
+
+def load_startup_state(default_session):
+    """
+    Everything the first page load needs, read on one connection: the sessions (newest first, creating
+    default_session when there are none) and the most recently saved private endpoint row, or None.
+    """
+    flush_writes()
+    with get_connection() as conn:
+        sessions = conn.execute("SELECT session_id,session_name FROM sessions order by created DESC ").fetchall()
+        if not sessions:
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO sessions (session_id,session_name) VALUES (?,?)",
+                             (default_session, default_session))
+            sessions = [(default_session, default_session)]
+        endpoint = conn.execute("SELECT * from endpoints order by timestamp desc LIMIT 1").fetchone()
+    return sessions, endpoint
+
+
+def get_cached_response(cache_key, max_age=None):
+    """Returns the cached response for a key, or None if missing or older than max_age seconds."""
+    now = time.time()
+    with get_connection() as conn:
+        row = conn.execute("SELECT response, created FROM response_cache WHERE cache_key = ?", (cache_key,)).fetchone()
+        if row is None or (max_age is not None and now - row[1] > max_age):
+            return None
+        with conn:
+            conn.execute("UPDATE response_cache SET last_used = ?, hits = hits + 1 WHERE cache_key = ?", (now, cache_key))
+    return row[0]
+
+
+def put_cached_response(cache_key, response):
+    now = time.time()
+    with get_connection() as conn, conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO response_cache (cache_key, response, created, last_used, hits)
+            VALUES (?, ?, ?, ?, 0)
+        """, (cache_key, response, now, now))
+
+
+def evict_response_cache(max_entries=None, max_age=None):
+    """Deletes entries older than max_age seconds, then the least recently used beyond max_entries."""
+    with get_connection() as conn, conn:
+        if max_age is not None:
+            conn.execute("DELETE FROM response_cache WHERE created < ?", (time.time() - max_age,))
+        if max_entries is not None:
+            conn.execute("""
+                DELETE FROM response_cache WHERE cache_key IN (
+                    SELECT cache_key FROM response_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+            """, (max_entries,))
+
+
+def create_document(session_id, filename):
+    """Registers an uploaded file for a session and returns its document id."""
+    with get_connection() as conn, conn:
+        conn.execute("INSERT OR IGNORE INTO sessions (session_id,session_name) VALUES (?,?)", (session_id, session_id))
+        cursor = conn.execute("INSERT INTO documents (session_id, filename, status) VALUES (?, ?, 'ingesting')",
+                              (session_id, filename))
+        return cursor.lastrowid
+
+
+def add_document_chunks(document_id, chunks):
+    """Stores (chunk_index, content, tokens) rows for a document in one transaction."""
+    with get_connection() as conn, conn:
+        conn.executemany("INSERT INTO document_chunks (document_id, chunk_index, content, tokens) VALUES (?, ?, ?, ?)",
+                         [(document_id, index, content, tokens) for index, content, tokens in chunks])
+
+
+def update_document(document_id, status=None, chunk_count=None, summary=None):
+    with get_connection() as conn, conn:
+        conn.execute("""
+            UPDATE documents SET status = COALESCE(?, status), chunk_count = COALESCE(?, chunk_count),
+                                 summary = COALESCE(?, summary)
+            WHERE id = ?
+        """, (status, chunk_count, summary, document_id))
+
+
+def get_document(document_id):
+    """Returns (id, session_id, filename, status, chunk_count, summary) or None."""
+    with get_connection() as conn:
+        return conn.execute("SELECT id, session_id, filename, status, chunk_count, summary FROM documents WHERE id = ?",
+                            (document_id,)).fetchone()
+
+
+def save_document_progress(document_id, progress):
+    """Stores a document's ingest progress dict for server processes other than the one ingesting it."""
+    with get_connection() as conn, conn:
+        conn.execute("UPDATE documents SET progress = ? WHERE id = ?", (json.dumps(progress), document_id))
+
+
+def get_document_progress(document_id):
+    """Returns the progress dict last stored with save_document_progress, or None."""
+    with get_connection() as conn:
+        row = conn.execute("SELECT progress FROM documents WHERE id = ?", (document_id,)).fetchone()
+    return json.loads(row[0]) if row and row[0] else None
+
+
+def iter_document_chunks(document_id, batch_size=256):
+    """Yields (chunk_id, chunk_index, content, tokens) rows of a document in order, a batch of rows at a time."""
+    last_index = -1
+    while True:
+        with get_connection() as conn:
+            rows = conn.execute("""
+                SELECT id, chunk_index, content, tokens FROM document_chunks
+                WHERE document_id = ? AND chunk_index > ? ORDER BY chunk_index LIMIT ?
+            """, (document_id, last_index, batch_size)).fetchall()
+        if not rows:
+            return
+        yield from rows
+        last_index = rows[-1][1]
+
+
+def get_chunks_by_id(chunk_ids):
+    """Returns {chunk_id: (filename, content)} for the given document chunk ids."""
+    if not chunk_ids:
+        return {}
+    placeholders = ",".join("?" * len(chunk_ids))
+    with get_connection() as conn:
+        rows = conn.execute(f"""
+            SELECT c.id, d.filename, c.content FROM document_chunks c JOIN documents d ON d.id = c.document_id
+            WHERE c.id IN ({placeholders})
+        """, list(chunk_ids)).fetchall()
+    return {chunk_id: (filename, content) for chunk_id, filename, content in rows}
+
+
+def _fts_query(query):
+    """Turns free text into an FTS5 query: every word must match, the last one as a prefix."""
+    terms = ['"' + term.replace('"', '""') + '"' for term in query.split()]
+    if terms:
+        terms[-1] += "*"
+    return " ".join(terms)
+
+
+def search_chat_history(query, limit=20):
+    """
+    Full-text search over all messages, best matches first.
+
+    Returns (message_id, session_id, session_name, sender, snippet) rows; matched words in the snippet
+    are wrapped in ** for Markdown.
+    """
+    match = _fts_query(query)
+    if not match:
+        return []
+    flush_writes()
+    with get_connection() as conn:
+        return conn.execute("""
+            SELECT c.id, c.session_id, s.session_name, c.sender,
+                   snippet(chat_history_fts, 0, '**', '**', '…', 16)
+            FROM chat_history_fts
+            JOIN chat_history c ON c.id = chat_history_fts.rowid
+            LEFT JOIN sessions s ON s.session_id = c.session_id
+            WHERE chat_history_fts MATCH ?
+            ORDER BY bm25(chat_history_fts)
+            LIMIT ?
+        """, (match, limit)).fetchall()
+
+
+def get_message_session(message_id):
+    flush_writes()
+    with get_connection() as conn:
+        row = conn.execute("SELECT session_id FROM chat_history WHERE id = ?", (message_id,)).fetchone()
+    return row[0] if row else None
+
+
+def rebuild_search_index():
+    """Rebuilds the full-text index from chat_history, e.g. after rows were changed with triggers off."""
+    with get_connection() as conn, conn:
+        conn.execute("INSERT INTO chat_history_fts (chat_history_fts) VALUES ('rebuild')")
+        conn.execute("INSERT INTO chat_history_fts (chat_history_fts) VALUES ('optimize')")
+
+
+def acquire_lease(name, holder, ttl):
+    """Takes or renews the lease name for holder if it is free or expired. Returns True while holder has it."""
+    now = time.time()
+    with get_connection() as conn, conn:
+        conn.execute("""
+            INSERT INTO leases (name, holder, expires) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires = excluded.expires
+            WHERE leases.holder = excluded.holder OR leases.expires < ?
+        """, (name, holder, now + ttl, now))
+        row = conn.execute("SELECT holder FROM leases WHERE name = ?", (name,)).fetchone()
+    return row is not None and row[0] == holder
+
+
+def release_lease(name, holder):
+    """Gives up the lease name if holder still has it, so another process can take it over right away."""
+    with get_connection() as conn, conn:
+        conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+
+def save_shared_stream(stream_id, text, done=False):
+    """Publishes the text generated so far for a stream other server processes may be polled for."""
+    now = time.time()
+    with get_connection() as conn, conn:
+        conn.execute("""
+            INSERT INTO response_streams (stream_id, text, done, last_read, updated) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(stream_id) DO UPDATE SET text = excluded.text, done = excluded.done, updated = excluded.updated
+        """, (stream_id, text, int(done), now, now))
+
+
+def read_shared_stream(stream_id):
+    """Returns (text, done) of a shared stream and marks it read, or None if unknown. Done streams are removed."""
+    with get_connection() as conn, conn:
+        row = conn.execute("SELECT text, done FROM response_streams WHERE stream_id = ?", (stream_id,)).fetchone()
+        if row is None:
+            return None
+        if row[1]:
+            conn.execute("DELETE FROM response_streams WHERE stream_id = ?", (stream_id,))
+        else:
+            conn.execute("UPDATE response_streams SET last_read = ? WHERE stream_id = ?", (time.time(), stream_id))
+    return row[0] or "", bool(row[1])
+
+
+def cancel_shared_stream(stream_id):
+    """Flags a shared stream as cancelled; the process generating it stops it on its next sweep."""
+    with get_connection() as conn, conn:
+        conn.execute("UPDATE response_streams SET cancelled = 1 WHERE stream_id = ?", (stream_id,))
+
+
+def shared_stream_states(stream_ids):
+    """Returns {stream_id: (last_read, cancelled)} for the given shared streams."""
+    if not stream_ids:
+        return {}
+    placeholders = ",".join("?" * len(stream_ids))
+    with get_connection() as conn:
+        rows = conn.execute(f"SELECT stream_id, last_read, cancelled FROM response_streams "
+                            f"WHERE stream_id IN ({placeholders})", list(stream_ids)).fetchall()
+    return {stream_id: (last_read, bool(cancelled)) for stream_id, last_read, cancelled in rows}
+
+
+def prune_shared_streams(max_age):
+    """Deletes shared streams not updated for max_age seconds."""
+    with get_connection() as conn, conn:
+        conn.execute("DELETE FROM response_streams WHERE updated < ?", (time.time() - max_age,))
+
+
+def increment_counter(name):
+    """Adds one to the counter name and returns its new value."""
+    with get_connection() as conn, conn:
+        conn.execute("""
+            INSERT INTO counters (name, value) VALUES (?, 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + 1
+        """, (name,))
+        return conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()[0]
+
+
+def get_counter(name):
+    """Current value of the counter name (0 before its first increment)."""
+    with get_connection() as conn:
+        row = conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else 0
+
+
+def save_shared_state(key, value):
+    """Stores a JSON-serialisable value under key, for every server process to read."""
+    with get_connection() as conn, conn:
+        conn.execute("""
+            INSERT INTO shared_state (key, value, updated) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated = excluded.updated
+        """, (key, json.dumps(value), time.time()))
+
+
+def read_shared_state(key, default=None):
+    """Returns the value stored under key with save_shared_state, or default."""
+    with get_connection() as conn:
+        row = conn.execute("SELECT value FROM shared_state WHERE key = ?", (key,)).fetchone()
+    return json.loads(row[0]) if row else default
+
+
+def queue_background_job(kind, job_key, args):
+    """
+    Queues a job for the process holding the background lease. A job with the same job_key still
+    waiting is kept as is, so repeated requests run once. Returns True if the job was added.
+    """
+    with get_connection() as conn, conn:
+        cursor = conn.execute("INSERT OR IGNORE INTO background_jobs (kind, job_key, args, created) VALUES (?, ?, ?, ?)",
+                              (kind, job_key, json.dumps(args), time.time()))
+        return cursor.rowcount > 0
+
+
+def take_background_jobs(limit=100):
+    """Removes up to limit queued jobs, oldest first, and returns them as (kind, args) pairs."""
+    # Only the lease holder takes jobs, so nothing else can delete them between the read and the delete.
+    with get_connection() as conn, conn:
+        rows = conn.execute("SELECT id, kind, args FROM background_jobs ORDER BY id LIMIT ?", (limit,)).fetchall()
+        conn.executemany("DELETE FROM background_jobs WHERE id = ?", [(job_id,) for job_id, _, _ in rows])
+    return [(kind, json.loads(args)) for _, kind, args in rows]
 
 
+if __name__ == "__main__":
+    import argparse
 
+    parser = argparse.ArgumentParser(description="Maintenance commands for the chat history database.")
+    parser.add_argument("command", choices=["migrate", "rebuild-search-index"])
+    parser.add_argument("--db", default=DB_FILENAME, help="database file (default: %(default)s)")
+    args = parser.parse_args()
+    DB_FILENAME = args.db
+    init_db()
+    if args.command == "rebuild-search-index":
+        rebuild_search_index()
+    print(f"{args.command}: done ({DB_FILENAME})")
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# The app is a set of top-level modules; make them importable however pytest is invoked.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sql_connects  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """sql_connects on a fresh, migrated database in tmp_path."""
+    monkeypatch.setattr(sql_connects, "DB_FILENAME", str(tmp_path / "test.db"))
+    sql_connects.close_all_connections()
+    sql_connects.invalidate_conversation_context()
+    sql_connects.init_db()
+    yield sql_connects
+    sql_connects.close_all_connections()
+    sql_connects.invalidate_conversation_context()
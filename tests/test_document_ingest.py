@@ -0,0 +1,39 @@
+import base64
+
+import pytest
+
+pytest.importorskip("httpx")
+
+import document_ingest  # noqa: E402
+
+
+def data_url(text):
+    return "data:text/plain;base64," + base64.b64encode(text.encode("utf-8")).decode("ascii")
+
+
+def test_finished_progress_moves_from_memory_to_sqlite(db, monkeypatch):
+    indexed = []
+    monkeypatch.setattr(document_ingest, "index_document",
+                        lambda session_id, document_id, on_progress: indexed.append(document_id))
+    contents = data_url("First paragraph.\n\n" + "word " * 2000)
+    document_id = db.create_document("s", "notes.txt")
+    document_ingest._set_progress(document_id, filename="notes.txt", status="ingesting", chunks=0)
+    assert document_id in document_ingest._progress
+
+    document_ingest._run_ingest("s", document_id, contents, "notes.txt")
+    assert indexed == [document_id]
+    assert document_id not in document_ingest._progress
+    assert document_id not in document_ingest._progress_synced
+    progress = document_ingest.ingest_progress(document_id)
+    assert progress["status"] == "ready"
+    assert progress["chunks"] == len(list(db.iter_document_chunks(document_id))) > 1
+
+
+def test_pdf_is_offered_only_with_pypdf():
+    try:
+        import pypdf  # noqa: F401
+    except ImportError:
+        assert not document_ingest.is_supported("report.pdf")
+    else:
+        assert document_ingest.is_supported("report.pdf")
+    assert document_ingest.is_supported("notes.MD")
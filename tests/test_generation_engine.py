@@ -0,0 +1,124 @@
+import asyncio
+import threading
+import time
+import uuid
+
+import pytest
+
+pytest.importorskip("httpx")
+
+import generation_engine  # noqa: E402
+from generation_engine import CancellationToken, GenerationError  # noqa: E402
+
+
+class FakeBackend:
+    """
+    Stands in for generation_engine._chunks: streams the words of the prompt, holding back everything
+    after the first word until release is set. Records which prompts started and which were closed.
+    """
+
+    def __init__(self):
+        self.started = []
+        self.closed = []
+        self.release = threading.Event()
+
+    def __call__(self, prompt, model, mode, api_url, access_token, options, keep_alive, stats, messages):
+        return self._chunks(prompt)
+
+    async def _chunks(self, prompt):
+        self.started.append(prompt)
+        try:
+            for i, word in enumerate(prompt.split()):
+                while i and not self.release.is_set():
+                    await asyncio.sleep(0.005)
+                yield word + " "
+        finally:
+            self.closed.append(prompt)
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = FakeBackend()
+    monkeypatch.setattr(generation_engine, "_chunks", backend)
+    yield backend
+    backend.release.set()
+
+
+@pytest.fixture
+def model():
+    """A model name of its own, so every test gets fresh scheduler slots."""
+    return f"fake-{uuid.uuid4().hex[:8]}"
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.005)
+
+
+def test_identical_requests_share_one_generation(backend, model):
+    first = generation_engine.stream("one two three", model)
+    assert next(first) == "one "
+    second = generation_engine.stream("one two three", model)
+    assert next(second) == "one "  # replayed from what the generation produced so far
+    backend.release.set()
+    assert "".join(first) == "two three "
+    assert "".join(second) == "two three "
+    assert backend.started == ["one two three"]
+
+
+def test_cancelled_caller_detaches_without_stopping_the_others(backend, model):
+    token = CancellationToken()
+    stats = {}
+    leaving = generation_engine.stream("one two three", model, token=token, stats=stats)
+    staying = generation_engine.stream("one two three", model)
+    assert next(leaving) == next(staying) == "one "
+    token.cancel()
+    assert list(leaving) == []
+    assert stats["cancelled"]
+    time.sleep(0.05)
+    assert backend.closed == []
+    backend.release.set()
+    assert "".join(staying) == "two three "
+
+
+def test_backend_is_closed_when_the_last_caller_leaves(backend, model):
+    only = generation_engine.stream("one two three", model)
+    assert next(only) == "one "
+    only.close()
+    wait_for(lambda: backend.closed == ["one two three"])
+    # The abandoned generation is no longer shared: asking again starts a new one.
+    backend.release.set()
+    assert "".join(generation_engine.stream("one two three", model)) == "one two three "
+    assert backend.started == ["one two three"] * 2
+
+
+def test_deadline_includes_time_spent_queued(backend, model, monkeypatch):
+    monkeypatch.setitem(generation_engine.generation_scheduler.CONCURRENCY_LIMITS, ("model", model), 1)
+    holder = generation_engine.stream("hold the slot", model)
+    assert next(holder) == "hold "
+    # The slot frees up after a second, well past the 0.2 s deadline of the queued request.
+    releaser = threading.Timer(1, backend.release.set)
+    releaser.start()
+    stats = {}
+    with pytest.raises(GenerationError):
+        list(generation_engine.stream("never started", model, timeout=0.2, stats=stats))
+    assert stats["timed_out"]
+    assert "never started" not in backend.started
+    assert "".join(holder) == "the slot "
+    releaser.join()
+
+
+def test_failure_is_raised_after_the_text_produced_before_it(monkeypatch, model):
+    async def failing(*args):
+        yield "partial "
+        raise RuntimeError("backend went away")
+
+    monkeypatch.setattr(generation_engine, "_chunks", failing)
+    stats = {}
+    chunks = generation_engine.stream("anything", model, stats=stats)
+    assert next(chunks) == "partial "
+    with pytest.raises(GenerationError, match="backend went away"):
+        next(chunks)
+    assert stats["error"] == "backend went away"
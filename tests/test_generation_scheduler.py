@@ -0,0 +1,79 @@
+import asyncio
+
+import generation_scheduler
+
+
+def run_jobs(jobs, limit):
+    """Runs (name, priority) jobs through one limiter of size limit; returns start order and peak concurrency."""
+    key = ("model", f"test-{limit}-{len(jobs)}")
+    generation_scheduler._slots.pop(key, None)
+    generation_scheduler.CONCURRENCY_LIMITS[key] = limit
+    started, running, peak = [], [0], [0]
+
+    async def job(name, priority):
+        async with generation_scheduler.acquire([key], priority):
+            started.append(name)
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+            await asyncio.sleep(0.01)
+            running[0] -= 1
+
+    async def main():
+        # Every job is queued before the first one finishes, so wakeup order is decided by the limiter.
+        await asyncio.gather(*(job(name, priority) for name, priority in jobs))
+
+    try:
+        asyncio.run(main())
+        assert generation_scheduler._slots[key].active == 0
+    finally:
+        del generation_scheduler.CONCURRENCY_LIMITS[key]
+        generation_scheduler._slots.pop(key, None)
+    return started, peak[0]
+
+
+def test_slot_limit_is_never_exceeded():
+    started, peak = run_jobs([(f"job {i}", "interactive") for i in range(7)], limit=2)
+    assert peak == 2
+    assert len(started) == 7
+
+
+def test_interactive_waiters_go_before_background_ones():
+    jobs = [("first", "interactive"), ("title 1", "background"), ("chat 1", "interactive"),
+            ("title 2", "background"), ("chat 2", "interactive")]
+    started, _ = run_jobs(jobs, limit=1)
+    assert started == ["first", "chat 1", "chat 2", "title 1", "title 2"]
+
+
+def test_cancelled_waiter_gives_up_its_place():
+    key = ("model", "test-cancelled-waiter")
+    generation_scheduler.CONCURRENCY_LIMITS[key] = 1
+    slots = generation_scheduler._get_slots(key)
+
+    async def main():
+        holder = asyncio.Event()
+        release = asyncio.Event()
+        order = []
+
+        async def job(name):
+            async with generation_scheduler.acquire([key]):
+                order.append(name)
+                holder.set()
+                await release.wait()
+
+        first = asyncio.create_task(job("first"))
+        await holder.wait()
+        cancelled = asyncio.create_task(job("cancelled"))
+        last = asyncio.create_task(job("last"))
+        await asyncio.sleep(0)
+        assert slots.queued() == 2
+        cancelled.cancel()
+        release.set()
+        await asyncio.gather(first, last, cancelled, return_exceptions=True)
+        return order
+
+    try:
+        assert asyncio.run(main()) == ["first", "last"]
+        assert slots.active == 0 and slots.queued() == 0
+    finally:
+        del generation_scheduler.CONCURRENCY_LIMITS[key]
+        generation_scheduler._slots.pop(key, None)
@@ -0,0 +1,55 @@
+import pytest
+
+pytest.importorskip("httpx")
+np = pytest.importorskip("numpy")
+
+import retrieval  # noqa: E402
+
+# Fixed embeddings: cosine similarity to "fruit" is 1.0, 0.8, 0.6 and 0.0 in this order.
+VECTORS = {
+    "fruit": [1.0, 0.0, 0.0],
+    "apples are sweet": [2.0, 0.0, 0.0],
+    "pears are grainy": [0.8, 0.6, 0.0],
+    "plums are sour": [0.6, 0.8, 0.0],
+    "engines need oil": [0.0, 0.0, 3.0],
+}
+
+
+@pytest.fixture
+def index_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(retrieval, "VECTOR_INDEX_DIR", str(tmp_path))
+    monkeypatch.setattr(retrieval, "embed_texts", lambda texts: [VECTORS[text] for text in texts])
+    retrieval._indexes.clear()
+    yield tmp_path
+    retrieval._indexes.clear()
+
+
+def test_search_returns_top_k_by_cosine_similarity(index_dir):
+    index = retrieval.VectorIndex("test")
+    index.add([10, 11, 12], [VECTORS[text] for text in ("plums are sour", "engines need oil", "apples are sweet")])
+    assert [i for i, _ in index.search(VECTORS["fruit"], 2)] == [12, 10]
+    # Rows appended after a search are picked up by the next one.
+    index.add([13], [VECTORS["pears are grainy"]])
+    hits = index.search(VECTORS["fruit"], 10)
+    assert [i for i, _ in hits] == [12, 13, 10, 11]
+    assert [round(score, 3) for _, score in hits] == [1.0, 0.8, 0.6, 0.0]
+    assert len(retrieval.VectorIndex("test")) == 4  # read back from disk
+
+
+def test_passages_are_cut_at_top_k_and_min_score(db, index_dir):
+    document_id = db.create_document("s", "notes.txt")
+    texts = ["engines need oil", "plums are sour", "apples are sweet", "pears are grainy"]
+    db.add_document_chunks(document_id, [(i, text, db.estimate_tokens(text)) for i, text in enumerate(texts)])
+    assert retrieval.index_document("s", document_id) == 4
+    assert retrieval.has_index("s")
+
+    passages = retrieval.retrieve_passages("s", "fruit", top_k=2)
+    assert [content for _, _, content in passages] == ["apples are sweet", "pears are grainy"]
+    # The engine chunk is in the top 4 but scores below RETRIEVAL_MIN_SCORE.
+    passages = retrieval.retrieve_passages("s", "fruit", top_k=4)
+    assert [content for _, _, content in passages] == ["apples are sweet", "pears are grainy", "plums are sour"]
+    assert {filename for _, filename, _ in passages} == {"notes.txt"}
+
+    retrieval.delete_index("s")
+    assert not retrieval.has_index("s")
+    assert retrieval.retrieve_passages("s", "fruit") == []
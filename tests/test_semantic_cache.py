@@ -0,0 +1,71 @@
+import math
+import os
+
+import pytest
+
+pytest.importorskip("httpx")
+pytest.importorskip("numpy")
+
+import retrieval  # noqa: E402
+import semantic_cache  # noqa: E402
+
+
+def at_angle(cosine):
+    """A unit vector with the given cosine similarity to [1, 0]."""
+    return [cosine, math.sqrt(1 - cosine ** 2)]
+
+
+# Cosine similarity to the first question: above SEMANTIC_CACHE_THRESHOLD (0.92) for the rephrasing only.
+VECTORS = {
+    "how do I sort a list?": [1.0, 0.0],
+    "how can I sort a list?": at_angle(0.95),
+    "how do I reverse a list?": at_angle(0.90),
+}
+
+
+@pytest.fixture
+def cache(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(retrieval, "VECTOR_INDEX_DIR", str(tmp_path / "index"))
+    monkeypatch.setattr(semantic_cache, "SEMANTIC_CACHE_ENABLED", True)
+    monkeypatch.setattr(semantic_cache, "embed_texts", lambda texts: [VECTORS[text] for text in texts])
+    semantic_cache._indexes.clear()
+    yield semantic_cache
+    semantic_cache._indexes.clear()
+
+
+def answer(db, cache, session_id, scope, question, text):
+    db.create_session(session_id)
+    _, embedding = cache.lookup(question, scope)
+    answer_id = db.update_messages(session_id, text, "Ai")
+    cache.remember(embedding, answer_id, scope)
+    return answer_id
+
+
+def test_only_questions_above_the_threshold_are_answered(db, cache):
+    scope = cache.cache_scope("a", "llama3")
+    answer(db, cache, "a", scope, "how do I sort a list?", "Use sorted().")
+    assert cache.lookup("how can I sort a list?", scope)[0] == "Use sorted()."
+    assert cache.lookup("how do I reverse a list?", scope)[0] is None
+    assert cache.lookup("how can I sort a list?", cache.cache_scope("a", "qwen2.5"))[0] is None
+
+
+def test_model_scope_answers_across_sessions(db, cache):
+    assert cache.SEMANTIC_CACHE_SCOPE == "model"
+    answer(db, cache, "a", cache.cache_scope("a", "llama3"), "how do I sort a list?", "Use sorted().")
+    assert cache.lookup("how can I sort a list?", cache.cache_scope("b", "llama3"))[0] == "Use sorted()."
+    # Once the answer's session is deleted, its entry is skipped.
+    db.delete_session("a")
+    cache.forget_session("a")
+    assert cache.lookup("how can I sort a list?", cache.cache_scope("b", "llama3"))[0] is None
+
+
+def test_session_scope_keeps_answers_per_session(db, cache, monkeypatch):
+    monkeypatch.setattr(cache, "SEMANTIC_CACHE_SCOPE", "session")
+    scope = cache.cache_scope("a", "llama3")
+    answer(db, cache, "a", scope, "how do I sort a list?", "Use sorted().")
+    assert cache.lookup("how can I sort a list?", scope)[0] == "Use sorted()."
+    assert cache.lookup("how can I sort a list?", cache.cache_scope("b", "llama3"))[0] is None
+    assert os.listdir(retrieval.VECTOR_INDEX_DIR)
+    cache.forget_session("a")
+    assert os.listdir(retrieval.VECTOR_INDEX_DIR) == []
+    assert cache.lookup("how can I sort a list?", scope)[0] is None
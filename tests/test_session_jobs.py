@@ -0,0 +1,48 @@
+import pytest
+
+pytest.importorskip("httpx")
+
+import session_jobs  # noqa: E402
+from generation_engine import GenerationError  # noqa: E402
+
+
+def fake_model(*answers):
+    """Stands in for stream_ollama_response: each call streams the next answer, or raises it if it is an error."""
+    calls = []
+
+    def stream(prompt, *args, **kwargs):
+        calls.append(prompt)
+        answer = answers[min(len(calls), len(answers)) - 1]
+        if isinstance(answer, Exception):
+            raise answer
+        yield answer
+
+    stream.calls = calls
+    return stream
+
+
+def test_title_is_judged_by_the_generation_not_its_text(db, monkeypatch):
+    db.create_session("s")
+    message_id = db.update_messages("s", "why does this raise a TypeError?", "user")
+    monkeypatch.setattr(session_jobs, "stream_ollama_response", fake_model("Debugging a TypeError"))
+    assert session_jobs.summarize_session_title("s", message_id, "llama3") == "Debugging a TypeError"
+    assert db.fetch_all() == [("s", "Debugging a TypeError")]
+
+    monkeypatch.setattr(session_jobs, "stream_ollama_response", fake_model(GenerationError("model not found")))
+    with pytest.raises(GenerationError):
+        session_jobs.summarize_session_title("s", message_id, "llama3")
+    assert db.fetch_all() == [("s", "Debugging a TypeError")]
+
+
+def test_long_backlog_is_compacted_a_pass_at_a_time(db, monkeypatch):
+    db.create_session("s")
+    ids = [db.update_messages("s", f"message {i} " + "word " * 160, "user" if i % 2 == 0 else "Ai")
+           for i in range(60)]
+    model = fake_model("summary")
+    monkeypatch.setattr(session_jobs, "stream_ollama_response", model)
+    session_jobs._run_compaction("s", "llama3")
+    assert len(model.calls) > 1
+    for prompt in model.calls:
+        assert db.estimate_tokens(prompt) < session_jobs.COMPACTION_PASS_TOKENS + 200
+    assert db.get_session_summary("s") == ("summary", ids[-session_jobs.COMPACTION_KEEP_RECENT - 1])
+    assert session_jobs._foldable_tokens("s") < session_jobs.COMPACTION_THRESHOLD
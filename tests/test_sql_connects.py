@@ -0,0 +1,224 @@
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+
+def query_plans(db, fn):
+    """Runs fn and returns {sql: query plan} for every SELECT it sent, with parameters filled in."""
+    statements = []
+    with db.get_connection() as conn:
+        conn.set_trace_callback(statements.append)
+        try:
+            fn()
+        finally:
+            conn.set_trace_callback(None)
+        return {sql: " | ".join(row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql))
+                for sql in statements if sql.lstrip().upper().startswith("SELECT")}
+
+
+@pytest.fixture
+def history(db):
+    for session_id in ("a", "b"):
+        db.create_session(session_id)
+        for i in range(20):
+            db.update_messages(session_id, f"{session_id} message {i}", "user" if i % 2 == 0 else "Ai")
+    return db
+
+
+@pytest.mark.parametrize("query", [
+    lambda db: db.get_chat_history("a"),
+    lambda db: db.get_chat_history("a", limit=5),
+    lambda db: db.get_chat_history("a", before_id=10, limit=5),
+    lambda db: db.get_messages_after("a", 5),
+    lambda db: db.get_messages_after("a", 5, limit=5),
+], ids=["history", "history-page", "history-before", "messages-after", "messages-after-page"])
+def test_history_queries_use_session_index(history, query):
+    plans = query_plans(history, lambda: query(history))
+    assert plans
+    for sql, plan in plans.items():
+        assert "idx_chat_history_session" in plan, (sql, plan)
+        assert "TEMP B-TREE" not in plan, (sql, plan)  # rows come back in index order, unsorted
+
+
+def test_history_is_ordered_by_id(history):
+    rows = history.get_chat_history("a", limit=5)
+    assert [message for _, _, message in rows] == [f"a message {i}" for i in range(15, 20)]
+    assert rows == history.get_messages_after("a", rows[0][0] - 1)
+
+
+def test_update_messages_rejects_empty_session(db):
+    with pytest.raises(ValueError):
+        db.update_messages("", "hi", "user")
+    assert db.fetch_all() == []
+
+
+def test_delete_session_cascades(history):
+    history.delete_session("a")
+    assert history.get_chat_history("a") == []
+    assert len(history.get_chat_history("b")) == 20
+
+
+def test_conversation_context_is_trimmed_to_the_window(db):
+    db.create_session("long")
+    for i in range(300):
+        db.update_messages("long", f"message {i} " + "word " * 40, "user" if i % 2 == 0 else "Ai")
+        if i % 10 == 0:
+            db.get_conversation_messages("long", token_budget=500)
+    window = db.get_conversation_messages("long", token_budget=500)
+    assert [m["content"].split()[1] for m in window[:2]] == ["0", "1"]  # pinned opening turn
+    assert window[-1]["content"].startswith("message 299 ")
+    assert sum(db.estimate_tokens(m["content"]) for m in window) <= 500
+    entry = db._context_cache["long"]
+    assert len(entry.messages) <= db.CONTEXT_PINNED_MESSAGES + db.CONTEXT_RETAINED_MESSAGES
+    assert db.get_uncompacted_tokens("long") == sum(
+        db.estimate_tokens(db._format_context_line(db._message_role(sender), message))
+        for _, sender, message in db.get_chat_history("long"))
+    # Asking for everything reloads what was trimmed.
+    assert len(db.get_conversation_messages("long", token_budget=0)) == 300
+
+
+def test_uncompacted_tokens_leave_out_recent_messages(db):
+    db.create_session("s")
+    db.update_messages("s", "short question", "user")
+    for _ in range(3):
+        db.update_messages("s", "long answer " * 500, "Ai")
+    total = db.get_uncompacted_tokens("s")
+    assert total > 1000
+    # Only the short question is older than the three recent answers.
+    assert db.get_uncompacted_tokens("s", keep_recent=3) == db.estimate_tokens("User: short question\n")
+    assert db.get_uncompacted_tokens("s", keep_recent=4) == 0
+
+
+def vm_steps(db, fn):
+    """SQLite virtual machine instructions (in hundreds) executed by fn."""
+    steps = [0]
+
+    def count():
+        steps[0] += 1
+        return 0
+
+    with db.get_connection() as conn:
+        conn.set_progress_handler(count, 100)
+        try:
+            fn()
+        finally:
+            conn.set_progress_handler(None, 100)
+    return steps[0]
+
+
+def test_sessions_to_title_does_not_scan_messages(db):
+    for session_id in ("a", "b", "c"):
+        db.create_session(session_id)
+        db.update_messages(session_id, "hello", "user")
+    db.update_session_name("Titled", "c", db.get_chat_history("c")[-1][0])
+    short = vm_steps(db, db.fetch_sessions_to_title)
+    with db.get_connection() as conn, conn:
+        conn.executemany("INSERT INTO chat_history (session_id, sender, message) VALUES ('a', 'user', ?)",
+                         [(f"message {i}",) for i in range(5000)])
+    assert sorted(session_id for session_id, _ in db.fetch_sessions_to_title()) == ["a", "b"]
+    assert vm_steps(db, db.fetch_sessions_to_title) <= short + 1
+
+
+def search_ids(db, query):
+    return [message_id for message_id, *_ in db.search_chat_history(query)]
+
+
+def test_search_follows_inserts_updates_and_deletes(db):
+    db.create_session("a")
+    db.create_session("b")
+    question = db.update_messages("a", "How do I rotate a matrix in numpy?", "user")
+    answer = db.update_messages("b", "Use numpy.rot90 to rotate it.", "Ai")
+    assert sorted(search_ids(db, "rotate")) == sorted([question, answer])
+    assert search_ids(db, "numpy.rot") == [answer]  # the last word matches as a prefix
+    (message_id, session_id, session_name, sender, snippet), = db.search_chat_history("matrix")
+    assert (message_id, session_id, session_name, sender) == (question, "a", "a", "user")
+    assert "**matrix**" in snippet
+
+    with db.get_connection() as conn, conn:
+        conn.execute("UPDATE chat_history SET message = 'How do I transpose an array?' WHERE id = ?", (question,))
+    assert search_ids(db, "matrix") == []
+    assert search_ids(db, "transpose") == [question]
+
+    db.delete_session("b")  # chat_history rows go by cascade, and the index follows them
+    assert search_ids(db, "rotate") == []
+    with db.get_connection() as conn:
+        assert conn.execute("SELECT count(*) FROM chat_history_fts").fetchone()[0] == 1
+
+
+@pytest.mark.parametrize("query", ["", "   ", "?!", "\"*", "(", "-"])
+def test_search_without_words_finds_nothing(db, query):
+    db.create_session("a")
+    db.update_messages("a", "then - (it) said \"*\"?!", "user")
+    assert db.search_chat_history(query) == []
+
+
+def test_search_treats_operators_as_words(db):
+    db.create_session("a")
+    message_id = db.update_messages("a", "cats AND dogs NOT birds", "user")
+    assert search_ids(db, "AND") == [message_id]
+    assert search_ids(db, "NOT birds") == [message_id]
+    assert search_ids(db, "cats OR fish") == []
+
+
+def test_background_jobs_are_queued_once(db):
+    assert db.queue_background_job("compaction", "compaction:a", ["a", "model"])
+    assert not db.queue_background_job("compaction", "compaction:a", ["a", "model"])
+    assert db.queue_background_job("titles", "titles", ["model", "local", None, None])
+    assert db.take_background_jobs() == [("compaction", ["a", "model"]), ("titles", ["model", "local", None, None])]
+    assert db.take_background_jobs() == []
+    assert db.queue_background_job("compaction", "compaction:a", ["a", "model"])
+
+
+def test_shared_state_and_counters(db):
+    assert db.get_counter("titles") == 0
+    assert [db.increment_counter("titles") for _ in range(3)] == [1, 2, 3]
+    assert db.get_counter("titles") == 3
+    assert db.read_shared_state("model-status:m", ["not loaded", None]) == ["not loaded", None]
+    db.save_shared_state("model-status:m", ["loaded", 12.5])
+    assert db.read_shared_state("model-status:m") == ["loaded", 12.5]
+    document_id = db.create_document("s", "notes.txt")
+    assert db.get_document_progress(document_id) is None
+    db.save_document_progress(document_id, {"status": "ingesting", "chunks": 4})
+    assert db.get_document_progress(document_id) == {"status": "ingesting", "chunks": 4}
+
+
+def test_failed_queued_writes_are_recorded(db, monkeypatch):
+    monkeypatch.setattr(db, "WRITE_BEHIND", True)
+    failed_before = db.write_behind_stats["failed"]
+    db.create_session("s")
+    first = db.update_messages("s", "one", "user")
+    db.flush_writes()
+    with db._write_lock:
+        db._queue_write("message", "s", (first, "s", "user", "same id again"))
+    db.update_messages("s", "two", "user")
+    db.flush_writes()
+    assert [message for _, _, message in db.get_chat_history("s")] == ["one", "two"]
+    assert db.write_behind_stats["failed"] == failed_before + 1
+    assert db.failed_writes()[-1][:3] == ("message", "s", (first, "s", "user", "same id again"))
+
+
+SIGTERM_PROBE = """
+import os, signal, sys
+import sql_connects
+sql_connects.DB_FILENAME = sys.argv[1]
+sql_connects.WRITE_BEHIND_INTERVAL = 60
+sql_connects.init_db()
+sql_connects.install_shutdown_flush()
+for i in range(5):
+    sql_connects.update_messages("s", f"message {i}", "user")
+os.kill(os.getpid(), signal.SIGTERM)
+"""
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGKILL"), reason="POSIX only")
+def test_sigterm_flushes_queued_writes(tmp_path):
+    path = str(tmp_path / "test.db")
+    env = dict(os.environ, SQL_WRITE_BEHIND="1", UNCOVER_WORKERS="1", PYTHONPATH=os.pathsep.join(sys.path))
+    result = subprocess.run([sys.executable, "-c", SIGTERM_PROBE, path], env=env, capture_output=True, timeout=60)
+    assert result.returncode == -signal.SIGTERM, result.stderr
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM chat_history").fetchone()[0] == 5
@@ -0,0 +1,81 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("dash")
+pytest.importorskip("httpx")
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Counts the SQLite connections opened while importing the app, and whether numpy got imported.
+IMPORT_PROBE = """
+import sqlite3
+import sys
+opened = []
+connect = sqlite3.connect
+sqlite3.connect = lambda *args, **kwargs: opened.append(args) or connect(*args, **kwargs)
+import main
+print(len(opened), "numpy" in sys.modules)
+"""
+
+# Time to a usable first page in a fresh interpreter: importing main, then init_db and the bootstrap_page
+# callback on the database that creates. The bounds are loose enough for a slow CI machine but catch an
+# eager heavy import or a wait on the Ollama daemon (OLLAMA_HOST points at a socket that never answers).
+STARTUP_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+main.init_db()
+main.bootstrap_page("/")
+print(json.dumps({"import": imported - started, "first page": time.perf_counter() - imported}))
+"""
+IMPORT_BUDGET = 5.0  # seconds; about 0.8 on a developer laptop
+FIRST_PAGE_BUDGET = 1.0  # seconds; a few milliseconds when nothing waits on the daemon
+STARTUP_RUNS = 3  # the fastest run is compared, so one slow run on a busy machine does not fail the test
+
+
+def test_import_does_no_database_io(tmp_path):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([REPO, *sys.path]))
+    result = subprocess.run([sys.executable, "-c", IMPORT_PROBE], cwd=tmp_path, env=env,
+                            capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.split()[-2:] == ["0", "False"]
+    assert not list(tmp_path.iterdir())  # no database file created either
+
+
+def test_first_page_is_served_within_budget(tmp_path):
+    timings = []
+    with socket.create_server(("127.0.0.1", 0)) as silent:  # connections queue up, requests get no reply
+        host, port = silent.getsockname()
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([REPO, *sys.path]), OLLAMA_HOST=f"http://{host}:{port}")
+        for _ in range(STARTUP_RUNS):
+            result = subprocess.run([sys.executable, "-c", STARTUP_PROBE], cwd=tmp_path, env=env,
+                                    capture_output=True, text=True, timeout=120)
+            assert result.returncode == 0, result.stderr
+            timings.append(json.loads(result.stdout.splitlines()[-1]))
+    assert min(t["import"] for t in timings) < IMPORT_BUDGET, timings
+    assert min(t["first page"] for t in timings) < FIRST_PAGE_BUDGET, timings
+
+
+def test_bootstrap_page_fills_every_output(db, monkeypatch):
+    import main
+
+    catalog = [{"name": "llama3:8b", "size": 4.7e9, "family": "llama", "parameter_size": "8B",
+                "quantization": "Q4_0", "modified_at": None}]
+    monkeypatch.setattr(main, "get_model_catalog", lambda *args, **kwargs: catalog)
+    monkeypatch.setattr(main, "model_catalog_loaded", lambda: True)
+    outputs = next(callback["output"] for callback in main.app.callback_map.values()
+                   if callback["callback"].__name__ == "bootstrap_page")
+    result = main.bootstrap_page("/")
+    assert isinstance(result, tuple)
+    assert len(result) == len(outputs) == 12
+    models, *_, sessions, session, _, _, catalog_poll_disabled = result
+    assert models == [{"label": "llama3:8b (8B, Q4_0, 4.7 GB)", "value": "llama3:8b"}]
+    assert sessions == [{"label": "Session 1", "value": "Session 1"}]
+    assert session == "Session 1"
+    assert catalog_poll_disabled
@@ -0,0 +1,12 @@
+# WSGI entry point for headless serving, e.g.
+#     gunicorn --workers 4 --threads 8 --worker-class gthread --bind 0.0.0.0:8919 wsgi:server
+# or `python main.py --headless --workers 4`. Unless UNCOVER_WORKERS=1 says otherwise, processes assume
+# they share the database with other workers (see sql_connects.MULTI_PROCESS).
+import os
+
+os.environ.setdefault("UNCOVER_WORKERS", "2")
+
+from main import server, start_background_services  # noqa: E402
+
+start_background_services()
+application = server